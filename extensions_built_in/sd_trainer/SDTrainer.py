@@ -51,6 +51,8 @@ class SDTrainer(BaseSDTrainProcess):
         self.assistant_adapter: Union['T2IAdapter', 'ControlNetModel', None]
         self.do_prior_prediction = False
         self.do_long_prompts = False
+        self.supports_text_embedding_cache = True
+        self.supports_distributed = True
         self.do_guided_loss = False
         self.taesd: Optional[AutoencoderTiny] = None
 
@@ -1205,13 +1207,30 @@ class SDTrainer(BaseSDTrainProcess):
                                 self.sd.text_encoder.eval()
                             if isinstance(self.adapter, CustomAdapter):
                                 self.adapter.is_unconditional_run = False
-                            conditional_embeds = self.sd.encode_prompt(
-                                conditioned_prompts, prompt_2,
-                                dropout_prob=self.train_config.prompt_dropout_prob,
-                                long_prompts=self.do_long_prompts).to(
-                                self.device_torch,
-                                dtype=dtype)
-                            if self.train_config.do_cfg:
+                            # cached by the dataset for these captions
+                            use_cached_embeds = batch.prompt_embeds is not None and not self.do_long_prompts
+                            if self.train_config.do_cfg and not isinstance(self.adapter, CustomAdapter):
+                                # negative prompts are memoized, new ones are encoded in one batch with the prompts
+                                conditional_embeds, unconditional_embeds = self.sd.encode_prompt_with_negative(
+                                    None if use_cached_embeds else conditioned_prompts,
+                                    self.batch_negative_prompt,
+                                    prompt2=prompt_2,
+                                    dropout_prob=self.train_config.prompt_dropout_prob,
+                                    long_prompts=self.do_long_prompts)
+                                if use_cached_embeds:
+                                    conditional_embeds = batch.prompt_embeds
+                                conditional_embeds = conditional_embeds.to(self.device_torch, dtype=dtype)
+                                unconditional_embeds = unconditional_embeds.to(self.device_torch, dtype=dtype)
+                            elif use_cached_embeds:
+                                conditional_embeds = batch.prompt_embeds.to(self.device_torch, dtype=dtype)
+                            else:
+                                conditional_embeds = self.sd.encode_prompt(
+                                    conditioned_prompts, prompt_2,
+                                    dropout_prob=self.train_config.prompt_dropout_prob,
+                                    long_prompts=self.do_long_prompts).to(
+                                    self.device_torch,
+                                    dtype=dtype)
+                            if self.train_config.do_cfg and unconditional_embeds is None:
                                 if isinstance(self.adapter, CustomAdapter):
                                     self.adapter.is_unconditional_run = True
                                 unconditional_embeds = self.sd.encode_prompt(
@@ -1522,6 +1541,8 @@ class SDTrainer(BaseSDTrainProcess):
         # flush()
 
         if not self.is_grad_accumulation_step:
+            # before unscaling so every rank sees the same infs and skips the same steps
+            self.sync_gradients()
             # fix this for multi params
             if self.train_config.optimizer != 'adafactor':
                 self.scaler.unscale_(self.optimizer)
@@ -30,12 +30,23 @@ class ExtractJob(BaseJob):
         self.output_folder = self.get_conf('output_folder', required=True)
         self.is_v2 = self.get_conf('is_v2', False)
         self.device = self.get_conf('device', 'cpu')
+        # read safetensors checkpoints lazily instead of loading both models
+        self.stream = self.get_conf('stream', True)
+        # layers extracted in parallel when streaming
+        self.num_workers = self.get_conf('num_workers', 4)
 
         # loads the processes from the config
         self.load_processes(process_dict)
 
     def run(self):
         super().run()
+        if self.stream:
+            if self.base_model_path.endswith('.safetensors') and self.extract_model_path.endswith('.safetensors'):
+                print(f"Streaming weights from {self.base_model_path} and {self.extract_model_path}")
+                self.run_processes()
+                return
+            print("Streaming needs two .safetensors checkpoints, loading the models instead")
+            self.stream = False
         # load models
         print(f"Loading models for extraction")
         print(f" - Loading base model: {self.base_model_path}")
@@ -51,6 +62,9 @@ class ExtractJob(BaseJob):
         self.model_extract_vae = self.model_extract[1]
         self.model_extract_unet = self.model_extract[2]
 
+        self.run_processes()
+
+    def run_processes(self):
         print("")
         print(f"Running  {len(self.process)} process{'' if len(self.process) == 1 else 'es'}")
 
@@ -4,6 +4,7 @@ from collections import OrderedDict
 from safetensors.torch import save_file
 
 from jobs.process.BaseProcess import BaseProcess
+from toolkit.lycoris_utils import extract_diff_from_files
 from toolkit.metadata import get_meta_for_safetensors
 
 from typing import ForwardRef
@@ -68,6 +69,25 @@ class BaseExtractProcess(BaseProcess):
 
         return os.path.join(self.job.output_folder, output_filename)
 
+    def extract_streaming(self, **kwargs):
+        # extract straight from the checkpoint files to output_path, kwargs are passed to extract_diff_from_files
+        save_meta = get_meta_for_safetensors(self.meta, self.job.name)
+        num_extracted = extract_diff_from_files(
+            self.job.base_model_path,
+            self.job.extract_model_path,
+            self.output_path,
+            is_v2=self.job.is_v2,
+            extract_device=self.job.device,
+            extract_unet=self.extract_unet,
+            extract_text_encoder=self.extract_text_encoder,
+            num_workers=self.job.num_workers,
+            save_dtype=self.torch_dtype,
+            metadata=save_meta,
+            **kwargs
+        )
+        print(f"Extracted {num_extracted} layers")
+        print(f"Saved to {self.output_path}")
+
     def save(self, state_dict):
         # prepare meta
         save_meta = get_meta_for_safetensors(self.meta, self.job.name)
@@ -20,8 +20,12 @@ class BaseProcess(object):
         self.raw_process_config = config
         self.name = self.get_conf('name', self.job.name)
         self.meta = copy.deepcopy(self.job.meta)
-        self.timer: Timer = Timer(f'{self.name} Timer')
         self.performance_log_every = self.get_conf('performance_log_every', 0)
+        # also write the timer stats as json and a chrome trace to this folder every performance_log_every
+        self.performance_log_dir = self.get_conf('performance_log_dir', None)
+        # time the gpu side of each span with cuda events
+        self.performance_log_cuda = self.get_conf('performance_log_cuda', False)
+        self.timer: Timer = Timer(f'{self.name} Timer', use_cuda_events=self.performance_log_cuda)
 
         print(json.dumps(self.config, indent=4))
 
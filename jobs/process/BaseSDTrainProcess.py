@@ -21,7 +21,7 @@ import torch.backends.cuda
 from toolkit.basic import value_map
 from toolkit.clip_vision_adapter import ClipVisionAdapter
 from toolkit.custom_adapter import CustomAdapter
-from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch
+from toolkit.data_loader import get_dataloader_from_datasets, trigger_dataloader_setup_epoch, get_dataloader_datasets
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
 from toolkit.ema import ExponentialMovingAverage
 from toolkit.embedding import Embedding
@@ -48,6 +48,12 @@ from jobs.process import BaseTrainProcess
 from toolkit.metadata import get_meta_for_safetensors, load_metadata_from_safetensors, add_base_model_info_to_meta, \
     parse_metadata_from_safetensors
 from toolkit.train_tools import get_torch_dtype, LearnableSNRGamma, apply_learnable_snr_gos, apply_snr_weight
+from toolkit.timestep_sampler import TimestepSampler
+from toolkit.sync_debug import HostSyncCounter
+from toolkit.async_saver import AsyncSaver
+from toolkit.train_metrics import TrainMetrics
+from toolkit.distributed import init_distributed, cleanup_distributed, get_rank, get_local_rank, is_main_process, \
+    broadcast_parameters, all_reduce_gradients, all_reduce_mean_dict
 import gc
 
 from tqdm import tqdm
@@ -84,6 +90,30 @@ class BaseSDTrainProcess(BaseTrainProcess):
         else:
             self.network_config = None
         self.train_config = TrainConfig(**self.get_conf('train', {}))
+        self.is_distributed = init_distributed(
+            self.train_config.distributed,
+            backend=self.train_config.distributed_backend,
+            timeout_minutes=self.train_config.distributed_timeout,
+        )
+        # set by trainers that sync their gradients with sync_gradients
+        self.supports_distributed = False
+        if self.is_distributed:
+            if self.device_torch.type == 'cuda':
+                # one device per process
+                self.device = f'cuda:{get_local_rank()}'
+                self.device_torch = torch.device(self.device)
+            if self.training_seed is not None:
+                # different noise on every rank, the trained weights are synced from the main process
+                torch.manual_seed(self.training_seed + get_rank())
+                if torch.cuda.is_available():
+                    torch.cuda.manual_seed(self.training_seed + get_rank())
+                random.seed(self.training_seed + get_rank())
+        # time spent in these spans is time the training loop waited for data
+        self.timer.data_wait_names = {'get_batch', 'get_batch:reg', 'reset_batch', 'reset_batch:reg'}
+        self.timestep_sampler = TimestepSampler(self.train_config, self.device_torch)
+        self.host_sync_counter: Union[HostSyncCounter, None] = None
+        if self.train_config.debug_host_syncs:
+            self.host_sync_counter = HostSyncCounter()
         model_config = self.get_conf('model', {})
 
         # update modelconfig dtype to match train
@@ -91,6 +121,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.model_config = ModelConfig(**model_config)
 
         self.save_config = SaveConfig(**self.get_conf('save', {}))
+        self.async_saver: Union[AsyncSaver, None] = None
+        if self.save_config.async_save:
+            self.async_saver = AsyncSaver(max_pinned_mb=self.save_config.async_save_max_pinned_mb)
         self.sample_config = SampleConfig(**self.get_conf('sample', {}))
         first_sample_config = self.get_conf('first_sample', None)
         if first_sample_config is not None:
@@ -100,6 +133,11 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.has_first_sample_requested = False
             self.first_sample_config = self.sample_config
         self.logging_config = LogingConfig(**self.get_conf('logging', {}))
+        self.train_metrics = TrainMetrics(
+            os.path.join(self.save_root, 'metrics.jsonl')
+            if self.logging_config.log_metrics and is_main_process() else None,
+            reset_peaks=self.logging_config.log_metrics and self.logging_config.reset_memory_peaks
+        )
         self.optimizer: torch.optim.Optimizer = None
         self.lr_scheduler = None
         self.data_loader: Union[DataLoader, None] = None
@@ -152,6 +190,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         self.network: Union[Network, None] = None
         self.adapter: Union[T2IAdapter, IPAdapter, ClipVisionAdapter, ReferenceAdapter, CustomAdapter, ControlNetModel, None] = None
         self.embedding: Union[Embedding, None] = None
+        # set by trainers that use batch.prompt_embeds from datasets caching text embeddings
+        self.supports_text_embedding_cache = False
 
         is_training_adapter = self.adapter_config is not None and self.adapter_config.train
 
@@ -188,6 +228,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         return generate_image_config_list
 
     def sample(self, step=None, is_first=False):
+        if not is_main_process():
+            return
         flush()
         sample_folder = os.path.join(self.save_root, 'samples')
         gen_img_config_list = []
@@ -382,7 +424,34 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # override in subclass
         pass
 
+    def save_merged_model(self, step_num: str, save_meta: OrderedDict):
+        # the full model with the network merged in, saved next to the network weights
+        if not self.network.can_merge_in or self.network.network_type.lower() == 'dora':
+            print("Warning: merge_network_on_save is set but this network cannot be merged in, skipping")
+            return
+        file_path = os.path.join(self.save_root, f'{self.job.name}_merged{step_num}.safetensors')
+        if self.save_config.save_format == "diffusers":
+            # saving as a folder path
+            file_path = file_path.replace('.safetensors', '')
+            save_meta = parse_metadata_from_safetensors(save_meta)
+        self.network.merge_in(merge_weight=1.0)
+        try:
+            # the state dict is copied out before the original weights are put back
+            self.sd.save(
+                file_path,
+                save_meta,
+                get_torch_dtype(self.save_config.dtype),
+                saver=self.async_saver
+            )
+        finally:
+            self.network.merge_out()
+
     def save(self, step=None):
+        if not is_main_process():
+            return
+        if self.async_saver is not None:
+            # only one save in flight, wait for the last one to be written
+            self.async_saver.begin()
         flush()
         if self.ema is not None:
             # always save params as ema
@@ -428,11 +497,15 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     file_path,
                     dtype=get_torch_dtype(self.save_config.dtype),
                     metadata=save_meta,
-                    extra_state_dict=embedding_dict
+                    extra_state_dict=embedding_dict,
+                    saver=self.async_saver
                 )
                 self.network.multiplier = prev_multiplier
                 # if we have an embedding as well, pair it with the network
 
+                if self.train_config.merge_network_on_save:
+                    self.save_merged_model(step_num, save_meta)
+
             # even if added to lora, still save the trigger version
             if self.embedding is not None:
                 emb_filename = f'{self.embed_config.trigger}{step_num}.safetensors'
@@ -470,7 +543,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         state_dict,
                         output_file=file_path,
                         meta=save_meta,
-                        dtype=get_torch_dtype(self.save_config.dtype)
+                        dtype=get_torch_dtype(self.save_config.dtype),
+                        saver=self.async_saver
                     )
                 elif self.adapter_config.type == 'control_net':
                     # save in diffusers format
@@ -495,7 +569,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         output_file=file_path,
                         meta=save_meta,
                         dtype=get_torch_dtype(self.save_config.dtype),
-                        direct_save=self.adapter_config.train_only_image_encoder
+                        direct_save=self.adapter_config.train_only_image_encoder,
+                        saver=self.async_saver
                     )
         else:
             if self.save_config.save_format == "diffusers":
@@ -518,7 +593,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 self.sd.save(
                     file_path,
                     save_meta,
-                    get_torch_dtype(self.save_config.dtype)
+                    get_torch_dtype(self.save_config.dtype),
+                    saver=self.async_saver
                 )
 
         # save learnable params as json if we have thim
@@ -530,22 +606,43 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 'gamma': self.snr_gos.gamma.item(),
             }
             path_to_save = file_path = os.path.join(self.save_root, 'learnable_snr.json')
-            with open(path_to_save, 'w') as f:
-                json.dump(json_data, f, indent=4)
+
+            def save_snr_json():
+                with open(path_to_save, 'w') as f:
+                    json.dump(json_data, f, indent=4)
+
+            if self.async_saver is not None:
+                self.async_saver.run(save_snr_json)
+            else:
+                save_snr_json()
 
         # save optimizer
         if self.optimizer is not None:
             try:
                 filename = f'optimizer.pt'
                 file_path = os.path.join(self.save_root, filename)
-                torch.save(self.optimizer.state_dict(), file_path)
+                if self.async_saver is not None:
+                    self.async_saver.torch_save(self.optimizer.state_dict(), file_path)
+                else:
+                    torch.save(self.optimizer.state_dict(), file_path)
             except Exception as e:
                 print(e)
                 print("Could not save optimizer")
 
-        self.print(f"Saved to {file_path}")
-        self.clean_up_saves()
-        self.post_save_hook(file_path)
+        if self.async_saver is not None:
+            saved_path = file_path
+
+            def finish_save():
+                self.print(f"Saved to {saved_path}")
+                self.clean_up_saves()
+                self.post_save_hook(saved_path)
+
+            # everything is snapshotted, write it out while training continues
+            self.async_saver.commit(on_done=finish_save)
+        else:
+            self.print(f"Saved to {file_path}")
+            self.clean_up_saves()
+            self.post_save_hook(file_path)
 
         if self.ema is not None:
             self.ema.train()
@@ -589,11 +686,79 @@ class BaseSDTrainProcess(BaseTrainProcess):
     def before_dataset_load(self):
         pass
 
+    def get_text_embedding_prompt(self, prompt: str, is_reg: bool) -> str:
+        # what process_general_training_batch does to a caption before it is encoded
+        if self.trigger_word is not None:
+            prompt = self.sd.inject_trigger_into_prompt(
+                prompt,
+                trigger=self.trigger_word,
+                add_if_not_present=not is_reg,
+            )
+        return prompt
+
+    def get_text_embedding_cache_blocker(self) -> Union[str, None]:
+        # cached embeddings are only valid if the text encoder is frozen and the encoded prompt only depends
+        # on the caption. Returns why they cannot be used, or None
+        if not self.supports_text_embedding_cache:
+            return "this trainer does not use cached text embeddings"
+        if self.train_config.train_text_encoder:
+            return "the text encoder is being trained"
+        if self.embedding is not None:
+            return "an embedding is being trained"
+        if self.adapter is not None and isinstance(self.adapter, (ClipVisionAdapter, CustomAdapter)):
+            return "the adapter changes the prompt or text encoder"
+        if self.adapter_config is not None and self.adapter_config.type == 'te_augmenter':
+            return "te_augmenter changes the text encoder"
+        if self.train_config.prompt_saturation_chance > 0:
+            return "prompt_saturation_chance changes prompts at train time"
+        if self.train_config.prompt_dropout_prob > 0:
+            return "prompt_dropout_prob drops encoders at train time"
+        if self.train_config.short_and_long_captions or self.train_config.short_and_long_captions_encoder_split:
+            return "short and long captions are not cached"
+        if self.train_config.single_item_batching:
+            return "single_item_batching is not supported"
+        if self.model_config.refiner_name_or_path is not None:
+            return "refiners are not supported"
+        return None
+
+    def setup_text_embedding_cache(self):
+        all_datasets = []
+        for data_loader in [self.data_loader, self.data_loader_reg]:
+            if data_loader is not None:
+                all_datasets += get_dataloader_datasets(data_loader)
+        datasets = [x for x in all_datasets if x.dataset_config.cache_text_embeddings]
+        if len(datasets) == 0:
+            return
+        blocker = self.get_text_embedding_cache_blocker()
+        if blocker is not None:
+            self.print(f"Not caching text embeddings, {blocker}")
+            return
+        for dataset in datasets:
+            dataset.cache_text_embeddings(self.get_text_embedding_prompt)
+
+        if self.train_config.unload_text_encoder:
+            if len(datasets) < len(all_datasets):
+                self.print("Keeping the text encoder loaded, not every dataset caches text embeddings")
+            elif self.train_config.do_cfg or self.train_config.do_random_cfg:
+                self.print("Keeping the text encoder loaded, cfg training encodes negative prompts")
+            else:
+                self.print("Unloading the text encoder")
+                text_encoders = self.sd.text_encoder if isinstance(self.sd.text_encoder, list) else [self.sd.text_encoder]
+                for text_encoder in text_encoders:
+                    text_encoder.to('cpu')
+                flush()
+
     def get_params(self):
         # you can extend this in subclass to get params
         # otherwise params will be gathered through normal means
         return None
 
+    def sync_gradients(self):
+        # average the gradients over all ranks before the optimizer step
+        if self.is_distributed:
+            with self.timer('sync_gradients'):
+                all_reduce_gradients(self.optimizer.param_groups)
+
     def hook_train_loop(self, batch):
         # return loss
         return 0.0
@@ -710,16 +875,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         return params
 
     def get_sigmas(self, timesteps, n_dim=4, dtype=torch.float32):
-        sigmas = self.sd.noise_scheduler.sigmas.to(device=self.device, dtype=dtype)
-        schedule_timesteps = self.sd.noise_scheduler.timesteps.to(self.device)
-        timesteps = timesteps.to(self.device)
-
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
-
-        sigma = sigmas[step_indices].flatten()
-        while len(sigma.shape) < n_dim:
-            sigma = sigma.unsqueeze(-1)
-        return sigma
+        return self.timestep_sampler.get_sigmas(timesteps, n_dim=n_dim, dtype=dtype)
 
     def get_noise(self, latents, batch_size, dtype=torch.float32):
         # get noise
@@ -808,6 +964,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             with self.timer('prepare_latents'):
                 dtype = get_torch_dtype(self.train_config.dtype)
+                # starts all the host to device copies at once, they do not block when the batch is pinned
+                batch.to_device(self.device_torch)
                 imgs = None
                 is_reg = any(batch.get_is_reg_list())
                 if batch.tensor is not None:
@@ -895,89 +1053,19 @@ class BaseSDTrainProcess(BaseTrainProcess):
                     do_double = False
 
             with self.timer('prepare_noise'):
-                num_train_timesteps = self.train_config.num_train_timesteps
-
-                if self.train_config.noise_scheduler in ['custom_lcm']:
-                    # we store this value on our custom one
-                    self.sd.noise_scheduler.set_timesteps(
-                        self.sd.noise_scheduler.train_timesteps, device=self.device_torch
-                    )
-                elif self.train_config.noise_scheduler in ['lcm']:
-                    self.sd.noise_scheduler.set_timesteps(
-                        num_train_timesteps, device=self.device_torch, original_inference_steps=num_train_timesteps
-                    )
-                elif self.train_config.noise_scheduler == 'flowmatch':
-                    self.sd.noise_scheduler.set_train_timesteps(
-                        num_train_timesteps,
-                        device=self.device_torch,
-                        linear=self.train_config.linear_timesteps
-                    )
-                else:
-                    self.sd.noise_scheduler.set_timesteps(
-                        num_train_timesteps, device=self.device_torch
-                    )
+                self.timestep_sampler.set_train_timesteps(self.sd.noise_scheduler)
 
                 content_or_style = self.train_config.content_or_style
                 if is_reg:
                     content_or_style = self.train_config.content_or_style_reg
 
-                # if self.train_config.timestep_sampling == 'style' or self.train_config.timestep_sampling == 'content':
-                if content_or_style in ['style', 'content']:
-                    # this is from diffusers training code
-                    # Cubic sampling for favoring later or earlier timesteps
-                    # For more details about why cubic sampling is used for content / structure,
-                    # refer to section 3.4 of https://arxiv.org/abs/2302.08453
-
-                    # for content / structure, it is best to favor earlier timesteps
-                    # for style, it is best to favor later timesteps
-
-                    orig_timesteps = torch.rand((batch_size,), device=latents.device)
-
-                    if content_or_style == 'content':
-                        timestep_indices = orig_timesteps ** 3 * self.train_config.num_train_timesteps
-                    elif content_or_style == 'style':
-                        timestep_indices = (1 - orig_timesteps ** 3) * self.train_config.num_train_timesteps
-
-                    timestep_indices = value_map(
-                        timestep_indices,
-                        0,
-                        self.train_config.num_train_timesteps - 1,
-                        min_noise_steps,
-                        max_noise_steps - 1
-                    )
-                    timestep_indices = timestep_indices.long().clamp(
-                        min_noise_steps + 1,
-                        max_noise_steps - 1
-                    )
-
-                elif content_or_style == 'balanced':
-                    if min_noise_steps == max_noise_steps:
-                        timestep_indices = torch.ones((batch_size,), device=self.device_torch) * min_noise_steps
-                    else:
-                        # todo, some schedulers use indices, otheres use timesteps. Not sure what to do here
-                        timestep_indices = torch.randint(
-                            min_noise_steps + 1,
-                            max_noise_steps - 1,
-                            (batch_size,),
-                            device=self.device_torch
-                        )
-                    timestep_indices = timestep_indices.long()
-                else:
-                    raise ValueError(f"Unknown content_or_style {content_or_style}")
-
-                # do flow matching
-                # if self.sd.is_flow_matching:
-                #     u = compute_density_for_timestep_sampling(
-                #         weighting_scheme="logit_normal",  # ["sigma_sqrt", "logit_normal", "mode", "cosmap"]
-                #         batch_size=batch_size,
-                #         logit_mean=0.0,
-                #         logit_std=1.0,
-                #         mode_scale=1.29,
-                #     )
-                #     timestep_indices = (u * self.sd.noise_scheduler.config.num_train_timesteps).long()
-                # convert the timestep_indices to a timestep
-                timesteps = [self.sd.noise_scheduler.timesteps[x.item()] for x in timestep_indices]
-                timesteps = torch.stack(timesteps, dim=0)
+                # sampled and converted to timesteps on the device, without reading them back
+                timesteps = self.timestep_sampler.sample_timesteps(
+                    batch_size,
+                    content_or_style,
+                    min_noise_steps,
+                    max_noise_steps
+                )
 
                 # get noise
                 noise = self.get_noise(latents, batch_size, dtype=dtype)
@@ -1188,6 +1276,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         # torch.autograd.set_detect_anomaly(True)
         # run base process run
         BaseTrainProcess.run(self)
+        if self.is_distributed and not self.supports_distributed:
+            raise ValueError(f"{self.__class__.__name__} does not support data parallel training")
         params = []
 
         ### HOOK ###
@@ -1512,6 +1602,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
         optimizer = get_optimizer(self.params, optimizer_type, learning_rate=self.train_config.lr,
                                   optimizer_params=self.train_config.optimizer_params)
         self.optimizer = optimizer
+        # every rank starts from the weights of the main process
+        broadcast_parameters(optimizer.param_groups)
 
         # check if it exists
         optimizer_state_filename = f'optimizer.pt'
@@ -1565,6 +1657,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         if self.datasets_reg is not None:
             self.data_loader_reg = get_dataloader_from_datasets(self.datasets_reg, self.train_config.batch_size,
                                                                 self.sd)
+        self.setup_text_embedding_cache()
 
         flush()
         ### HOOK ###
@@ -1587,6 +1680,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
             leave=True,
             initial=self.step_num,
             iterable=range(0, self.train_config.steps),
+            disable=not is_main_process(),
         )
         self.progress_bar.pause()
 
@@ -1628,6 +1722,7 @@ class BaseSDTrainProcess(BaseTrainProcess):
         did_first_flush = False
         for step in range(start_step_num, self.train_config.steps):
             self.timer.start('train_loop')
+            self.train_metrics.start_step()
             if self.train_config.do_random_cfg:
                 self.train_config.do_cfg = True
                 self.train_config.cfg_scale = value_map(random.random(), 0, 1, 1.0, self.train_config.max_cfg_scale)
@@ -1654,8 +1749,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         with self.timer('reset_batch:reg'):
                             # hit the end of an epoch, reset
                             self.progress_bar.pause()
-                            dataloader_iterator_reg = iter(dataloader_reg)
+                            # set up the new epoch first, the iterator starts loading from it right away
                             trigger_dataloader_setup_epoch(dataloader_reg)
+                            dataloader_iterator_reg = iter(dataloader_reg)
 
                         with self.timer('get_batch:reg'):
                             batch = next(dataloader_iterator_reg)
@@ -1669,8 +1765,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         with self.timer('reset_batch'):
                             # hit the end of an epoch, reset
                             self.progress_bar.pause()
-                            dataloader_iterator = iter(dataloader)
+                            # set up the new epoch first, the iterator starts loading from it right away
                             trigger_dataloader_setup_epoch(dataloader)
+                            dataloader_iterator = iter(dataloader)
                             self.epoch_num += 1
                             if self.train_config.gradient_accumulation_steps == -1:
                                 # if we are accumulating for an entire epoch, trigger a step
@@ -1682,6 +1779,12 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 else:
                     batch = None
 
+                if isinstance(batch, DataLoaderBatchDTO) and len(batch.timings) > 0:
+                    # spans the dataloader workers recorded for this batch
+                    self.timer.add_events(batch.timings, parent='get_batch:reg' if is_reg_step else 'get_batch')
+                    batch.timings = []
+                self.train_metrics.data_ready()
+
                 # setup accumulation
                 if self.train_config.gradient_accumulation_steps == -1:
                     # epoch is handling the accumulation, dont touch it
@@ -1698,8 +1801,22 @@ class BaseSDTrainProcess(BaseTrainProcess):
 
             # flush()
             ### HOOK ###
-            loss_dict = self.hook_train_loop(batch)
+            if self.host_sync_counter is not None:
+                with self.host_sync_counter:
+                    loss_dict = self.hook_train_loop(batch)
+            else:
+                loss_dict = self.hook_train_loop(batch)
             self.timer.stop('train_loop')
+            if isinstance(batch, DataLoaderBatchDTO):
+                self.train_metrics.end_step(
+                    num_samples=len(batch.file_items),
+                    num_images=len(batch.file_items) if batch.tensor is not None else 0,
+                    # only batches of cached latents count as latents
+                    num_latents=len(batch.file_items) if batch.latents is not None else 0,
+                    is_optimizer_step=not self.is_grad_accumulation_step
+                )
+            else:
+                self.train_metrics.end_step(0, 0, 0, not self.is_grad_accumulation_step)
             if not did_first_flush:
                 flush()
                 did_first_flush = True
@@ -1722,6 +1839,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                 prog_bar_string = f"lr: {learning_rate:.1e}"
                 for key, value in loss_dict.items():
                     prog_bar_string += f" {key}: {value:.3e}"
+                if self.host_sync_counter is not None:
+                    prog_bar_string += f" syncs: {self.host_sync_counter.count}"
 
                 self.progress_bar.set_postfix_str(prog_bar_string)
 
@@ -1738,7 +1857,8 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         # print above the progress bar
                         if self.train_config.free_u:
                             self.sd.pipeline.disable_freeu()
-                        self.sample(self.step_num)
+                        with self.train_metrics.phase('sample'):
+                            self.sample(self.step_num)
                         self.ensure_params_requires_grad()
                         self.progress_bar.unpause()
 
@@ -1746,24 +1866,43 @@ class BaseSDTrainProcess(BaseTrainProcess):
                         # print above the progress bar
                         self.progress_bar.pause()
                         self.print(f"Saving at step {self.step_num}")
-                        self.save(self.step_num)
+                        with self.train_metrics.phase('save'):
+                            self.save(self.step_num)
                         self.ensure_params_requires_grad()
                         self.progress_bar.unpause()
 
                     if self.logging_config.log_every and self.step_num % self.logging_config.log_every == 0:
                         self.progress_bar.pause()
+                        # log the mean over all ranks
+                        loss_dict = all_reduce_mean_dict(loss_dict)
                         with self.timer('log_to_tensorboard'):
                             # log to tensorboard
                             if self.writer is not None:
                                 for key, value in loss_dict.items():
                                     self.writer.add_scalar(f"{key}", value, self.step_num)
                                 self.writer.add_scalar(f"lr", learning_rate, self.step_num)
+                            self.train_metrics.log(self.step_num, self.writer)
                             self.progress_bar.unpause()
 
-                    if self.performance_log_every > 0 and self.step_num % self.performance_log_every == 0:
+                    if (
+                            self.performance_log_every > 0
+                            and self.step_num % self.performance_log_every == 0
+                            and is_main_process()
+                    ):
                         self.progress_bar.pause()
                         # print the timers and clear them
                         self.timer.print()
+                        if self.writer is not None:
+                            self.timer.log_to_tensorboard(self.writer, self.step_num)
+                        if self.performance_log_dir is not None:
+                            os.makedirs(self.performance_log_dir, exist_ok=True)
+                            step_str = str(self.step_num).zfill(9)
+                            self.timer.save_json(
+                                os.path.join(self.performance_log_dir, f"timer_{step_str}.json"), self.step_num
+                            )
+                            self.timer.save_chrome_trace(
+                                os.path.join(self.performance_log_dir, f"trace_{step_str}.json")
+                            )
                         self.timer.reset()
                         self.progress_bar.unpause()
 
@@ -1790,6 +1929,9 @@ class BaseSDTrainProcess(BaseTrainProcess):
             self.sample(self.step_num)
         print("")
         self.save()
+        if self.async_saver is not None:
+            self.async_saver.wait()
+        cleanup_distributed()
 
         del (
             self.sd,
@@ -8,6 +8,7 @@ import torch
 import yaml
 
 from jobs.process.BaseProcess import BaseProcess
+from toolkit.distributed import is_main_process
 
 if TYPE_CHECKING:
     from jobs import TrainJob, BaseJob, ExtensionJob
@@ -64,7 +65,7 @@ class BaseTrainProcess(BaseProcess):
             print(*args)
 
     def setup_tensorboard(self):
-        if self.log_dir:
+        if self.log_dir and is_main_process():
             from torch.utils.tensorboard import SummaryWriter
             now = datetime.now()
             time_str = now.strftime('%Y%m%d-%H%M%S')
@@ -74,6 +75,8 @@ class BaseTrainProcess(BaseProcess):
 
     def save_training_config(self):
         os.makedirs(self.save_root, exist_ok=True)
+        if not is_main_process():
+            return
         save_dif = os.path.join(self.save_root, f'config.yaml')
         with open(save_dif, 'w') as f:
             yaml.dump(self.job.raw_config, f)
@@ -44,6 +44,17 @@ class ExtractLoconProcess(BaseExtractProcess):
         super().run()
         print(f"Running process: {self.mode}, lin: {self.linear_param}, conv: {self.conv_param}")
 
+        if self.job.stream:
+            self.extract_streaming(
+                mode=self.mode,
+                linear_mode_param=self.linear_param,
+                conv_mode_param=self.conv_param,
+                use_bias=self.use_sparse_bias,
+                sparsity=self.sparsity,
+                small_conv=not self.disable_cp,
+            )
+            return
+
         state_dict, extract_diff_meta = extract_diff(
             self.job.model_base,
             self.job.model_extract,
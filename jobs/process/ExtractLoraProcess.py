@@ -49,6 +49,18 @@ class ExtractLoraProcess(BaseExtractProcess):
         super().run()
         print(f"Running process: {self.mode}, dim: {self.dim}")
 
+        if self.job.stream:
+            self.extract_streaming(
+                mode=self.mode,
+                linear_mode_param=self.linear_param,
+                conv_mode_param=self.conv_param,
+                use_bias=self.use_sparse_bias,
+                sparsity=self.sparsity,
+                small_conv=False,
+                linear_only=self.conv_param > 0.0000000001,
+            )
+            return
+
         state_dict, extract_diff_meta = extract_diff(
             self.job.model_base,
             self.job.model_extract,
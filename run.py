@@ -61,8 +61,25 @@ def main():
         default=None,
         help='Name to replace [name] tag in config file, useful for shared config file'
     )
+    # launch several processes for data parallel training
+    parser.add_argument(
+        '-p', '--num_processes',
+        type=int,
+        default=1,
+        help='Number of processes to launch on this machine for data parallel training, one per gpu. Needs train.distributed in the config'
+    )
     args = parser.parse_args()
 
+    if args.num_processes > 1 and 'WORLD_SIZE' not in os.environ:
+        # start this script again once per process with torchrun, they get WORLD_SIZE and join up
+        from torch.distributed.run import main as torchrun
+        torchrun([
+            '--standalone',
+            f'--nproc_per_node={args.num_processes}',
+            os.path.abspath(__file__),
+        ] + sys.argv[1:])
+        return
+
     config_file_list = args.config_file_list
     if len(config_file_list) == 0:
         raise Exception("You must provide at least one config file")
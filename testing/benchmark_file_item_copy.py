@@ -0,0 +1,55 @@
+import argparse
+import copy
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_loader import AiToolkitDataset
+
+# Per item overhead of handing a file item to __getitem__, before (deepcopy) and after (sample view).
+# Builds a small synthetic dataset so it runs anywhere.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_images', type=int, default=64)
+parser.add_argument('--iterations', type=int, default=20000)
+args = parser.parse_args()
+
+
+def time_per_item(fn, file_list, iterations):
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(file_list[i % len(file_list)])
+    return (time.perf_counter() - start) / iterations
+
+
+with tempfile.TemporaryDirectory() as dataset_folder:
+    rng = np.random.default_rng(0)
+    for i in range(args.num_images):
+        width, height = [(768, 512), (512, 768), (640, 640)][i % 3]
+        img = Image.fromarray(rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+        img.save(os.path.join(dataset_folder, f'img_{i:05d}.jpg'))
+        with open(os.path.join(dataset_folder, f'img_{i:05d}.txt'), 'w') as f:
+            f.write('a photo, of a thing, benchmark')
+
+    dataset_config = DatasetConfig(
+        dataset_path=dataset_folder,
+        resolution=512,
+        caption_ext='txt',
+        buckets=True,
+        augmentations=[{'method': 'ColorJitter', 'params': {'p': 0.5}}],
+    )
+    dataset = AiToolkitDataset(dataset_config, batch_size=1)
+
+    deepcopy_time = time_per_item(copy.deepcopy, dataset.file_list, args.iterations)
+    view_time = time_per_item(lambda x: x.get_sample_view(), dataset.file_list, args.iterations)
+
+    print(f"deepcopy:    {deepcopy_time * 1e6:10.2f} us per item")
+    print(f"sample view: {view_time * 1e6:10.2f} us per item")
+    print(f"speedup:     {deepcopy_time / view_time:10.1f}x")
@@ -0,0 +1,511 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from toolkit.config_modules import DatasetConfig
+from toolkit.data_loader import AiToolkitDataset, get_dataloader_from_datasets
+from toolkit.data_transfer_object.data_loader import DataLoaderBatchDTO
+
+# Times the hot paths of the toolkit on tiny randomly initialized models and a synthetic dataset, so it runs
+# on a cpu only box in a few minutes. Results are written as json, pass an earlier result with --compare to
+# see the change.
+#
+# python testing/benchmark_suite.py --output before.json
+# python testing/benchmark_suite.py --output after.json --compare before.json
+#
+# Benchmarks that need something that is not installed are recorded as skipped along with the reason.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_images', type=int, default=64, help='images in the synthetic dataset')
+parser.add_argument('--aspects', type=str, default='1:1,3:2,2:3,16:9', help='aspect ratios, cycled through')
+parser.add_argument('--image_size', type=int, default=96, help='short side of the synthetic images')
+parser.add_argument('--resolution', type=int, default=64, help='training resolution')
+parser.add_argument('--batch_size', type=int, default=4)
+parser.add_argument('--repeats', type=int, default=5, help='timed runs of each benchmark')
+parser.add_argument('--train_steps', type=int, default=10, help='timed steps of the train step benchmark')
+parser.add_argument('--num_workers', type=int, default=2, help='dataloader workers for the epoch benchmark')
+parser.add_argument('--only', type=str, default=None, help='comma separated benchmarks to run')
+parser.add_argument('--skip', type=str, default=None, help='comma separated benchmarks to skip')
+parser.add_argument('--output', type=str, default=None, help='json file to write the results to')
+parser.add_argument('--compare', type=str, default=None, help='json results of an earlier run to compare to')
+args = parser.parse_args()
+
+BENCHMARKS = OrderedDict()
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+def benchmark(name):
+    # a benchmark takes the context and returns a list of timings in seconds
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return decorator
+
+
+def time_calls(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def parse_aspects(aspects: str):
+    parsed = []
+    for aspect in aspects.split(','):
+        width, height = aspect.split(':')
+        parsed.append((float(width), float(height)))
+    return parsed
+
+
+def make_dataset(folder, num_images, aspects, short_side):
+    rng = np.random.default_rng(0)
+    for i in range(num_images):
+        aspect_w, aspect_h = aspects[i % len(aspects)]
+        scale = short_side / min(aspect_w, aspect_h)
+        width, height = int(aspect_w * scale), int(aspect_h * scale)
+        img = Image.fromarray(rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+        img.save(os.path.join(folder, f'img_{i:05d}.jpg'))
+        with open(os.path.join(folder, f'img_{i:05d}.txt'), 'w') as f:
+            f.write(f'a photo, of a thing, benchmark {i}')
+
+
+def make_tokenizer(folder):
+    # character level clip tokenizer, no download needed
+    from transformers import CLIPTokenizer
+    vocab = OrderedDict()
+    vocab['<|startoftext|>'] = 0
+    vocab['<|endoftext|>'] = 1
+    for c in 'abcdefghijklmnopqrstuvwxyz0123456789,.!?\'"-':
+        vocab[c] = len(vocab)
+        vocab[c + '</w>'] = len(vocab)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'vocab.json'), 'w') as f:
+        json.dump(vocab, f)
+    with open(os.path.join(folder, 'merges.txt'), 'w') as f:
+        f.write('#version: 0.2\n')
+    tokenizer = CLIPTokenizer(
+        os.path.join(folder, 'vocab.json'),
+        os.path.join(folder, 'merges.txt'),
+        model_max_length=77,
+    )
+    return tokenizer
+
+
+def make_tiny_models(seed=0):
+    from diffusers import AutoencoderKL, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel
+    torch.manual_seed(seed)
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        vocab_size=100,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        max_position_embeddings=77,
+        projection_dim=32,
+    ))
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        down_block_types=('DownEncoderBlock2D', 'DownEncoderBlock2D'),
+        up_block_types=('UpDecoderBlock2D', 'UpDecoderBlock2D'),
+        block_out_channels=(32, 64),
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=64,
+    )
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=('CrossAttnDownBlock2D', 'DownBlock2D'),
+        up_block_types=('UpBlock2D', 'CrossAttnUpBlock2D'),
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        cross_attention_dim=32,
+        attention_head_dim=8,
+        norm_num_groups=8,
+    )
+    return text_encoder, vae, unet
+
+
+def make_tiny_pipeline(folder):
+    # saved as an sd 1 diffusers folder, so it loads like any other model
+    from diffusers import DDPMScheduler, StableDiffusionPipeline
+    text_encoder, vae, unet = make_tiny_models()
+    pipe = StableDiffusionPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=make_tokenizer(os.path.join(folder, 'tokenizer_src')),
+        unet=unet,
+        scheduler=DDPMScheduler(num_train_timesteps=1000),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+    pipe.save_pretrained(folder, safe_serialization=True)
+    shutil.rmtree(os.path.join(folder, 'tokenizer_src'))
+
+
+class Context:
+    def __init__(self, root):
+        self.root = root
+        self.dataset_folder = os.path.join(root, 'dataset')
+        self.model_folder = os.path.join(root, 'model')
+        self.aspects = parse_aspects(args.aspects)
+        os.makedirs(self.dataset_folder)
+        make_dataset(self.dataset_folder, args.num_images, self.aspects, args.image_size)
+        self._sd = None
+
+    def get_dataset_config(self, **kwargs):
+        return DatasetConfig(
+            dataset_path=self.dataset_folder,
+            resolution=args.resolution,
+            caption_ext='txt',
+            buckets=True,
+            num_workers=args.num_workers,
+            **kwargs
+        )
+
+    def clear_dataset_cache(self):
+        for file in os.listdir(self.dataset_folder):
+            path = os.path.join(self.dataset_folder, file)
+            if file.startswith('.aitk_'):
+                os.remove(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+
+    def get_model_folder(self):
+        if not os.path.exists(self.model_folder):
+            make_tiny_pipeline(self.model_folder)
+        return self.model_folder
+
+    def get_sd(self):
+        if self._sd is None:
+            try:
+                from toolkit.stable_diffusion_model import StableDiffusion
+                from toolkit.config_modules import ModelConfig
+            except ImportError as e:
+                raise SkipBenchmark(f"StableDiffusion could not be imported: {e}")
+            from diffusers import DDPMScheduler
+            model_config = ModelConfig(name_or_path=self.get_model_folder(), dtype='fp32')
+            sd = StableDiffusion(
+                device='cpu',
+                model_config=model_config,
+                dtype='fp32',
+                noise_scheduler=DDPMScheduler(num_train_timesteps=1000),
+            )
+            sd.load_model()
+            self._sd = sd
+        return self._sd
+
+
+@benchmark('dataset_init_cold')
+def bench_dataset_init_cold(ctx: Context):
+    # size probing and caption reading with no index files yet
+    def run():
+        ctx.clear_dataset_cache()
+        AiToolkitDataset(ctx.get_dataset_config(), batch_size=args.batch_size)
+
+    return time_calls(run, args.repeats)
+
+
+@benchmark('dataset_init_warm')
+def bench_dataset_init_warm(ctx: Context):
+    ctx.clear_dataset_cache()
+    return time_calls(lambda: AiToolkitDataset(ctx.get_dataset_config(), batch_size=args.batch_size), args.repeats)
+
+
+@benchmark('setup_buckets')
+def bench_setup_buckets(ctx: Context):
+    dataset = AiToolkitDataset(ctx.get_dataset_config(), batch_size=args.batch_size)
+
+    def run():
+        # buckets are only built on the first epoch
+        dataset.epoch_num = 0
+        dataset.setup_buckets(quiet=True)
+
+    return time_calls(run, args.repeats)
+
+
+@benchmark('getitem')
+def bench_getitem(ctx: Context):
+    # one bucketed batch
+    dataset = AiToolkitDataset(ctx.get_dataset_config(), batch_size=args.batch_size)
+
+    def run():
+        for i in range(len(dataset)):
+            dataset[i]
+
+    times = time_calls(run, args.repeats)
+    return [t / len(dataset) for t in times]
+
+
+@benchmark('collate')
+def bench_collate(ctx: Context):
+    dataset = AiToolkitDataset(ctx.get_dataset_config(), batch_size=args.batch_size)
+    batches = [dataset[i] for i in range(len(dataset))]
+
+    def run():
+        for batch in batches:
+            DataLoaderBatchDTO(file_items=batch)
+
+    times = time_calls(run, args.repeats)
+    return [t / len(batches) for t in times]
+
+
+@benchmark('dataloader_epoch')
+def bench_dataloader_epoch(ctx: Context):
+    dataloader = get_dataloader_from_datasets([ctx.get_dataset_config()], batch_size=args.batch_size)
+
+    def run():
+        for batch in dataloader:
+            batch.cleanup()
+
+    return time_calls(run, args.repeats)
+
+
+@benchmark('latent_caching')
+def bench_latent_caching(ctx: Context):
+    sd = ctx.get_sd()
+
+    def run():
+        ctx.clear_dataset_cache()
+        AiToolkitDataset(ctx.get_dataset_config(cache_latents_to_disk=True), batch_size=args.batch_size, sd=sd)
+
+    times = time_calls(run, args.repeats)
+    ctx.clear_dataset_cache()
+    return [t / args.num_images for t in times]
+
+
+@benchmark('encode_prompt')
+def bench_encode_prompt(ctx: Context):
+    sd = ctx.get_sd()
+    prompts = [f'a photo, of a thing, benchmark {i}' for i in range(args.batch_size)]
+
+    def run():
+        with torch.no_grad():
+            sd.encode_prompt(prompts)
+
+    return time_calls(run, args.repeats)
+
+
+@benchmark('train_step')
+def bench_train_step(ctx: Context):
+    # full hook_train_loop steps of an sd_trainer lora job, from the trainers own timer
+    try:
+        from toolkit.job import get_job
+        from jobs.process import BaseSDTrainProcess
+    except ImportError as e:
+        raise SkipBenchmark(f"trainer could not be imported: {e}")
+    ctx.clear_dataset_cache()
+    warmup = 2
+    config = OrderedDict([
+        ('job', 'extension'),
+        ('config', OrderedDict([
+            ('name', 'benchmark_train_step'),
+            ('process', [OrderedDict([
+                ('type', 'sd_trainer'),
+                ('training_folder', os.path.join(ctx.root, 'output')),
+                ('device', 'cpu'),
+                ('network', {'type': 'lora', 'linear': 4, 'linear_alpha': 4}),
+                ('save', {'dtype': 'float32', 'save_every': 100000}),
+                ('datasets', [{
+                    'folder_path': ctx.dataset_folder,
+                    'caption_ext': 'txt',
+                    'resolution': args.resolution,
+                    'num_workers': args.num_workers,
+                }]),
+                ('train', {
+                    'batch_size': args.batch_size,
+                    'steps': args.train_steps + warmup,
+                    'train_unet': True,
+                    'train_text_encoder': False,
+                    'noise_scheduler': 'ddpm',
+                    'optimizer': 'adamw',
+                    'lr': 1e-4,
+                    'dtype': 'fp32',
+                    'disable_sampling': True,
+                }),
+                ('model', {'name_or_path': ctx.get_model_folder()}),
+                ('sample', {'sampler': 'ddpm', 'sample_every': 100000, 'prompts': []}),
+            ])]),
+        ])),
+        ('meta', {'name': 'benchmark', 'version': '1.0'}),
+    ])
+    job = get_job(config)
+    job.run()
+    process = job.process[0]
+    times = list(process.timer.timers.get('train_loop', []))
+    job.cleanup()
+    if len(times) == 0:
+        raise SkipBenchmark("the trainer did not record any steps")
+    return times[warmup:] if len(times) > warmup else times
+
+
+@benchmark('lora_save_load')
+def bench_lora_save_load(ctx: Context):
+    try:
+        from toolkit.lora_special import LoRASpecialNetwork
+        from toolkit.config_modules import NetworkConfig
+    except ImportError as e:
+        raise SkipBenchmark(f"LoRASpecialNetwork could not be imported: {e}")
+    text_encoder, vae, unet = make_tiny_models()
+    network = LoRASpecialNetwork(
+        text_encoder=text_encoder,
+        unet=unet,
+        lora_dim=4,
+        multiplier=1.0,
+        alpha=4,
+        train_unet=True,
+        train_text_encoder=True,
+        network_config=NetworkConfig(type='lora', linear=4, linear_alpha=4),
+        network_type='lora',
+    )
+    network.apply_to(text_encoder, unet, True, True)
+    path = os.path.join(ctx.root, 'benchmark_lora.safetensors')
+
+    def run():
+        network.save_weights(path, dtype=torch.float32, metadata={})
+        network.load_weights(path)
+
+    return time_calls(run, args.repeats)
+
+
+@benchmark('extract_diff')
+def bench_extract_diff(ctx: Context):
+    from toolkit.lycoris_utils import extract_diff
+    base_text_encoder, base_vae, base_unet = make_tiny_models(seed=0)
+    tuned_text_encoder, tuned_vae, tuned_unet = make_tiny_models(seed=0)
+    torch.manual_seed(1)
+    with torch.no_grad():
+        for model in [tuned_text_encoder, tuned_unet]:
+            for param in model.parameters():
+                param.add_(torch.randn_like(param) * 0.01)
+
+    def run():
+        extract_diff(
+            (base_text_encoder, base_vae, base_unet),
+            (tuned_text_encoder, tuned_vae, tuned_unet),
+            'fixed',
+            4,
+            4,
+            'cpu',
+            False,
+            0.98,
+            False,
+        )
+
+    return time_calls(run, args.repeats)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(times):
+    values = np.array(times)
+    return OrderedDict([
+        ('status', 'ok'),
+        ('median', float(np.median(values))),
+        ('mean', float(values.mean())),
+        ('min', float(values.min())),
+        ('max', float(values.max())),
+        ('times', [float(t) for t in times]),
+    ])
+
+
+def print_results(results, baseline=None):
+    print('')
+    for name, result in results.items():
+        if result['status'] != 'ok':
+            print(f" - {name:20s} {result['status']}: {result['reason']}")
+            continue
+        line = f" - {name:20s} {result['median'] * 1000:10.3f} ms median, {result['min'] * 1000:10.3f} ms min"
+        if baseline is not None:
+            base = baseline.get(name)
+            if base is not None and base['status'] == 'ok' and result['median'] > 0:
+                line += f", {base['median'] / result['median']:6.2f}x vs baseline"
+        print(line)
+    print('')
+
+
+def main():
+    names = list(BENCHMARKS.keys())
+    if args.only is not None:
+        only = args.only.split(',')
+        unknown = [name for name in only if name not in BENCHMARKS]
+        if len(unknown) > 0:
+            raise ValueError(f"unknown benchmarks {unknown}, choose from {names}")
+        names = [name for name in names if name in only]
+    if args.skip is not None:
+        skip = args.skip.split(',')
+        names = [name for name in names if name not in skip]
+
+    torch.manual_seed(0)
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as root:
+        ctx = Context(root)
+        for name in names:
+            print(f"Running {name}")
+            try:
+                results[name] = summarize(BENCHMARKS[name](ctx))
+            except SkipBenchmark as e:
+                results[name] = OrderedDict([('status', 'skipped'), ('reason', str(e))])
+            except Exception as e:
+                traceback.print_exc()
+                results[name] = OrderedDict([('status', 'error'), ('reason', f"{type(e).__name__}: {e}")])
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['benchmarks']
+    print_results(results, baseline)
+
+    if args.output is not None:
+        output = OrderedDict([
+            ('commit', get_git_commit()),
+            ('time', time.time()),
+            ('torch', torch.__version__),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('num_threads', torch.get_num_threads()),
+            ('params', vars(args)),
+            ('benchmarks', results),
+        ])
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f"Saved results to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+
+import torch
+from safetensors.torch import save_file
+
+
+def _write_atomic(filename: str, write_fn: Callable[[str], None]):
+    # write next to the target, flush it to disk, then swap it in so a crash never leaves a partial file
+    tmp_path = f"{filename}.{os.getpid()}.tmp"
+    try:
+        write_fn(tmp_path)
+        with open(tmp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, filename)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(filename)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        # not every platform can fsync a directory
+        pass
+
+
+class AsyncSaver:
+    """
+    Writes checkpoints on a background thread so training can keep going while they are written. Everything
+    handed to it is snapshotted to the cpu first, so training can change the weights right away. Cuda weights
+    passed to save_file and save_tensors are copied through pinned buffers, up to max_pinned_mb, the rest and
+    objects passed to torch_save, like the optimizer state, go to normal memory. The pinned buffers are released
+    once the save is written. At most one save is in flight, starting a new one waits for the last one to finish.
+
+    saver.begin()
+    saver.save_file(state_dict, path, metadata)
+    saver.torch_save(optimizer.state_dict(), optimizer_path)
+    saver.commit(on_done=clean_up)
+    """
+
+    def __init__(self, pin_memory: bool = True, max_pinned_mb: float = 2048):
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.max_pinned_bytes = int(max_pinned_mb * 1024 * 1024)
+        # pinned memory held by the snapshots of the current save
+        self._pinned_bytes = 0
+        self._jobs: List[Callable[[], None]] = []
+        self._has_cuda_copies = False
+        self._thread: Union[threading.Thread, None] = None
+        self._error: Union[BaseException, None] = None
+
+    @property
+    def is_saving(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def begin(self):
+        # backpressure, one save in flight at a time
+        self.wait()
+        self._jobs = []
+        self._has_cuda_copies = False
+
+    def _get_pinned(self, tensor: torch.Tensor) -> Union[torch.Tensor, None]:
+        nbytes = tensor.numel() * tensor.element_size()
+        if self._pinned_bytes + nbytes > self.max_pinned_bytes:
+            return None
+        try:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device='cpu', pin_memory=True)
+        except RuntimeError:
+            # out of page locked memory, use normal memory from here on
+            print("Warning: could not allocate pinned memory for async saving, falling back to normal memory")
+            self.pin_memory = False
+            return None
+        self._pinned_bytes += nbytes
+        return buffer
+
+    def snapshot(self, value, pin: bool = True):
+        if isinstance(value, torch.Tensor):
+            value = value.detach()
+            if value.is_cuda:
+                buffer = self._get_pinned(value) if self.pin_memory and pin else None
+                if buffer is not None:
+                    buffer.copy_(value, non_blocking=True)
+                    self._has_cuda_copies = True
+                    return buffer
+                return value.to('cpu')
+            return value.clone()
+        if isinstance(value, dict):
+            snapshot = OrderedDict() if isinstance(value, OrderedDict) else {}
+            for k, v in value.items():
+                snapshot[k] = self.snapshot(v, pin)
+            return snapshot
+        if isinstance(value, (list, tuple)):
+            return type(value)(self.snapshot(v, pin) for v in value)
+        return value
+
+    def save_file(self, state_dict: Dict[str, torch.Tensor], filename: str, metadata: Union[dict, None] = None):
+        state_dict = self.snapshot(state_dict)
+        self._jobs.append(
+            lambda: _write_atomic(filename, lambda path: save_file(state_dict, path, metadata=metadata))
+        )
+
+    def save_tensors(
+            self,
+            tensors: Iterable[Tuple[str, torch.Tensor]],
+            filename: str,
+            metadata: Union[dict, None] = None
+    ):
+        # like save_file for (key, tensor) pairs made one at a time, each is snapshotted as it comes
+        state_dict = OrderedDict()
+        for key, tensor in tensors:
+            state_dict[key] = self.snapshot(tensor)
+        self._jobs.append(
+            lambda: _write_atomic(filename, lambda path: save_file(state_dict, path, metadata=metadata))
+        )
+
+    def torch_save(self, obj, filename: str):
+        # optimizer state and the like are too big to keep pinned, they are copied to normal memory
+        obj = self.snapshot(obj, pin=False)
+        self._jobs.append(lambda: _write_atomic(filename, lambda path: torch.save(obj, path)))
+
+    def run(self, fn: Callable[[], None]):
+        # anything else that has to happen in order with the writes
+        self._jobs.append(fn)
+
+    def commit(self, on_done: Union[Callable[[], None], None] = None):
+        jobs = self._jobs
+        self._jobs = []
+        copy_done = None
+        if self._has_cuda_copies:
+            # the worker waits for the non blocking copies, not the training thread
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        def worker():
+            try:
+                if copy_done is not None:
+                    copy_done.synchronize()
+                for job in jobs:
+                    job()
+                if on_done is not None:
+                    on_done()
+            except BaseException as e:
+                self._error = e
+            finally:
+                # the jobs hold the snapshots. Dropping them hands the pinned blocks back to the torch host
+                # allocator, which reuses them for the next save or the dataloader
+                jobs.clear()
+                self._pinned_bytes = 0
+
+        self._thread = threading.Thread(target=worker, name='async_saver', daemon=True)
+        self._thread.start()
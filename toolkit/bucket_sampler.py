@@ -0,0 +1,152 @@
+import random
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+from torch.utils.data import Sampler
+
+if TYPE_CHECKING:
+    from toolkit.data_loader import AiToolkitDataset
+
+# (dataset index, file index, epoch state)
+SampleRef = Tuple[int, int, Union[tuple, None]]
+
+partial_batch_modes = ['keep', 'fill', 'drop']
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches across all bucketed datasets of a dataloader. Buckets with the same resolution are merged across
+    datasets so they can share a batch. Each dataset's share of an epoch is scaled by its sample_weight, and
+    the last partial batch of a bucket can be kept, filled with other images from the bucket, or dropped.
+    Only datasets that are batched the same way are merged: they have to agree on being regularization
+    datasets, on cached latents, clip vision embeddings and text embeddings, on having mask, control,
+    unconditional and clip images, and on the number of extra values.
+
+    Yields lists of (dataset index, file index, epoch state) for BucketConcatDataset. The layout is rebuilt
+    on every iteration so bucket changes from setup_epoch are picked up. The epoch state carries the per file
+    values setup_epoch changed, so persistent workers holding an older copy of the dataset load the file
+    the way the current layout expects.
+
+    For data parallel training every rank builds the same layout from a shared seed and takes every
+    num_replicas-th batch, the layout is cut to a multiple of num_replicas so all ranks step together.
+    """
+
+    def __init__(
+            self,
+            datasets: List['AiToolkitDataset'],
+            batch_size: int,
+            partial_batches: str = 'keep',
+            num_replicas: int = 1,
+            rank: int = 0,
+            seed: int = 0,
+    ):
+        if partial_batches not in partial_batch_modes:
+            raise ValueError(f"partial_batches must be one of {partial_batch_modes}, got {partial_batches}")
+        self.datasets = datasets
+        self.batch_size = batch_size
+        self.partial_batches = partial_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        # layouts built so far, seeds the shuffle of the next one when sharded
+        self.num_layouts = 0
+        # layout made for __len__, reused by the next __iter__ if the datasets did not change epoch
+        self._batches: Union[List[List[SampleRef]], None] = None
+        self._batches_epoch: Union[tuple, None] = None
+
+    def _get_epoch(self) -> tuple:
+        return tuple(dataset.epoch_num for dataset in self.datasets)
+
+    def _get_batch_group(self, dataset: 'AiToolkitDataset') -> tuple:
+        # datasets have to match on everything that the batch and training step treat per batch. Batch tensors
+        # are zero filled for items without one, so a dataset without masks must never share a batch with one
+        # that has them, its images would get an all zero mask
+        dataset_config = dataset.dataset_config
+        return (
+            dataset_config.is_reg,
+            dataset.is_caching_latents,
+            dataset.is_caching_clip_vision_to_disk,
+            dataset.is_text_embedding_cached,
+            dataset_config.mask_path is not None or dataset_config.alpha_mask,
+            dataset_config.control_path is not None,
+            dataset_config.unconditional_path is not None,
+            dataset_config.clip_image_path is not None,
+            len(dataset_config.extra_values),
+        )
+
+    def _get_random(self):
+        if self.num_replicas <= 1:
+            return random
+        # the same on every rank
+        return random.Random(self.seed + self.num_layouts)
+
+    def get_merged_buckets(self, rng=random) -> Dict[tuple, List[SampleRef]]:
+        merged: Dict[tuple, List[SampleRef]] = OrderedDict()
+        for dataset_idx, dataset in enumerate(self.datasets):
+            group = self._get_batch_group(dataset)
+            weight = dataset.dataset_config.sample_weight
+            for bucket_key, bucket in dataset.buckets.items():
+                file_list_idx = bucket.file_list_idx
+                if self.num_replicas > 1:
+                    # buckets are shuffled differently on every rank
+                    file_list_idx = sorted(file_list_idx)
+                if len(file_list_idx) == 0:
+                    continue
+                # whole copies for the integer part of the weight, a random subset for the rest
+                num_samples = int(round(len(file_list_idx) * weight))
+                samples = file_list_idx * (num_samples // len(file_list_idx))
+                samples = samples + rng.sample(file_list_idx, num_samples % len(file_list_idx))
+                merged.setdefault(group + (bucket_key,), []).extend(
+                    [(dataset_idx, idx, dataset.get_item_epoch_state(idx)) for idx in samples]
+                )
+        return merged
+
+    def build_batches(self) -> List[List[SampleRef]]:
+        rng = self._get_random()
+        self.num_layouts += 1
+        batches: List[List[SampleRef]] = []
+        for key, samples in self.get_merged_buckets(rng).items():
+            if len(samples) == 0:
+                continue
+            rng.shuffle(samples)
+            num_full = len(samples) // self.batch_size
+            for i in range(num_full):
+                batches.append(samples[i * self.batch_size:(i + 1) * self.batch_size])
+            remainder = samples[num_full * self.batch_size:]
+            if len(remainder) == 0 or self.partial_batches == 'drop':
+                continue
+            if self.partial_batches == 'fill':
+                num_missing = self.batch_size - len(remainder)
+                # prefer images that are not already in this batch
+                pool = samples[:num_full * self.batch_size]
+                if len(pool) >= num_missing:
+                    remainder = remainder + rng.sample(pool, num_missing)
+                else:
+                    remainder = remainder + rng.choices(samples, k=num_missing)
+            batches.append(remainder)
+        rng.shuffle(batches)
+        if self.num_replicas > 1:
+            num_batches = len(batches) // self.num_replicas * self.num_replicas
+            if num_batches == 0:
+                raise ValueError(
+                    f"Only {len(batches)} batches for {self.num_replicas} processes, every process needs at least one"
+                )
+            batches = batches[self.rank:num_batches:self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        epoch = self._get_epoch()
+        if self._batches is None or self._batches_epoch != epoch:
+            self._batches = self.build_batches()
+        batches = self._batches
+        # the next iteration gets a new shuffle
+        self._batches = None
+        self._batches_epoch = None
+        yield from batches
+
+    def __len__(self):
+        epoch = self._get_epoch()
+        if self._batches is None or self._batches_epoch != epoch:
+            self._batches = self.build_batches()
+            self._batches_epoch = epoch
+        return len(self._batches)
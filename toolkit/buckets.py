@@ -1,4 +1,7 @@
-from typing import Type, List, Union, TypedDict
+from functools import lru_cache
+from typing import Type, List, Union, TypedDict, Tuple
+
+import numpy as np
 
 
 class BucketResolution(TypedDict):
@@ -119,6 +122,21 @@ def get_bucket_sizes(resolution: int = 512, divisibility: int = 8) -> List[Bucke
     return bucket_size_list
 
 
+@lru_cache(maxsize=None)
+def get_cached_bucket_sizes(resolution: int = 512, divisibility: int = 8) -> Tuple[BucketResolution, ...]:
+    # shared between calls, do not modify the returned buckets
+    return tuple(get_bucket_sizes(resolution=resolution, divisibility=divisibility))
+
+
+@lru_cache(maxsize=None)
+def get_bucket_size_array(resolution: int = 512, divisibility: int = 8) -> np.ndarray:
+    # (num_buckets, 2) array of width, height. Cached since every image at a resolution shares it
+    bucket_sizes = get_bucket_sizes(resolution=resolution, divisibility=divisibility)
+    bucket_array = np.array([[b["width"], b["height"]] for b in bucket_sizes], dtype=np.int64)
+    bucket_array.setflags(write=False)
+    return bucket_array
+
+
 def get_resolution(width, height):
     num_pixels = width * height
     # determine same number of pixels for square image
@@ -141,7 +159,7 @@ def get_bucket_for_image_size(
         # if real resolution is smaller, use that instead
         real_resolution = get_resolution(width, height)
         resolution = min(resolution, real_resolution)
-        bucket_size_list = get_bucket_sizes(resolution=resolution, divisibility=divisibility)
+        bucket_size_list = get_cached_bucket_sizes(resolution=resolution, divisibility=divisibility)
 
     # Check for exact match first
     for bucket in bucket_size_list:
@@ -172,3 +190,68 @@ def get_bucket_for_image_size(
         raise ValueError("No suitable bucket found")
 
     return closest_bucket
+
+
+def get_buckets_for_image_sizes(
+        widths: np.ndarray,
+        heights: np.ndarray,
+        resolution: int,
+        divisibility: int = 8,
+        chunk_size: int = 4096
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized get_bucket_for_image_size for many images at once. Gives the same buckets, including the
+    tie breaking on the first closest bucket. Returns arrays of bucket widths and heights.
+    """
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    bucket_widths = np.zeros_like(widths)
+    bucket_heights = np.zeros_like(heights)
+    if len(widths) == 0:
+        return bucket_widths, bucket_heights
+
+    # if real resolution is smaller, use that instead
+    real_resolutions = np.power((widths * heights).astype(np.float64), 0.5).astype(np.int64)
+    image_resolutions = np.minimum(resolution, real_resolutions)
+
+    # group rows by resolution with one sort instead of a scan per resolution
+    order = np.argsort(image_resolutions, kind='stable')
+    unique_resolutions, group_starts, group_counts = np.unique(
+        image_resolutions[order], return_index=True, return_counts=True
+    )
+    for image_resolution, group_start, group_count in zip(unique_resolutions, group_starts, group_counts):
+        bucket_array = get_bucket_size_array(resolution=int(image_resolution), divisibility=divisibility)
+        # float math is exact here, pixel counts are far below 2 ** 53
+        bw = bucket_array[:, 0][None, :].astype(np.float64)
+        bh = bucket_array[:, 1][None, :].astype(np.float64)
+        rows = order[group_start:group_start + group_count]
+        # small chunks keep the (images, buckets) matrices in cache
+        for start_idx in range(0, len(rows), chunk_size):
+            chunk = rows[start_idx:start_idx + chunk_size]
+            w = widths[chunk][:, None].astype(np.float64)
+            h = heights[chunk][:, None].astype(np.float64)
+
+            # To minimize pixels, we use the larger scale factor to minimize the amount that has to be cropped.
+            scale = np.maximum(bw / w, bh / h)
+            new_width = np.trunc(w * scale)
+            new_height = np.trunc(h * scale)
+            removed_pixels = (new_width - bw) * new_height + (new_height - bh) * new_width
+            # argmin returns the first minimum, same as the strict < in the loop version
+            best = np.argmin(removed_pixels, axis=1)
+            bucket_widths[chunk] = bucket_array[best, 0]
+            bucket_heights[chunk] = bucket_array[best, 1]
+
+        # exact matches always win
+        bucket_keys = bucket_array[:, 0] * (1 << 32) + bucket_array[:, 1]
+        image_keys = widths[rows] * (1 << 32) + heights[rows]
+        is_exact = np.isin(image_keys, bucket_keys)
+        if is_exact.any():
+            exact_rows = rows[is_exact]
+            first_match = {}
+            for bucket_idx, key in enumerate(bucket_keys.tolist()):
+                first_match.setdefault(key, bucket_idx)
+            exact_idx = np.array([first_match[k] for k in image_keys[is_exact].tolist()], dtype=np.int64)
+            bucket_widths[exact_rows] = bucket_array[exact_idx, 0]
+            bucket_heights[exact_rows] = bucket_array[exact_idx, 1]
+
+    return bucket_widths, bucket_heights
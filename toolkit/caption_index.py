@@ -0,0 +1,70 @@
+import json
+import os
+from typing import Dict, List, Union
+
+from toolkit.dataloader_mixins import CaptionEntry, read_caption_file
+
+# bump to invalidate every stored caption
+CAPTION_INDEX_VERSION = 1
+
+
+class CaptionIndex:
+    """
+    Parsed caption files for a dataset, read once at dataset load so sampling never touches the filesystem
+    for captions. Optionally persisted to .aitk_captions.json in the dataset folder. Entries are keyed by
+    caption path relative to the dataset folder and hold the file mtime and size so edited captions are
+    read again.
+    """
+
+    def __init__(self, path: str, dataset_root: str, persist: bool = True):
+        self.path = path
+        self.dataset_root = dataset_root
+        self.persist = persist
+        # rel path -> [mtime_ns, file size, caption, short caption, extra values]
+        self.entries: Dict[str, list] = {}
+        self.is_dirty = False
+        if self.persist:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Warning: could not read caption index {self.path}, rebuilding it: {e}")
+            return
+        if isinstance(data, dict) and data.get('__version__') == CAPTION_INDEX_VERSION:
+            self.entries = data.get('files', {})
+
+    def save(self):
+        if not self.persist or not self.is_dirty:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'__version__': CAPTION_INDEX_VERSION, 'files': self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.is_dirty = False
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(path, self.dataset_root).replace(os.sep, '/')
+
+    def get_captions(self, caption_paths: List[str]) -> Dict[str, Union[CaptionEntry, None]]:
+        # caption path -> parsed caption, or None when there is no caption file
+        captions: Dict[str, Union[CaptionEntry, None]] = {}
+        for caption_path in dict.fromkeys(caption_paths):
+            try:
+                stat = os.stat(caption_path)
+            except OSError:
+                captions[caption_path] = None
+                continue
+            key = self._key(caption_path)
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+                caption, caption_short, extra_values = read_caption_file(caption_path)
+                entry = [stat.st_mtime_ns, stat.st_size, caption, caption_short, extra_values]
+                self.entries[key] = entry
+                self.is_dirty = True
+            captions[caption_path] = (entry[2], entry[3], entry[4])
+        return captions
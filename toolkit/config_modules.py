@@ -23,12 +23,21 @@ class SaveConfig:
         self.save_format: SaveFormat = kwargs.get('save_format', 'safetensors')
         if self.save_format not in ['safetensors', 'diffusers']:
             raise ValueError(f"save_format must be safetensors or diffusers, got {self.save_format}")
+        # snapshot checkpoints to cpu and write them on a background thread while training continues
+        self.async_save: bool = kwargs.get('async_save', False)
+        # page locked memory the async save may use to copy weights off the gpu, freed after each save
+        self.async_save_max_pinned_mb: float = kwargs.get('async_save_max_pinned_mb', 2048)
 
 
 class LogingConfig:
     def __init__(self, **kwargs):
         self.log_every: int = kwargs.get('log_every', 100)
         self.verbose: bool = kwargs.get('verbose', False)
+        # log throughput and memory every log_every steps to tensorboard and metrics.jsonl in the save folder
+        self.log_metrics: bool = kwargs.get('log_metrics', True)
+        # reset the process wide host and cuda peak memory stats between train, sample and save to log a peak for
+        # each. Off by default, it clears the peaks for anything else in the process that reads them
+        self.reset_memory_peaks: bool = kwargs.get('reset_memory_peaks', False)
         self.use_wandb: bool = kwargs.get('use_wandb', False)
 
 
@@ -129,6 +138,8 @@ class NetworkConfig:
                 self.conv = 4
 
         self.transformer_only = kwargs.get('transformer_only', True)
+        # run the down projections of linear loras fed the same input (to_q, to_k, to_v) as one matmul
+        self.fuse_shared_inputs: bool = kwargs.get('fuse_shared_inputs', False)
 
 
 AdapterTypes = Literal['t2i', 'ip', 'ip+', 'clip', 'ilora', 'photo_maker', 'control_net']
@@ -239,6 +250,8 @@ class TrainConfig:
         self.sdp = kwargs.get('sdp', False)
         self.train_unet = kwargs.get('train_unet', True)
         self.train_text_encoder = kwargs.get('train_text_encoder', False)
+        # move the text encoders off the gpu when every dataset has cached text embeddings. Sampling moves them back
+        self.unload_text_encoder = kwargs.get('unload_text_encoder', False)
         self.train_refiner = kwargs.get('train_refiner', True)
         self.train_turbo = kwargs.get('train_turbo', False)
         self.show_turbo_outputs = kwargs.get('show_turbo_outputs', False)
@@ -358,6 +371,14 @@ class TrainConfig:
         self.target_norm_std_value = kwargs.get('target_norm_std_value', 1.0)
         self.linear_timesteps = kwargs.get('linear_timesteps', False)
         self.disable_sampling = kwargs.get('disable_sampling', False)
+        # count the device to host syncs of every training step (cuda only) and show them on the progress bar
+        self.debug_host_syncs = kwargs.get('debug_host_syncs', False)
+        # data parallel over the processes started by torchrun or run.py --num_processes
+        self.distributed = kwargs.get('distributed', False)
+        # nccl or gloo, defaults to nccl when cuda is available
+        self.distributed_backend: Union[str, None] = kwargs.get('distributed_backend', None)
+        # how long ranks wait for each other, the main process samples and saves while the others wait
+        self.distributed_timeout: float = kwargs.get('distributed_timeout', 60)
 
 
 class ModelConfig:
@@ -414,6 +435,12 @@ class ModelConfig:
         # only for flux for now
         self.quantize = kwargs.get("quantize", False)
         self.low_vram = kwargs.get("low_vram", False)
+
+        # single file checkpoints are converted to diffusers format once and loaded from the cache after that.
+        # the checkpoint is hashed and a full diffusers copy of it is written to the cache
+        self.use_converted_cache = kwargs.get("use_converted_cache", False)
+        self.converted_cache_dir = kwargs.get("converted_cache_dir", None)  # defaults to ~/.cache/ai-toolkit
+        self.converted_cache_max_gb = kwargs.get("converted_cache_max_gb", 32)
         pass
 
 
@@ -529,6 +556,9 @@ class DatasetConfig:
         self.bucket_tolerance: int = kwargs.get('bucket_tolerance', 64)
         self.is_reg: bool = kwargs.get('is_reg', False)
         self.network_weight: float = float(kwargs.get('network_weight', 1.0))
+        # relative share of an epoch for this dataset when buckets are batched across datasets. 2.0 samples
+        # every image twice per epoch, 0.5 samples a random half
+        self.sample_weight: float = float(kwargs.get('sample_weight', 1.0))
         self.token_dropout_rate: float = float(kwargs.get('token_dropout_rate', 0.0))
         self.shuffle_tokens: bool = kwargs.get('shuffle_tokens', False)
         self.caption_dropout_rate: float = float(kwargs.get('caption_dropout_rate', 0.0))
@@ -549,11 +579,23 @@ class DatasetConfig:
         self.poi: Union[str, None] = kwargs.get('poi',
                                                 None)  # if one is set and in json data, will be used as auto crop scale point of interes
         self.num_repeats: int = kwargs.get('num_repeats', 1)  # number of times to repeat dataset
+        # keep file geometry in numpy columns and build file items per sample. Saves a lot of ram per worker
+        # on very large datasets
+        self.columnar_file_index: bool = kwargs.get('columnar_file_index', False)
         # cache latents will store them in memory
         self.cache_latents: bool = kwargs.get('cache_latents', False)
         # cache latents to disk will store them on disk. If both are true, it will save to disk, but keep in memory
         self.cache_latents_to_disk: bool = kwargs.get('cache_latents_to_disk', False)
         self.cache_clip_vision_to_disk: bool = kwargs.get('cache_clip_vision_to_disk', False)
+        # format of the disk latent cache. safetensors is one file per image, packed is a few large memory mapped
+        # shards with an index. Existing safetensors caches are migrated into the packed store when it is enabled
+        self.latent_cache_format: str = kwargs.get('latent_cache_format', 'safetensors')  # safetensors, packed
+        if self.latent_cache_format not in ['safetensors', 'packed']:
+            raise ValueError(f"latent_cache_format must be safetensors or packed, got {self.latent_cache_format}")
+        # number of images to run through the vae at once when caching latents. Images are grouped by bucket size
+        self.latent_cache_batch_size: int = kwargs.get('latent_cache_batch_size', 1)
+        # threads used to load and resize images while the vae is encoding. 0 loads them in the main thread
+        self.latent_cache_num_workers: int = kwargs.get('latent_cache_num_workers', 0)
 
         self.standardize_images: bool = kwargs.get('standardize_images', False)
 
@@ -583,8 +625,33 @@ class DatasetConfig:
         self.replacements: List[str] = kwargs.get('replacements', [])
         self.loss_multiplier: float = kwargs.get('loss_multiplier', 1.0)
 
+        # keeps decoded and resized images in shared memory for all dataloader workers, up to this many MB.
+        # augmentations and crops still run every step. Useful for small datasets with many repeats. 0 disables
+        self.shared_image_cache_mb: float = kwargs.get('shared_image_cache_mb', 0)
         self.num_workers: int = kwargs.get('num_workers', 2)
         self.prefetch_factor: int = kwargs.get('prefetch_factor', 2)
+        # keep dataloader workers alive between epochs instead of starting them and copying the dataset again
+        self.persistent_workers: bool = kwargs.get('persistent_workers', True)
+        # batch buckets of the same size across all datasets instead of per dataset.
+        # Like num_workers, the first dataset's values are used for the dataloader
+        self.cross_dataset_buckets: bool = kwargs.get('cross_dataset_buckets', True)
+        # what to do with the last partial batch of a bucket: keep, fill (with other images from the bucket), drop
+        self.partial_batches: str = kwargs.get('partial_batches', 'keep')
+        # pin batches in page locked memory so they are copied to the gpu without blocking. Only used with cuda
+        self.pin_memory: bool = kwargs.get('pin_memory', True)
+        # processes used to read image sizes for new or changed files. None uses every cpu
+        self.size_probe_workers: Union[int, None] = kwargs.get('size_probe_workers', None)
+        # captions are read once at load. This also stores them in .aitk_captions.json so the next load only stats them
+        self.persist_caption_index: bool = kwargs.get('persist_caption_index', True)
+        # cache text encoder outputs for every caption to _t_e_cache. Only used by trainers that support it,
+        # when the text encoder is not trained and nothing changes the prompt at train time
+        self.cache_text_embeddings: bool = kwargs.get('cache_text_embeddings', False)
+        # captions with token dropout, shuffling or random triggers cache this many random variants. A random
+        # one is used each step. Caption dropout uses a cached empty caption
+        self.text_embedding_variants: int = kwargs.get('text_embedding_variants', 4)
+        self.text_embedding_cache_batch_size: int = kwargs.get('text_embedding_cache_batch_size', 8)
+        # decode jpegs at a reduced scale when they are much larger than their bucket. Only used with buckets
+        self.reduced_jpeg_decode: bool = kwargs.get('reduced_jpeg_decode', True)
         self.extra_values: List[float] = kwargs.get('extra_values', [])
         self.square_crop: bool = kwargs.get('square_crop', False)
         # apply same augmentations to control images. Usually want this true unless special case
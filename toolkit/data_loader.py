@@ -1,10 +1,9 @@
-import copy
 import json
 import os
 import random
 import traceback
 from functools import lru_cache
-from typing import List, TYPE_CHECKING
+from typing import List, TYPE_CHECKING, Union
 
 import cv2
 import numpy as np
@@ -12,14 +11,22 @@ import torch
 from PIL import Image
 from PIL.ImageOps import exif_transpose
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader, ConcatDataset
+from torch.utils.data import Dataset, DataLoader, ConcatDataset, DistributedSampler
 from tqdm import tqdm
 import albumentations as A
 
 from toolkit.buckets import get_bucket_for_image_size, BucketResolution
 from toolkit.config_modules import DatasetConfig, preprocess_dataset_raw_config
-from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin
+from toolkit.dataloader_mixins import CaptionMixin, BucketsMixin, LatentCachingMixin, Augments, CLIPCachingMixin, \
+    TextEmbeddingCachingMixin
 from toolkit.data_transfer_object.data_loader import FileItemDTO, DataLoaderBatchDTO
+from toolkit.caption_index import CaptionIndex
+from toolkit.file_index import FileIndex
+from toolkit.image_cache import SharedImageCache, can_share as can_share_image_cache
+from toolkit.bucket_sampler import BucketBatchSampler
+from toolkit.size_database import ImageSizeDatabase
+from toolkit.timer import data_timer
+from toolkit.distributed import is_distributed, get_rank, get_world_size, broadcast_object
 
 import platform
 
@@ -366,7 +373,11 @@ class PairedImageDataset(Dataset):
         return img, prompt, (self.neg_weight, self.pos_weight)
 
 
-class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, CaptionMixin, Dataset):
+# file item attributes that can change between epochs, poi crops are redone every epoch
+epoch_state_attrs = ['scale_to_width', 'scale_to_height', 'crop_x', 'crop_y', 'crop_width', 'crop_height']
+
+
+class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, TextEmbeddingCachingMixin, BucketsMixin, CaptionMixin, Dataset):
 
     def __init__(
             self,
@@ -402,6 +413,11 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         self.resolution = dataset_config.resolution
         self.caption_dict = None
         self.file_list: List['FileItemDTO'] = []
+        # repeats are sampled as repeated indices into file_list, not as copies of the file items
+        self.num_repeats = max(1, self.dataset_config.num_repeats)
+        self.file_index: Union[FileIndex, None] = None
+        if self.dataset_config.columnar_file_index and self.is_caching_latents_to_memory:
+            print("  -  columnar_file_index does not support cache_latents in memory. Using the file list")
 
         # check if dataset_path is a folder or json
         if os.path.isdir(self.dataset_path):
@@ -413,10 +429,6 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 # keys are file paths
                 file_list = list(self.caption_dict.keys())
 
-        if self.dataset_config.num_repeats > 1:
-            # repeat the list
-            file_list = file_list * self.dataset_config.num_repeats
-
         if self.dataset_config.standardize_images:
             if self.sd.is_xl or self.sd.is_vega or self.sd.is_ssd:
                 NormalizeMethod = NormalizeSDXLTransform
@@ -440,12 +452,14 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
         dataset_folder = self.dataset_path
         if not os.path.isdir(self.dataset_path):
             dataset_folder = os.path.dirname(dataset_folder)
+        self.dataset_folder = dataset_folder
         dataset_size_file = os.path.join(dataset_folder, '.aitk_size.json')
-        if os.path.exists(dataset_size_file):
-            with open(dataset_size_file, 'r') as f:
-                self.size_database = json.load(f)
-        else:
-            self.size_database = {}
+        self.size_database = ImageSizeDatabase(
+            dataset_size_file,
+            dataset_root=dataset_folder,
+            num_workers=dataset_config.size_probe_workers
+        )
+        image_sizes = self.size_database.get_sizes(file_list)
 
         bad_count = 0
         for file in tqdm(file_list):
@@ -455,7 +469,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                     path=file,
                     dataset_config=dataset_config,
                     dataloader_transforms=self.transform,
-                    size_database=self.size_database,
+                    image_size=image_sizes.get(file, None),
                 )
                 self.file_list.append(file_item)
             except Exception as e:
@@ -465,8 +479,19 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 bad_count += 1
 
         # save the size database
-        with open(dataset_size_file, 'w') as f:
-            json.dump(self.size_database, f)
+        self.size_database.save()
+
+        if self.caption_dict is None:
+            # read every caption once now so sampling is purely in memory
+            self.caption_index = CaptionIndex(
+                os.path.join(dataset_folder, '.aitk_captions.json'),
+                dataset_root=dataset_folder,
+                persist=dataset_config.persist_caption_index
+            )
+            captions = self.caption_index.get_captions([x.get_caption_path() for x in self.file_list])
+            for file_item in self.file_list:
+                file_item.set_raw_caption(captions[file_item.get_caption_path()])
+            self.caption_index.save()
 
         print(f"  -  Found {len(self.file_list)} images")
         # print(f"  -  Found {bad_count} images that are too small")
@@ -478,7 +503,7 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the x axis
-                new_file_item = copy.deepcopy(file_item)
+                new_file_item = file_item.get_sample_view()
                 new_file_item.flip_x = True
                 self.file_list.append(new_file_item)
 
@@ -488,13 +513,29 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             current_file_list = [x for x in self.file_list]
             for file_item in current_file_list:
                 # create a copy that is flipped on the y axis
-                new_file_item = copy.deepcopy(file_item)
+                new_file_item = file_item.get_sample_view()
                 new_file_item.flip_y = True
                 self.file_list.append(new_file_item)
 
         if self.dataset_config.flip_x or self.dataset_config.flip_y:
             print(f"  -  Found {len(self.file_list)} images after adding flips")
 
+        self.image_cache: Union[SharedImageCache, None] = None
+        use_image_cache = self.dataset_config.shared_image_cache_mb > 0 and not self.is_caching_latents \
+            and self.dataset_config.buckets
+        if use_image_cache and not can_share_image_cache():
+            print(f"Warning: shared_image_cache_mb needs the fork start method, not caching decoded images")
+            use_image_cache = False
+        if use_image_cache:
+            print(f"  -  Caching decoded images in {self.dataset_config.shared_image_cache_mb}MB of shared memory")
+            self.image_cache = SharedImageCache(
+                len(self.file_list),
+                max_bytes=int(self.dataset_config.shared_image_cache_mb * 1024 * 1024)
+            )
+            for idx, file_item in enumerate(self.file_list):
+                file_item.image_cache = self.image_cache
+                file_item.image_cache_idx = idx
+
 
         self.setup_epoch()
 
@@ -514,17 +555,54 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
                 # handle cropping to a specific point of interest
                 # setup buckets every epoch
                 self.setup_buckets(quiet=True)
+        if self.dataset_config.columnar_file_index and not self.is_caching_latents_to_memory:
+            if self.file_index is None or self.dataset_config.poi is not None:
+                # poi crops change every epoch
+                self.file_index = FileIndex.from_dataset(self)
+        # spans recorded while setting up, like decodes while caching latents, are not part of any batch
+        data_timer.reset()
         self.epoch_num += 1
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.file_index is not None:
+            # workers only get the columnar index and build file items per sample
+            state['file_list'] = None
+        return state
+
+    def get_num_files(self):
+        if self.file_index is not None:
+            return len(self.file_index)
+        return len(self.file_list)
+
     def __len__(self):
         if self.dataset_config.buckets:
             return len(self.batch_indices)
-        return len(self.file_list)
-
-    def _get_single_item(self, index) -> 'FileItemDTO':
-        file_item = copy.deepcopy(self.file_list[index])
-        file_item.load_and_process_image(self.transform)
+        return self.get_num_files() * self.num_repeats
+
+    def get_item_epoch_state(self, index) -> Union[tuple, None]:
+        # per file state that setup_epoch changes after the first epoch. Persistent workers keep the dataset
+        # they were started with, so the sampler sends this along with the index
+        if self.dataset_config.poi is None:
+            return None
+        file_item = self.file_list[index % len(self.file_list)]
+        return tuple(getattr(file_item, name) for name in epoch_state_attrs)
+
+    def _get_single_item(self, index, epoch_state: Union[tuple, None] = None) -> 'FileItemDTO':
+        index = index % self.get_num_files()
+        if self.file_index is not None:
+            file_item = self.file_index.build_file_item(index, self)
+        else:
+            file_item = self.file_list[index].get_sample_view()
+        if epoch_state is not None:
+            for name, value in zip(epoch_state_attrs, epoch_state):
+                setattr(file_item, name, value)
+        with data_timer('load_image'):
+            file_item.load_and_process_image(self.transform)
         file_item.load_caption(self.caption_dict)
+        if file_item.text_embedding_paths is not None:
+            with data_timer('load_text_embedding'):
+                file_item.load_text_embedding()
         return file_item
 
     def __getitem__(self, item):
@@ -542,6 +620,15 @@ class AiToolkitDataset(LatentCachingMixin, CLIPCachingMixin, BucketsMixin, Capti
             return self._get_single_item(item)
 
 
+class BucketConcatDataset(ConcatDataset):
+    # indexed by a list of (dataset index, file index, epoch state) from BucketBatchSampler, returns the batch
+    def __getitem__(self, idx_list):
+        return [
+            self.datasets[dataset_idx]._get_single_item(idx, epoch_state=epoch_state)
+            for dataset_idx, idx, epoch_state in idx_list
+        ]
+
+
 def get_dataloader_from_datasets(
         dataset_options,
         batch_size=1,
@@ -577,16 +664,32 @@ def get_dataloader_from_datasets(
         else:
             raise ValueError(f"invalid dataset type: {config.type}")
 
-    concatenated_dataset = ConcatDataset(datasets)
+    # data parallel, every rank loads its own share of the batches. The shuffle seed comes from the main process
+    num_replicas = get_world_size() if is_distributed() else 1
+    rank = get_rank() if is_distributed() else 0
+    seed = broadcast_object(random.randint(0, 2 ** 31 - 1)) if num_replicas > 1 else 0
+
+    cross_dataset_buckets = dataset_config_list[0].cross_dataset_buckets
+    if has_buckets and num_replicas > 1 and not cross_dataset_buckets:
+        # per dataset batches are shuffled differently on every rank, only the bucket sampler can shard them
+        print("  -  Data parallel training batches buckets across datasets, ignoring cross_dataset_buckets")
+        cross_dataset_buckets = True
+
+    if has_buckets and cross_dataset_buckets:
+        concatenated_dataset = BucketConcatDataset(datasets)
+    else:
+        concatenated_dataset = ConcatDataset(datasets)
 
-    # todo build scheduler that can get buckets from all datasets that match
-    # todo and evenly distribute reg images
+    # todo evenly distribute reg images
 
     def dto_collation(batch: List['FileItemDTO']):
         # create DTO batch
-        batch = DataLoaderBatchDTO(
-            file_items=batch
-        )
+        with data_timer('collate'):
+            batch = DataLoaderBatchDTO(
+                file_items=batch
+            )
+        # the spans of this batch go to the training process with it
+        batch.timings = data_timer.pop_events()
         return batch
 
     # check if is caching latents
@@ -598,26 +701,60 @@ def get_dataloader_from_datasets(
     else:
         dataloader_kwargs['num_workers'] = dataset_config_list[0].num_workers
         dataloader_kwargs['prefetch_factor'] = dataset_config_list[0].prefetch_factor
+    if dataloader_kwargs['num_workers'] > 0 and dataset_config_list[0].persistent_workers:
+        # workers are kept between epochs. The bucket sampler sends them the new layout every epoch, the per
+        # dataset batching cannot, so poi datasets that rebuild buckets every epoch need new workers then
+        has_poi = any(config.poi is not None for config in dataset_config_list)
+        if not has_poi or (has_buckets and cross_dataset_buckets):
+            dataloader_kwargs['persistent_workers'] = True
+    # batches implement pin_memory, the dataloader calls it from its pin memory thread
+    dataloader_kwargs['pin_memory'] = dataset_config_list[0].pin_memory and torch.cuda.is_available()
+
+    shuffle_kwargs = {'shuffle': True}
+    if num_replicas > 1:
+        shuffle_kwargs = {
+            'sampler': DistributedSampler(
+                concatenated_dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, drop_last=True
+            )
+        }
 
     if has_buckets:
         # make sure they all have buckets
         for dataset in datasets:
             assert dataset.dataset_config.buckets, f"buckets not found on dataset {dataset.dataset_config.folder_path}, you either need all buckets or none"
 
-        data_loader = DataLoader(
-            concatenated_dataset,
-            batch_size=None,  # we batch in the datasets for now
-            drop_last=False,
-            shuffle=True,
-            collate_fn=dto_collation,  # Use the custom collate function
-            **dataloader_kwargs
-        )
+        if isinstance(concatenated_dataset, BucketConcatDataset):
+            data_loader = DataLoader(
+                concatenated_dataset,
+                batch_size=None,  # the sampler yields whole batches
+                sampler=BucketBatchSampler(
+                    datasets,
+                    batch_size=batch_size,
+                    partial_batches=dataset_config_list[0].partial_batches,
+                    num_replicas=num_replicas,
+                    rank=rank,
+                    seed=seed,
+                ),
+                collate_fn=dto_collation,
+                **dataloader_kwargs
+            )
+        else:
+            data_loader = DataLoader(
+                concatenated_dataset,
+                batch_size=None,  # we batch in the datasets for now
+                drop_last=False,
+                collate_fn=dto_collation,  # Use the custom collate function
+                **shuffle_kwargs,
+                **dataloader_kwargs
+            )
     else:
         data_loader = DataLoader(
             concatenated_dataset,
             batch_size=batch_size,
-            shuffle=True,
             collate_fn=dto_collation,
+            # keep every rank at the same number of steps
+            drop_last=num_replicas > 1,
+            **shuffle_kwargs,
             **dataloader_kwargs
         )
     return data_loader
@@ -626,6 +763,9 @@ def get_dataloader_from_datasets(
 def trigger_dataloader_setup_epoch(dataloader: DataLoader):
     # hacky but needed because of different types of datasets and dataloaders
     dataloader.len = None
+    if isinstance(dataloader.sampler, DistributedSampler):
+        # new shuffle for the next epoch, the same on every rank
+        dataloader.sampler.set_epoch(dataloader.sampler.epoch + 1)
     if isinstance(dataloader.dataset, list):
         for dataset in dataloader.dataset:
             if hasattr(dataset, 'datasets'):
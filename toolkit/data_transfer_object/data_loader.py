@@ -1,3 +1,4 @@
+import copy
 import os
 import weakref
 from _weakref import ReferenceType
@@ -5,18 +6,17 @@ from typing import TYPE_CHECKING, List, Union
 import torch
 import random
 
-from PIL import Image
-from PIL.ImageOps import exif_transpose
-
-from toolkit import image_utils
+from toolkit.size_database import probe_image_size
 from toolkit.dataloader_mixins import CaptionProcessingDTOMixin, ImageProcessingDTOMixin, LatentCachingFileItemDTOMixin, \
     ControlFileItemDTOMixin, ArgBreakMixin, PoiFileItemDTOMixin, MaskFileItemDTOMixin, AugmentationFileItemDTOMixin, \
-    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin
+    UnconditionalFileItemDTOMixin, ClipImageFileItemDTOMixin, TextEmbeddingFileItemDTOMixin
+from toolkit.prompt_utils import PromptEmbeds, concat_prompt_embeds
 
 
 if TYPE_CHECKING:
     from toolkit.config_modules import DatasetConfig
     from toolkit.stable_diffusion_model import StableDiffusion
+    from toolkit.image_cache import SharedImageCache
 
 printed_messages = []
 
@@ -37,26 +37,20 @@ class FileItemDTO(
     MaskFileItemDTOMixin,
     AugmentationFileItemDTOMixin,
     UnconditionalFileItemDTOMixin,
+    TextEmbeddingFileItemDTOMixin,
     PoiFileItemDTOMixin,
     ArgBreakMixin,
 ):
     def __init__(self, *args, **kwargs):
         self.path = kwargs.get('path', '')
         self.dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
-        size_database = kwargs.get('size_database', {})
-        filename = os.path.basename(self.path)
-        if filename in size_database:
-            w, h = size_database[filename]
-        else:
-            # process width and height
-            try:
-                w, h = image_utils.get_image_size(self.path)
-            except image_utils.UnknownImageFormat:
-                print_once(f'Warning: Some images in the dataset cannot be fast read. ' + \
-                           f'This process is faster for png, jpeg')
-                img = exif_transpose(Image.open(self.path))
-                h, w = img.size
-            size_database[filename] = (w, h)
+        # the dataset probes sizes in bulk through its size database and passes them in
+        image_size = kwargs.get('image_size', None)
+        if image_size is None:
+            image_size = probe_image_size(self.path)
+            if image_size is None:
+                raise ValueError(f"Could not read image size: {self.path}")
+        w, h = image_size
         self.width: int = w
         self.height: int = h
         self.dataloader_transforms = kwargs.get('dataloader_transforms', None)
@@ -73,13 +67,23 @@ class FileItemDTO(
         self.crop_width: int = kwargs.get('crop_width', self.scale_to_width)
         self.crop_height: int = kwargs.get('crop_height', self.scale_to_height)
         self.flip_x: bool = kwargs.get('flip_x', False)
-        self.flip_y: bool = kwargs.get('flip_x', False)
+        self.flip_y: bool = kwargs.get('flip_y', False)
         self.augments: List[str] = self.dataset_config.augments
         self.loss_multiplier: float = self.dataset_config.loss_multiplier
 
         self.network_weight: float = self.dataset_config.network_weight
         self.is_reg = self.dataset_config.is_reg
         self.tensor: Union[torch.Tensor, None] = None
+        # shared decoded image cache and this file's slot in it
+        self.image_cache: Union['SharedImageCache', None] = None
+        self.image_cache_idx: int = 0
+
+    def get_sample_view(self) -> 'FileItemDTO':
+        # A file item in the dataset file list is the record for the file: path, sizes, crop, caption config,
+        # transforms. Loading a sample only ever assigns attributes (tensors, captions, crop fixes), it never mutates
+        # shared objects in place, so a shallow copy is enough to keep per sample state off the record.
+        # This replaces a deepcopy that duplicated the dataset config, transforms and cached latents every step.
+        return copy.copy(self)
 
     def cleanup(self):
         self.tensor = None
@@ -88,6 +92,36 @@ class FileItemDTO(
         self.cleanup_clip_image()
         self.cleanup_mask()
         self.cleanup_unconditional()
+        self.cleanup_text_embedding()
+
+
+def stack_batch_tensors(tensors: List[Union[torch.Tensor, None]]) -> Union[torch.Tensor, None]:
+    # stack per item tensors into one preallocated batch tensor, zero filling items that do not have one.
+    # Returns None if no item has one
+    base_tensor = next((x for x in tensors if x is not None), None)
+    if base_tensor is None:
+        return None
+    shape = (len(tensors),) + tuple(base_tensor.shape)
+    if base_tensor.device.type == 'cpu' and torch.utils.data.get_worker_info() is not None:
+        # in a dataloader worker, build it in shared memory so it is not copied again to send it to the main process
+        numel = base_tensor.numel() * len(tensors)
+        storage = base_tensor.untyped_storage()._new_shared(numel * base_tensor.element_size(), device='cpu')
+        out = base_tensor.new(storage).resize_(shape)
+    else:
+        out = torch.empty(shape, dtype=base_tensor.dtype, device=base_tensor.device)
+    for i, x in enumerate(tensors):
+        if x is None:
+            out[i].zero_()
+        else:
+            out[i].copy_(x)
+    return out
+
+
+# batch fields that are moved to the training device with the batch
+_device_tensor_fields = [
+    'tensor', 'latents', 'control_tensor', 'clip_image_tensor', 'mask_tensor', 'unaugmented_tensor',
+    'unconditional_tensor', 'unconditional_latents'
+]
 
 
 class DataLoaderBatchDTO:
@@ -106,95 +140,31 @@ class DataLoaderBatchDTO:
             self.clip_image_embeds: Union[List[dict], None] = None
             self.clip_image_embeds_unconditional: Union[List[dict], None] = None
             self.sigmas: Union[torch.Tensor, None] = None  # can be added elseware and passed along training code
+            # spans recorded by the data timer while loading this batch
+            self.timings: List[tuple] = []
+            # text embeddings cached by the dataset, only set when every item has one
+            self.prompt_embeds: Union[PromptEmbeds, None] = None
+            if all([x.prompt_embeds is not None for x in self.file_items]):
+                self.prompt_embeds = concat_prompt_embeds([x.prompt_embeds for x in self.file_items])
             self.extra_values: Union[torch.Tensor, None] = torch.tensor([x.extra_values for x in self.file_items]) if len(self.file_items[0].extra_values) > 0 else None
             if not is_latents_cached:
                 # only return a tensor if latents are not cached
-                self.tensor: torch.Tensor = torch.cat([x.tensor.unsqueeze(0) for x in self.file_items])
+                self.tensor: torch.Tensor = stack_batch_tensors([x.tensor for x in self.file_items])
             # if we have encoded latents, we concatenate them
             self.latents: Union[torch.Tensor, None] = None
             if is_latents_cached:
-                self.latents = torch.cat([x.get_latent().unsqueeze(0) for x in self.file_items])
-            self.control_tensor: Union[torch.Tensor, None] = None
-            # if self.file_items[0].control_tensor is not None:
-            # if any have a control tensor, we concatenate them
-            if any([x.control_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_control_tensor = None
-                for x in self.file_items:
-                    if x.control_tensor is not None:
-                        base_control_tensor = x.control_tensor
-                        break
-                control_tensors = []
-                for x in self.file_items:
-                    if x.control_tensor is None:
-                        control_tensors.append(torch.zeros_like(base_control_tensor))
-                    else:
-                        control_tensors.append(x.control_tensor)
-                self.control_tensor = torch.cat([x.unsqueeze(0) for x in control_tensors])
+                self.latents = stack_batch_tensors([x.get_latent() for x in self.file_items])
+            # missing entries are zero filled
+            self.control_tensor = stack_batch_tensors([x.control_tensor for x in self.file_items])
 
             self.loss_multiplier_list: List[float] = [x.loss_multiplier for x in self.file_items]
 
-            if any([x.clip_image_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_clip_image_tensor = None
-                for x in self.file_items:
-                    if x.clip_image_tensor is not None:
-                        base_clip_image_tensor = x.clip_image_tensor
-                        break
-                clip_image_tensors = []
-                for x in self.file_items:
-                    if x.clip_image_tensor is None:
-                        clip_image_tensors.append(torch.zeros_like(base_clip_image_tensor))
-                    else:
-                        clip_image_tensors.append(x.clip_image_tensor)
-                self.clip_image_tensor = torch.cat([x.unsqueeze(0) for x in clip_image_tensors])
-
-            if any([x.mask_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_mask_tensor = None
-                for x in self.file_items:
-                    if x.mask_tensor is not None:
-                        base_mask_tensor = x.mask_tensor
-                        break
-                mask_tensors = []
-                for x in self.file_items:
-                    if x.mask_tensor is None:
-                        mask_tensors.append(torch.zeros_like(base_mask_tensor))
-                    else:
-                        mask_tensors.append(x.mask_tensor)
-                self.mask_tensor = torch.cat([x.unsqueeze(0) for x in mask_tensors])
-
+            self.clip_image_tensor = stack_batch_tensors([x.clip_image_tensor for x in self.file_items])
+            self.mask_tensor = stack_batch_tensors([x.mask_tensor for x in self.file_items])
             # add unaugmented tensors for ones with augments
-            if any([x.unaugmented_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_unaugmented_tensor = None
-                for x in self.file_items:
-                    if x.unaugmented_tensor is not None:
-                        base_unaugmented_tensor = x.unaugmented_tensor
-                        break
-                unaugmented_tensor = []
-                for x in self.file_items:
-                    if x.unaugmented_tensor is None:
-                        unaugmented_tensor.append(torch.zeros_like(base_unaugmented_tensor))
-                    else:
-                        unaugmented_tensor.append(x.unaugmented_tensor)
-                self.unaugmented_tensor = torch.cat([x.unsqueeze(0) for x in unaugmented_tensor])
-
+            self.unaugmented_tensor = stack_batch_tensors([x.unaugmented_tensor for x in self.file_items])
             # add unconditional tensors
-            if any([x.unconditional_tensor is not None for x in self.file_items]):
-                # find one to use as a base
-                base_unconditional_tensor = None
-                for x in self.file_items:
-                    if x.unaugmented_tensor is not None:
-                        base_unconditional_tensor = x.unconditional_tensor
-                        break
-                unconditional_tensor = []
-                for x in self.file_items:
-                    if x.unconditional_tensor is None:
-                        unconditional_tensor.append(torch.zeros_like(base_unconditional_tensor))
-                    else:
-                        unconditional_tensor.append(x.unconditional_tensor)
-                self.unconditional_tensor = torch.cat([x.unsqueeze(0) for x in unconditional_tensor])
+            self.unconditional_tensor = stack_batch_tensors([x.unconditional_tensor for x in self.file_items])
 
             if any([x.clip_image_embeds is not None for x in self.file_items]):
                 self.clip_image_embeds = []
@@ -216,6 +186,33 @@ class DataLoaderBatchDTO:
             print(e)
             raise e
 
+    def pin_memory(self):
+        # called by the dataloader pin memory thread when pin_memory is on
+        if not torch.cuda.is_available():
+            return self
+        for name in _device_tensor_fields:
+            value = getattr(self, name)
+            if value is not None and value.device.type == 'cpu' and not value.is_pinned():
+                setattr(self, name, value.pin_memory())
+        if self.prompt_embeds is not None:
+            for name in ['text_embeds', 'pooled_embeds', 'attention_mask']:
+                value = getattr(self.prompt_embeds, name)
+                if value is not None and value.device.type == 'cpu' and not value.is_pinned():
+                    setattr(self.prompt_embeds, name, value.pin_memory())
+        return self
+
+    def to_device(self, device: Union[str, torch.device], non_blocking: bool = True):
+        # move the batch tensors to the device. Copies from pinned memory do not block the host
+        for name in _device_tensor_fields:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.to(device, non_blocking=non_blocking and value.is_pinned()))
+        if self.prompt_embeds is not None:
+            self.prompt_embeds = self.prompt_embeds.to(
+                device, non_blocking=non_blocking and self.prompt_embeds.text_embeds.is_pinned()
+            )
+        return self
+
     def get_is_reg_list(self):
         return [x.is_reg for x in self.file_items]
 
@@ -4,8 +4,9 @@ import json
 import math
 import os
 import random
-from collections import OrderedDict
-from typing import TYPE_CHECKING, List, Dict, Union
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Dict, Union, Tuple
 
 import cv2
 import numpy as np
@@ -15,15 +16,18 @@ from tqdm import tqdm
 from transformers import CLIPImageProcessor, CLIPVisionModelWithProjection
 
 from toolkit.basic import flush, value_map
-from toolkit.buckets import get_bucket_for_image_size, get_resolution
+from toolkit.buckets import get_bucket_for_image_size, get_resolution, get_buckets_for_image_sizes
+from toolkit.latent_store import PackedLatentStore
 from toolkit.metadata import get_meta_for_safetensors
-from toolkit.prompt_utils import inject_trigger_into_prompt
+from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, split_prompt_embeds
 from torchvision import transforms
 from PIL import Image, ImageFilter, ImageOps
 from PIL.ImageOps import exif_transpose
 import albumentations as A
 
 from toolkit.train_tools import get_torch_dtype
+from toolkit.timer import data_timer
+from toolkit.distributed import is_distributed, is_main_process, barrier, shard, all_gather_object
 
 if TYPE_CHECKING:
     from toolkit.data_loader import AiToolkitDataset
@@ -94,12 +98,64 @@ def clean_caption(caption):
     return caption
 
 
+# exif orientations that swap width and height
+_transposed_orientations = [5, 6, 7, 8]
+
+
+def open_image(path: str, draft_size: Union[Tuple[int, int], None] = None) -> Image:
+    # open and orient an image. With a draft size (width, height) after orientation, jpegs are decoded at
+    # the smallest 1/2, 1/4 or 1/8 scale that is still at least that size, which skips most of the decode
+    # work for large photos. The caller still resizes to the exact size
+    img = Image.open(path)
+    if draft_size is not None and img.format == 'JPEG':
+        draft_width, draft_height = draft_size
+        if img.getexif().get(0x0112) in _transposed_orientations:
+            draft_width, draft_height = draft_height, draft_width
+        img.draft(img.mode, (draft_width, draft_height))
+    return exif_transpose(img)
+
+
+# caption, short caption, extra values
+CaptionEntry = Tuple[str, Union[str, None], Union[List[float], None]]
+
+
+def read_caption_file(prompt_path: str) -> CaptionEntry:
+    with open(prompt_path, 'r', encoding='utf-8') as f:
+        prompt = f.read()
+    short_caption = None
+    extra_values = None
+    if prompt_path.endswith('.json'):
+        # replace any line endings with commas for \n \r \r\n
+        prompt = prompt.replace('\r\n', ' ')
+        prompt = prompt.replace('\n', ' ')
+        prompt = prompt.replace('\r', ' ')
+
+        prompt_json = json.loads(prompt)
+        if 'caption' in prompt_json:
+            prompt = prompt_json['caption']
+        if 'caption_short' in prompt_json:
+            short_caption = prompt_json['caption_short']
+
+        if 'extra_values' in prompt_json:
+            extra_values = prompt_json['extra_values']
+
+    prompt = clean_caption(prompt)
+    if short_caption is not None:
+        short_caption = clean_caption(short_caption)
+    return prompt, short_caption, extra_values
+
+
 class CaptionMixin:
     def get_caption_item(self: 'AiToolkitDataset', index):
         if not hasattr(self, 'caption_type'):
             raise Exception('caption_type not found on class instance')
         if not hasattr(self, 'file_list'):
             raise Exception('file_list not found on class instance')
+        # captions do not change during a run, only probe the filesystem once per item
+        if not hasattr(self, 'caption_item_cache'):
+            self.caption_item_cache = {}
+        if index in self.caption_item_cache:
+            return self.caption_item_cache[index]
         img_path_or_tuple = self.file_list[index]
         if isinstance(img_path_or_tuple, tuple):
             img_path = img_path_or_tuple[0] if isinstance(img_path_or_tuple[0], str) else img_path_or_tuple[0].path
@@ -144,6 +200,7 @@ class CaptionMixin:
             from_string, to_string = replacement.split('|')
             prompt = prompt.replace(from_string, to_string)
 
+        self.caption_item_cache[index] = prompt
         return prompt
 
 
@@ -193,74 +250,79 @@ class BucketsMixin:
         bucket_tolerance = config.bucket_tolerance
         file_list: List['FileItemDTO'] = self.file_list
 
-        # for file_item in enumerate(file_list):
-        for idx, file_item in enumerate(file_list):
-            file_item: 'FileItemDTO' = file_item
-            width = int(file_item.width * file_item.dataset_config.scale)
-            height = int(file_item.height * file_item.dataset_config.scale)
-
-            did_process_poi = False
-            if file_item.has_point_of_interest:
-                # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
-                did_process_poi = file_item.setup_poi_bucket()
-            if self.dataset_config.square_crop:
-                # we scale first so smallest size matches resolution
-                scale_factor_x = resolution / width
-                scale_factor_y = resolution / height
-                scale_factor = max(scale_factor_x, scale_factor_y)
-                file_item.scale_to_width = math.ceil(width * scale_factor)
-                file_item.scale_to_height = math.ceil(height * scale_factor)
-                file_item.crop_width = resolution
-                file_item.crop_height = resolution
-                if width > height:
-                    file_item.crop_x = int(file_item.scale_to_width / 2 - resolution / 2)
-                    file_item.crop_y = 0
-                else:
-                    file_item.crop_x = 0
-                    file_item.crop_y = int(file_item.scale_to_height / 2 - resolution / 2)
-            elif not did_process_poi:
-                bucket_resolution = get_bucket_for_image_size(
-                    width, height,
-                    resolution=resolution,
-                    divisibility=bucket_tolerance
-                )
-
-                # Calculate scale factors for width and height
-                width_scale_factor = bucket_resolution["width"] / width
-                height_scale_factor = bucket_resolution["height"] / height
-
-                # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
-                max_scale_factor = max(width_scale_factor, height_scale_factor)
+        num_files = len(file_list)
+        widths = np.array([int(x.width * x.dataset_config.scale) for x in file_list], dtype=np.int64)
+        heights = np.array([int(x.height * x.dataset_config.scale) for x in file_list], dtype=np.int64)
+
+        did_process_poi = np.zeros(num_files, dtype=np.bool_)
+        if config.poi is not None:
+            for idx, file_item in enumerate(file_list):
+                if file_item.has_point_of_interest:
+                    # Attempt to process the poi if we can. It wont process if the image is smaller than the resolution
+                    did_process_poi[idx] = file_item.setup_poi_bucket()
+
+        # everything is computed for all images at once, then written back to the file items
+        scale_to_width = np.zeros(num_files, dtype=np.int64)
+        scale_to_height = np.zeros(num_files, dtype=np.int64)
+        crop_width = np.zeros(num_files, dtype=np.int64)
+        crop_height = np.zeros(num_files, dtype=np.int64)
+        crop_x = np.zeros(num_files, dtype=np.int64)
+        crop_y = np.zeros(num_files, dtype=np.int64)
+        if self.dataset_config.square_crop:
+            to_process = np.ones(num_files, dtype=np.bool_)
+            # we scale first so smallest size matches resolution
+            scale_factor = np.maximum(resolution / widths, resolution / heights)
+            scale_to_width = np.ceil(widths * scale_factor).astype(np.int64)
+            scale_to_height = np.ceil(heights * scale_factor).astype(np.int64)
+            crop_width[:] = resolution
+            crop_height[:] = resolution
+            is_landscape = widths > heights
+            crop_x = np.where(is_landscape, (scale_to_width / 2 - resolution / 2).astype(np.int64), 0)
+            crop_y = np.where(is_landscape, 0, (scale_to_height / 2 - resolution / 2).astype(np.int64))
+        else:
+            to_process = ~did_process_poi
+            bucket_widths, bucket_heights = get_buckets_for_image_sizes(
+                widths[to_process], heights[to_process],
+                resolution=resolution,
+                divisibility=bucket_tolerance
+            )
+            w = widths[to_process]
+            h = heights[to_process]
 
-                # round up
-                file_item.scale_to_width = int(math.ceil(width * max_scale_factor))
-                file_item.scale_to_height = int(math.ceil(height * max_scale_factor))
+            # Use the maximum of the scale factors to ensure both dimensions are scaled above the bucket resolution
+            max_scale_factor = np.maximum(bucket_widths / w, bucket_heights / h)
 
-                file_item.crop_height = bucket_resolution["height"]
-                file_item.crop_width = bucket_resolution["width"]
+            # round up
+            scale_to_width[to_process] = np.ceil(w * max_scale_factor).astype(np.int64)
+            scale_to_height[to_process] = np.ceil(h * max_scale_factor).astype(np.int64)
+            crop_width[to_process] = bucket_widths
+            crop_height[to_process] = bucket_heights
 
-                new_width = bucket_resolution["width"]
-                new_height = bucket_resolution["height"]
+            if not self.dataset_config.random_crop:
+                # do central crop
+                crop_x[to_process] = ((scale_to_width[to_process] - bucket_widths) / 2).astype(np.int64)
+                crop_y[to_process] = ((scale_to_height[to_process] - bucket_heights) / 2).astype(np.int64)
 
-                if self.dataset_config.random_crop:
+        for idx, file_item in enumerate(file_list):
+            if to_process[idx]:
+                file_item.scale_to_width = int(scale_to_width[idx])
+                file_item.scale_to_height = int(scale_to_height[idx])
+                file_item.crop_width = int(crop_width[idx])
+                file_item.crop_height = int(crop_height[idx])
+                if self.dataset_config.random_crop and not self.dataset_config.square_crop:
                     # random crop
-                    crop_x = random.randint(0, file_item.scale_to_width - new_width)
-                    crop_y = random.randint(0, file_item.scale_to_height - new_height)
-                    file_item.crop_x = crop_x
-                    file_item.crop_y = crop_y
+                    file_item.crop_x = random.randint(0, file_item.scale_to_width - file_item.crop_width)
+                    file_item.crop_y = random.randint(0, file_item.scale_to_height - file_item.crop_height)
                 else:
-                    # do central crop
-                    file_item.crop_x = int((file_item.scale_to_width - new_width) / 2)
-                    file_item.crop_y = int((file_item.scale_to_height - new_height) / 2)
-
-                if file_item.crop_y < 0 or file_item.crop_x < 0:
-                    print('debug')
+                    file_item.crop_x = int(crop_x[idx])
+                    file_item.crop_y = int(crop_y[idx])
 
             # check if bucket exists, if not, create it
             bucket_key = f'{file_item.crop_width}x{file_item.crop_height}'
             if bucket_key not in self.buckets:
                 self.buckets[bucket_key] = Bucket(file_item.crop_width, file_item.crop_height)
-            self.buckets[bucket_key].file_list_idx.append(idx)
+            # repeats are added as extra indices so the file item is not duplicated
+            self.buckets[bucket_key].file_list_idx.extend([idx] * max(1, config.num_repeats))
 
         # print the buckets
         self.shuffle_buckets()
@@ -284,6 +346,28 @@ class CaptionProcessingDTOMixin:
             dataset_config: DatasetConfig = kwargs.get('dataset_config', None)
             self.extra_values: List[float] = dataset_config.extra_values
 
+    def get_caption_path(self: 'FileItemDTO'):
+        path_no_ext = os.path.splitext(self.path)[0]
+        prompt_ext = self.dataset_config.caption_ext
+        return f"{path_no_ext}.{prompt_ext}"
+
+    def set_raw_caption(self: 'FileItemDTO', caption_entry: Union[CaptionEntry, None]):
+        # caption_entry is what read_caption_file returned, or None if there is no caption file
+        short_caption = None
+        if caption_entry is not None:
+            prompt, short_caption, extra_values = caption_entry
+            if extra_values is not None:
+                self.extra_values = extra_values
+        else:
+            prompt = ''
+            if self.dataset_config.default_caption is not None:
+                prompt = self.dataset_config.default_caption
+
+        if short_caption is None:
+            short_caption = self.dataset_config.default_caption
+        self.raw_caption = prompt
+        self.raw_caption_short = short_caption
+
     # todo allow for loading from sd-scripts style dict
     def load_caption(self: 'FileItemDTO', caption_dict: Union[dict, None]):
         if self.raw_caption is not None:
@@ -295,42 +379,9 @@ class CaptionProcessingDTOMixin:
                 self.raw_caption_short = caption_dict[self.path]["caption_short"]
         else:
             # see if prompt file exists
-            path_no_ext = os.path.splitext(self.path)[0]
-            prompt_ext = self.dataset_config.caption_ext
-            prompt_path = f"{path_no_ext}.{prompt_ext}"
-            short_caption = None
-
-            if os.path.exists(prompt_path):
-                with open(prompt_path, 'r', encoding='utf-8') as f:
-                    prompt = f.read()
-                    short_caption = None
-                    if prompt_path.endswith('.json'):
-                        # replace any line endings with commas for \n \r \r\n
-                        prompt = prompt.replace('\r\n', ' ')
-                        prompt = prompt.replace('\n', ' ')
-                        prompt = prompt.replace('\r', ' ')
-
-                        prompt_json = json.loads(prompt)
-                        if 'caption' in prompt_json:
-                            prompt = prompt_json['caption']
-                        if 'caption_short' in prompt_json:
-                            short_caption = prompt_json['caption_short']
-
-                        if 'extra_values' in prompt_json:
-                            self.extra_values = prompt_json['extra_values']
-
-                    prompt = clean_caption(prompt)
-                    if short_caption is not None:
-                        short_caption = clean_caption(short_caption)
-            else:
-                prompt = ''
-                if self.dataset_config.default_caption is not None:
-                    prompt = self.dataset_config.default_caption
-
-            if short_caption is None:
-                short_caption = self.dataset_config.default_caption
-            self.raw_caption = prompt
-            self.raw_caption_short = short_caption
+            prompt_path = self.get_caption_path()
+            caption_entry = read_caption_file(prompt_path) if os.path.exists(prompt_path) else None
+            self.set_raw_caption(caption_entry)
 
         self.caption = self.get_caption()
         if self.raw_caption_short is not None:
@@ -341,7 +392,8 @@ class CaptionProcessingDTOMixin:
             trigger=None,
             to_replace_list=None,
             add_if_not_present=False,
-            short_caption=False
+            short_caption=False,
+            use_caption_dropout=True
     ):
         if short_caption:
             raw_caption = self.raw_caption_short
@@ -350,7 +402,7 @@ class CaptionProcessingDTOMixin:
         if raw_caption is None:
             raw_caption = ''
         # handle dropout
-        if self.dataset_config.caption_dropout_rate > 0 and not short_caption:
+        if self.dataset_config.caption_dropout_rate > 0 and not short_caption and use_caption_dropout:
             # get a random float form 0 to 1
             rand = random.random()
             if rand < self.dataset_config.caption_dropout_rate:
@@ -417,6 +469,48 @@ class CaptionProcessingDTOMixin:
 
 
 class ImageProcessingDTOMixin:
+    def get_draft_size(self: 'FileItemDTO') -> Union[Tuple[int, int], None]:
+        # the size the image is resized to before cropping, when it is known before loading
+        if self.dataset_config.buckets and self.dataset_config.reduced_jpeg_decode:
+            return self.scale_to_width, self.scale_to_height
+        return None
+
+    def load_source_image(self: 'FileItemDTO') -> Image:
+        # open, orient, convert and flip the image. Scaling and cropping is done by the caller
+        with data_timer('decode'):
+            try:
+                img = open_image(self.path, draft_size=self.get_draft_size())
+            except Exception as e:
+                print(f"Error: {e}")
+                print(f"Error loading image: {self.path}")
+
+            if self.use_alpha_as_mask:
+                # we do this to make sure it does not replace the alpha with another color
+                # we want the image just without the alpha channel
+                np_img = np.array(img)
+                # strip off alpha
+                np_img = np_img[:, :, :3]
+                img = Image.fromarray(np_img)
+
+            img = img.convert('RGB')
+        w, h = img.size
+        if w > h and self.scale_to_width < self.scale_to_height:
+            # throw error, they should match
+            print(
+                f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
+        elif h > w and self.scale_to_height < self.scale_to_width:
+            # throw error, they should match
+            print(
+                f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
+
+        if self.flip_x:
+            # do a flip
+            img = img.transpose(Image.FLIP_LEFT_RIGHT)
+        if self.flip_y:
+            # do a flip
+            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        return img
+
     def load_and_process_image(
             self: 'FileItemDTO',
             transform: Union[None, transforms.Compose],
@@ -434,42 +528,23 @@ class ImageProcessingDTOMixin:
             if self.has_unconditional:
                 self.load_unconditional_image()
             return
-        try:
-            img = Image.open(self.path)
-            img = exif_transpose(img)
-        except Exception as e:
-            print(f"Error: {e}")
-            print(f"Error loading image: {self.path}")
-
-        if self.use_alpha_as_mask:
-            # we do this to make sure it does not replace the alpha with another color
-            # we want the image just without the alpha channel
-            np_img = np.array(img)
-            # strip off alpha
-            np_img = np_img[:, :, :3]
-            img = Image.fromarray(np_img)
 
-        img = img.convert('RGB')
-        w, h = img.size
-        if w > h and self.scale_to_width < self.scale_to_height:
-            # throw error, they should match
-            print(
-                f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
-        elif h > w and self.scale_to_height < self.scale_to_width:
-            # throw error, they should match
-            print(
-                f"unexpected values: w={w}, h={h}, file_item.scale_to_width={self.scale_to_width}, file_item.scale_to_height={self.scale_to_height}, file_item.path={self.path}")
+        img = None
+        if self.image_cache is not None and self.dataset_config.buckets:
+            # decoded, flipped and resized pixels shared by all dataloader workers
+            cached_img = self.image_cache.get(self.image_cache_idx, self.scale_to_width, self.scale_to_height)
+            if cached_img is not None:
+                img = Image.fromarray(cached_img)
 
-        if self.flip_x:
-            # do a flip
-            img = img.transpose(Image.FLIP_LEFT_RIGHT)
-        if self.flip_y:
-            # do a flip
-            img = img.transpose(Image.FLIP_TOP_BOTTOM)
+        if img is None:
+            img = self.load_source_image()
+            if self.dataset_config.buckets:
+                # scale and crop based on file item
+                img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
+                if self.image_cache is not None:
+                    self.image_cache.put(self.image_cache_idx, np.array(img))
 
         if self.dataset_config.buckets:
-            # scale and crop based on file item
-            img = img.resize((self.scale_to_width, self.scale_to_height), Image.BICUBIC)
             # crop to x_crop, y_crop, x_crop + crop_width, y_crop + crop_height
             if img.width < self.crop_x + self.crop_width or img.height < self.crop_y + self.crop_height:
                 # todo look into this. This still happens sometimes
@@ -540,9 +615,14 @@ class ControlFileItemDTOMixin:
         dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
         self.full_size_control_images = False
         if dataset_config.control_path is not None:
+            self.full_size_control_images = dataset_config.full_size_control_images
+        if 'control_path' in kwargs:
+            # already resolved by the file index
+            self.control_path = kwargs['control_path']
+            self.has_control_image = self.control_path is not None
+        elif dataset_config.control_path is not None:
             # find the control image path
             control_path = dataset_config.control_path
-            self.full_size_control_images = dataset_config.full_size_control_images
             # we are using control images
             img_path = kwargs.get('path', None)
             img_ext_list = ['.jpg', '.jpeg', '.png', '.webp']
@@ -555,8 +635,11 @@ class ControlFileItemDTOMixin:
 
     def load_control_image(self: 'FileItemDTO'):
         try:
-            img = Image.open(self.control_path).convert('RGB')
-            img = exif_transpose(img)
+            if self.full_size_control_images:
+                draft_size = (512, 512) if self.dataset_config.reduced_jpeg_decode else None
+            else:
+                draft_size = self.get_draft_size()
+            img = open_image(self.control_path, draft_size=draft_size).convert('RGB')
         except Exception as e:
             print(f"Error: {e}")
             print(f"Error loading image: {self.control_path}")
@@ -634,19 +717,29 @@ class ClipImageFileItemDTOMixin:
             sd = kwargs.get('sd', None)
             if hasattr(sd.adapter, 'clip_image_processor'):
                 self.clip_image_processor = sd.adapter.clip_image_processor
-            # find the control image path
-            clip_image_path = dataset_config.clip_image_path
-            # we are using control images
-            img_path = kwargs.get('path', None)
-            img_ext_list = ['.jpg', '.jpeg', '.png', '.webp']
-            file_name_no_ext = os.path.splitext(os.path.basename(img_path))[0]
-            for ext in img_ext_list:
-                if os.path.exists(os.path.join(clip_image_path, file_name_no_ext + ext)):
-                    self.clip_image_path = os.path.join(clip_image_path, file_name_no_ext + ext)
-                    self.has_clip_image = True
-                    break
-
-            self.build_clip_imag_augmentation_transform()
+            if 'clip_image_path' in kwargs:
+                # already resolved by the file index
+                self.clip_image_path = kwargs['clip_image_path']
+                self.has_clip_image = self.clip_image_path is not None
+            else:
+                # find the control image path
+                clip_image_path = dataset_config.clip_image_path
+                # we are using control images
+                img_path = kwargs.get('path', None)
+                img_ext_list = ['.jpg', '.jpeg', '.png', '.webp']
+                file_name_no_ext = os.path.splitext(os.path.basename(img_path))[0]
+                for ext in img_ext_list:
+                    if os.path.exists(os.path.join(clip_image_path, file_name_no_ext + ext)):
+                        self.clip_image_path = os.path.join(clip_image_path, file_name_no_ext + ext)
+                        self.has_clip_image = True
+                        break
+
+            if 'clip_image_aug_transform' in kwargs:
+                # built once for the dataset by the file index
+                self.clip_image_aug_transform = kwargs['clip_image_aug_transform']
+                self.has_clip_augmentations = self.clip_image_aug_transform is not None
+            else:
+                self.build_clip_imag_augmentation_transform()
 
     def build_clip_imag_augmentation_transform(self: 'FileItemDTO'):
         if self.dataset_config.clip_image_augmentations is not None and len(self.dataset_config.clip_image_augmentations) > 0:
@@ -818,7 +911,12 @@ class AugmentationFileItemDTOMixin:
         self.dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
         self.aug_transform: Union[None, A.Compose] = None
         self.aug_replay_spatial_transforms = None
-        self.build_augmentation_transform()
+        if 'aug_transform' in kwargs:
+            # built once for the dataset by the file index
+            self.aug_transform = kwargs['aug_transform']
+            self.has_augmentations = self.aug_transform is not None
+        else:
+            self.build_augmentation_transform()
 
     def build_augmentation_transform(self: 'FileItemDTO'):
         if self.dataset_config.augmentations is not None and len(self.dataset_config.augmentations) > 0:
@@ -927,6 +1025,10 @@ class MaskFileItemDTOMixin:
             self.use_alpha_as_mask = True
             self.mask_path = kwargs.get('path', None)
             self.has_mask_image = True
+        elif 'mask_path' in kwargs:
+            # already resolved by the file index
+            self.mask_path = kwargs['mask_path']
+            self.has_mask_image = self.mask_path is not None
         elif dataset_config.mask_path is not None:
             # find the control image path
             mask_path = dataset_config.mask_path if dataset_config.mask_path is not None else dataset_config.alpha_mask
@@ -942,8 +1044,11 @@ class MaskFileItemDTOMixin:
 
     def load_mask_image(self: 'FileItemDTO'):
         try:
-            img = Image.open(self.mask_path)
-            img = exif_transpose(img)
+            draft_size = self.get_draft_size()
+            if draft_size is not None:
+                # the sizes can be swapped below if the mask orientation does not match, so cover both
+                draft_size = (max(draft_size), max(draft_size))
+            img = open_image(self.mask_path, draft_size=draft_size)
         except Exception as e:
             print(f"Error: {e}")
             print(f"Error loading image: {self.mask_path}")
@@ -1033,7 +1138,11 @@ class UnconditionalFileItemDTOMixin:
         self.unconditional_transforms = self.dataloader_transforms
         dataset_config: 'DatasetConfig' = kwargs.get('dataset_config', None)
 
-        if dataset_config.unconditional_path is not None:
+        if 'unconditional_path' in kwargs:
+            # already resolved by the file index
+            self.unconditional_path = kwargs['unconditional_path']
+            self.has_unconditional = self.unconditional_path is not None
+        elif dataset_config.unconditional_path is not None:
             # we are using control images
             img_path = kwargs.get('path', None)
             img_ext_list = ['.jpg', '.jpeg', '.png', '.webp']
@@ -1046,8 +1155,7 @@ class UnconditionalFileItemDTOMixin:
 
     def load_unconditional_image(self: 'FileItemDTO'):
         try:
-            img = Image.open(self.unconditional_path)
-            img = exif_transpose(img)
+            img = open_image(self.unconditional_path, draft_size=self.get_draft_size())
         except Exception as e:
             print(f"Error: {e}")
             print(f"Error loading image: {self.mask_path}")
@@ -1094,6 +1202,48 @@ class UnconditionalFileItemDTOMixin:
         self.unconditional_latent = None
 
 
+class TextEmbeddingFileItemDTOMixin:
+    def __init__(self: 'FileItemDTO', *args, **kwargs):
+        if hasattr(super(), '__init__'):
+            super().__init__(*args, **kwargs)
+        # one cached embedding per caption variant, set when the dataset caches text embeddings
+        self.text_embedding_paths: Union[List[str], None] = None
+        self.text_embedding_captions: Union[List[str], None] = None
+        # embedding of the empty caption, used on caption dropout
+        self.text_embedding_dropout_path: Union[str, None] = None
+        self.prompt_embeds: Union[PromptEmbeds, None] = None
+
+    def get_caption_variants(self: 'FileItemDTO', num_variants: int) -> List[str]:
+        # captions this file can produce, not counting caption dropout. Token dropout, shuffling and random
+        # triggers make it random, then num_variants random captions are drawn and kept
+        dataset_config = self.dataset_config
+        is_random = dataset_config.token_dropout_rate > 0 or dataset_config.shuffle_tokens or \
+            len(dataset_config.random_triggers) > 0
+        if not is_random:
+            num_variants = 1
+        captions = [self.get_caption(use_caption_dropout=False) for _ in range(num_variants)]
+        return list(dict.fromkeys(captions))
+
+    def load_text_embedding(self: 'FileItemDTO'):
+        if self.dataset_config.caption_dropout_rate > 0 and random.random() < self.dataset_config.caption_dropout_rate:
+            caption = ''
+            embedding_path = self.text_embedding_dropout_path
+        else:
+            variant_idx = random.randint(0, len(self.text_embedding_paths) - 1)
+            caption = self.text_embedding_captions[variant_idx]
+            embedding_path = self.text_embedding_paths[variant_idx]
+        # the caption is kept in sync with the embedding, the trainer still sees the prompt it was made from
+        self.caption = caption
+        state_dict = load_file(embedding_path, device='cpu')
+        self.prompt_embeds = PromptEmbeds(
+            [state_dict['text_embeds'], state_dict.get('pooled_embeds', None)],
+            attention_mask=state_dict.get('attention_mask', None)
+        )
+
+    def cleanup_text_embedding(self: 'FileItemDTO'):
+        self.prompt_embeds = None
+
+
 class PoiFileItemDTOMixin:
     # Point of interest bounding box. Allows for dynamic cropping without cropping out the main subject
     # items in the poi will always be inside the image when random cropping
@@ -1122,6 +1272,10 @@ class PoiFileItemDTOMixin:
                     f"Error: poi is only supported when using json captions. Please set caption_ext to json in the dataset config"
                 )
             self.poi = self.poi.strip()
+        if self.poi is not None and 'poi_box' in kwargs:
+            # already read and flipped by the file index
+            self.poi_x, self.poi_y, self.poi_width, self.poi_height = kwargs['poi_box']
+        elif self.poi is not None:
             # get the caption path
             file_path_no_ext = os.path.splitext(path)[0]
             caption_path = file_path_no_ext + '.json'
@@ -1265,6 +1419,8 @@ class LatentCachingFileItemDTOMixin:
         self.is_caching_to_disk = False
         self.is_caching_to_memory = False
         self.latent_load_device = 'cpu'
+        # shared packed store when latent_cache_format is packed
+        self.latent_store: Union[PackedLatentStore, None] = None
         # sd1 or sdxl or others
         self.latent_space_version = 'sd1'
         # todo, increment this if we change the latent format to invalidate cache
@@ -1318,7 +1474,10 @@ class LatentCachingFileItemDTOMixin:
     def get_latent(self, device=None):
         if not self.is_latent_cached:
             return None
-        if self._encoded_latent is None:
+        if self._encoded_latent is None and self.latent_store is not None:
+            # zero copy slice of the memory mapped store
+            self._encoded_latent = self.latent_store.get(self.latent_store.key_for_path(self.get_latent_path()))
+        elif self._encoded_latent is None:
             # load it from disk
             state_dict = load_file(
                 self.get_latent_path(),
@@ -1346,12 +1505,21 @@ class LatentCachingMixin:
             print(" - Saving latents to disk")
         if to_memory:
             print(" - Keeping latents in memory")
+
+        latent_store: Union[PackedLatentStore, None] = None
+        if to_disk and self.dataset_config.latent_cache_format == 'packed':
+            latent_store = PackedLatentStore(
+                os.path.join(self.dataset_folder, '_latent_cache_packed'),
+                dataset_root=self.dataset_folder
+            )
+            print(f" - Using packed latent store with {len(latent_store)} cached latents")
         # move sd items to cpu except for vae
         self.sd.set_device_state_preset('cache_latents')
 
-        # use tqdm to show progress
-        i = 0
-        for file_item in tqdm(self.file_list, desc=f'Caching latents{" to disk" if to_disk else ""}'):
+        # latent path -> file items sharing it (repeats share a latent). Filled with everything not cached yet
+        to_encode: Dict[str, List['FileItemDTO']] = OrderedDict()
+
+        for file_item in tqdm(self.file_list, desc=f'Checking latent cache{" on disk" if to_disk else ""}'):
             # set latent space version
             if self.sd.model_config.latent_space_version is not None:
                 file_item.latent_space_version = self.sd.model_config.latent_space_version
@@ -1372,48 +1540,202 @@ class LatentCachingMixin:
             file_item.latent_load_device = self.sd.device
 
             latent_path = file_item.get_latent_path(recalculate=True)
+            file_item.latent_store = latent_store
+            latent_key = latent_store.key_for_path(latent_path) if latent_store is not None else None
+            if latent_path in to_encode:
+                # a repeat of something we are already going to encode
+                to_encode[latent_path].append(file_item)
+                continue
+            elif latent_store is not None and latent_key in latent_store:
+                if to_memory:
+                    file_item._encoded_latent = latent_store.get(latent_key).to('cpu', dtype=self.sd.torch_dtype)
+            elif latent_store is not None and os.path.exists(latent_path):
+                if is_main_process():
+                    # migrate the old per file cache into the store
+                    latent = latent_store.migrate_file(latent_key, latent_path)
+                else:
+                    # the main process migrates it, the store is reloaded below
+                    latent = load_file(latent_path, device='cpu')['latent']
+                if to_memory:
+                    file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
             # check if it is saved to disk already
-            if os.path.exists(latent_path):
+            elif os.path.exists(latent_path):
                 if to_memory:
                     # load it into memory
                     state_dict = load_file(latent_path, device='cpu')
                     file_item._encoded_latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
             else:
-                # not saved to disk, calculate
-                # load the image first
-                file_item.load_and_process_image(self.transform, only_load_latents=True)
-                dtype = self.sd.torch_dtype
-                device = self.sd.device_torch
-                # add batch dimension
-                imgs = file_item.tensor.unsqueeze(0).to(device, dtype=dtype)
-                latent = self.sd.encode_images(imgs).squeeze(0)
-                # save_latent
-                if to_disk:
-                    state_dict = OrderedDict([
-                        ('latent', latent.clone().detach().cpu()),
-                    ])
-                    # metadata
-                    meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
-                    os.makedirs(os.path.dirname(latent_path), exist_ok=True)
-                    save_file(state_dict, latent_path, metadata=meta)
+                to_encode[latent_path] = [file_item]
+                continue
+            file_item.is_latent_cached = True
+
+        # every rank has to see the cache as it was before anyone writes to it
+        barrier()
+        if len(to_encode) > 0:
+            if is_distributed():
+                self._encode_and_cache_latents_distributed(list(to_encode.values()), latent_store)
+            else:
+                self._encode_and_cache_latents(list(to_encode.values()), latent_store)
+        if is_distributed() and latent_store is not None:
+            # pick up what the main process added to the store
+            barrier()
+            if not is_main_process():
+                latent_store.reload()
 
+        # restore device state
+        self.sd.restore_device_state()
+
+    def _encode_and_cache_latents_distributed(
+            self: 'AiToolkitDataset',
+            item_groups: List[List['FileItemDTO']],
+            latent_store: Union[PackedLatentStore, None]
+    ):
+        # every rank encodes its share. Expects the dataset folder to be on a file system all ranks share
+        to_disk = self.is_caching_latents_to_disk
+        to_memory = self.is_caching_latents_to_memory
+        own_groups = shard(item_groups)
+        if to_disk and latent_store is None:
+            # ranks write their own latent files and load the others from disk once they are all written
+            self._encode_and_cache_latents(own_groups, None)
+            barrier()
+            own_items = set(id(group[0]) for group in own_groups)
+            for group in item_groups:
+                if id(group[0]) in own_items:
+                    continue
+                latent = None
                 if to_memory:
-                    # keep it in memory
-                    file_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+                    state_dict = load_file(group[0].get_latent_path(), device='cpu')
+                    latent = state_dict['latent'].to('cpu', dtype=self.sd.torch_dtype)
+                for file_item in group:
+                    file_item._encoded_latent = latent
+                    file_item.is_latent_cached = True
+            return
 
-                del imgs
-                del latent
-                del file_item.tensor
+        # the packed store has a single writer and memory caches need every latent, so they are gathered
+        self._encode_and_cache_latents(own_groups, None, to_disk=False, to_memory=True)
+        own_latents = OrderedDict([(group[0].get_latent_path(), group[0]._encoded_latent) for group in own_groups])
+        latents = {}
+        for rank_latents in all_gather_object(own_latents):
+            latents.update(rank_latents)
+        for group in item_groups:
+            latent_path = group[0].get_latent_path()
+            latent = latents[latent_path]
+            if latent_store is not None and is_main_process():
+                latent_store.add(latent_store.key_for_path(latent_path), latent)
+            for file_item in group:
+                file_item._encoded_latent = latent if to_memory else None
+                file_item.is_latent_cached = True
+
+    def _encode_and_cache_latents(
+            self: 'AiToolkitDataset',
+            item_groups: List[List['FileItemDTO']],
+            latent_store: Union[PackedLatentStore, None],
+            to_disk: Union[bool, None] = None,
+            to_memory: Union[bool, None] = None,
+    ):
+        # to_disk and to_memory default to how the dataset caches
+        if to_disk is None:
+            to_disk = self.is_caching_latents_to_disk
+        if to_memory is None:
+            to_memory = self.is_caching_latents_to_memory
+        batch_size = max(1, self.dataset_config.latent_cache_batch_size)
+        num_workers = self.dataset_config.latent_cache_num_workers
+        dtype = self.sd.torch_dtype
+        device = self.sd.device_torch
+
+        # group by the final image size so every encode batch can be stacked
+        size_groups: Dict[str, List[List['FileItemDTO']]] = OrderedDict()
+        for group in item_groups:
+            file_item = group[0]
+            if self.dataset_config.buckets:
+                size_key = f'{file_item.crop_width}x{file_item.crop_height}'
+            else:
+                size_key = f'{self.dataset_config.resolution}x{self.dataset_config.resolution}'
+            if size_key not in size_groups:
+                size_groups[size_key] = []
+            size_groups[size_key].append(group)
+
+        batches: List[List[List['FileItemDTO']]] = []
+        for groups in size_groups.values():
+            for start_idx in range(0, len(groups), batch_size):
+                batches.append(groups[start_idx:start_idx + batch_size])
+
+        # decode/resize on a worker pool, encode on the main thread and write on a background thread
+        load_pool = ThreadPoolExecutor(max_workers=num_workers) if num_workers > 0 else None
+        write_pool = ThreadPoolExecutor(max_workers=1) if to_disk else None
+        pending_loads = deque()
+        pending_writes = deque()
+        batch_iter = iter(batches)
+
+        def load_image(file_item: 'FileItemDTO'):
+            file_item.load_and_process_image(self.transform, only_load_latents=True)
+
+        def write_latent(file_item: 'FileItemDTO', latent_path: str, latent: torch.Tensor):
+            if latent_store is not None:
+                latent_store.add(latent_store.key_for_path(latent_path), latent)
+            else:
+                state_dict = OrderedDict([
+                    ('latent', latent),
+                ])
+                # metadata
+                meta = get_meta_for_safetensors(file_item.get_latent_info_dict())
+                os.makedirs(os.path.dirname(latent_path), exist_ok=True)
+                save_file(state_dict, latent_path, metadata=meta)
+
+        def submit_next_batch():
+            batch = next(batch_iter, None)
+            if batch is None:
+                return
+            if load_pool is not None:
+                futures = [load_pool.submit(load_image, group[0]) for group in batch]
+            else:
+                futures = []
+                for group in batch:
+                    load_image(group[0])
+            pending_loads.append((batch, futures))
 
-                # flush(garbage_collect=False)
-            file_item.is_latent_cached = True
-            i += 1
-            # flush every 100
-            # if i % 100 == 0:
-            #     flush()
+        try:
+            # keep a couple batches decoding ahead of the encoder
+            for _ in range(2):
+                submit_next_batch()
+
+            progress_bar = tqdm(total=len(item_groups), desc=f'Caching latents{" to disk" if to_disk else ""}')
+            while len(pending_loads) > 0:
+                batch, futures = pending_loads.popleft()
+                for future in futures:
+                    future.result()
+                submit_next_batch()
+
+                imgs = [group[0].tensor.to(device, dtype=dtype) for group in batch]
+                latents = self.sd.encode_images(imgs)
+
+                for group, latent in zip(batch, latents):
+                    file_item = group[0]
+                    latent = latent.clone().detach().cpu()
+                    if write_pool is not None:
+                        pending_writes.append(write_pool.submit(write_latent, file_item, file_item.get_latent_path(), latent))
+                        # backpressure so the write queue cannot grow without bound
+                        while len(pending_writes) > batch_size * 4:
+                            pending_writes.popleft().result()
+                    for repeat_item in group:
+                        if to_memory:
+                            # keep it in memory
+                            repeat_item._encoded_latent = latent.to('cpu', dtype=self.sd.torch_dtype)
+                        repeat_item.tensor = None
+                        repeat_item.is_latent_cached = True
 
-        # restore device state
-        self.sd.restore_device_state()
+                del imgs
+                del latents
+                progress_bar.update(len(batch))
+            progress_bar.close()
+
+            while len(pending_writes) > 0:
+                pending_writes.popleft().result()
+        finally:
+            if load_pool is not None:
+                load_pool.shutdown(wait=True)
+            if write_pool is not None:
+                write_pool.shutdown(wait=True)
 
 
 class CLIPCachingMixin:
@@ -1587,3 +1909,85 @@ class CLIPCachingMixin:
 
         # restore device state
         self.sd.restore_device_state()
+
+
+class TextEmbeddingCachingMixin:
+    def __init__(self: 'AiToolkitDataset', **kwargs):
+        # if we have super, call it
+        if hasattr(super(), '__init__'):
+            super().__init__(**kwargs)
+        self.is_text_embedding_cached = False
+
+    def get_text_embedding_path(self: 'AiToolkitDataset', prompt: str) -> str:
+        # embeddings are stored by what is encoded, files with the same caption share them
+        model_config = self.sd.model_config
+        hash_dict = OrderedDict([
+            ("prompt", prompt),
+            ("name_or_path", model_config.name_or_path),
+            ("lora_path", model_config.lora_path),
+            ("arch", [
+                model_config.is_v2, model_config.is_xl, model_config.is_v3, model_config.is_flux,
+                model_config.is_pixart, model_config.is_pixart_sigma, model_config.is_auraflow,
+            ]),
+            ("use_text_encoders", [model_config.use_text_encoder_1, model_config.use_text_encoder_2]),
+            ("text_embedding_version", 1),
+        ])
+        hash_input = json.dumps(hash_dict, sort_keys=True).encode('utf-8')
+        hash_str = base64.urlsafe_b64encode(hashlib.md5(hash_input).digest()).decode('ascii')
+        hash_str = hash_str.replace('=', '')
+        return os.path.join(self.dataset_folder, '_t_e_cache', f'{hash_str}.safetensors')
+
+    def cache_text_embeddings(self: 'AiToolkitDataset', prompt_transform: Callable[[str, bool], str]):
+        # prompt_transform(caption, is_reg) is what the trainer does to a caption before encoding it
+        print(f"Caching text embeddings for {self.dataset_path}")
+        is_reg = self.dataset_config.is_reg
+        num_variants = max(1, self.dataset_config.text_embedding_variants)
+
+        # encoded prompt -> cache path
+        prompt_paths: Dict[str, str] = OrderedDict()
+
+        def get_path(caption: str) -> str:
+            prompt = prompt_transform(caption, is_reg)
+            if prompt not in prompt_paths:
+                prompt_paths[prompt] = self.get_text_embedding_path(prompt)
+            return prompt_paths[prompt]
+
+        dropout_path = get_path('')
+        for file_item in self.file_list:
+            if file_item.raw_caption is None:
+                file_item.load_caption(self.caption_dict)
+            captions = file_item.get_caption_variants(num_variants)
+            file_item.text_embedding_captions = captions
+            file_item.text_embedding_paths = [get_path(caption) for caption in captions]
+            file_item.text_embedding_dropout_path = dropout_path
+
+        # every rank has to see the cache as it was before anyone writes to it
+        barrier()
+        to_encode = [prompt for prompt, path in prompt_paths.items() if not os.path.exists(path)]
+        print(f" - {len(prompt_paths)} distinct prompts, {len(to_encode)} to encode")
+        # data parallel ranks encode their share
+        to_encode = shard(to_encode)
+        if len(to_encode) > 0:
+            self.sd.set_device_state_preset('cache_text_embeddings')
+            batch_size = max(1, self.dataset_config.text_embedding_cache_batch_size)
+            with torch.no_grad():
+                for start_idx in tqdm(range(0, len(to_encode), batch_size), desc='Caching text embeddings'):
+                    prompts = to_encode[start_idx:start_idx + batch_size]
+                    prompt_embeds = self.sd.encode_prompt(prompts)
+                    for prompt, embeds in zip(prompts, split_prompt_embeds(prompt_embeds, len(prompts))):
+                        state_dict = OrderedDict([('text_embeds', embeds.text_embeds)])
+                        if embeds.pooled_embeds is not None:
+                            state_dict['pooled_embeds'] = embeds.pooled_embeds
+                        if embeds.attention_mask is not None:
+                            state_dict['attention_mask'] = embeds.attention_mask
+                        state_dict = OrderedDict([(k, v.detach().cpu().contiguous()) for k, v in state_dict.items()])
+                        path = prompt_paths[prompt]
+                        os.makedirs(os.path.dirname(path), exist_ok=True)
+                        save_file(state_dict, path, metadata={'prompt': prompt})
+            self.sd.restore_device_state()
+        barrier()
+        self.is_text_embedding_cached = True
+        if self.file_index is not None:
+            # file items are built from the index in workers, it has to carry the embedding paths
+            from toolkit.file_index import FileIndex
+            self.file_index = FileIndex.from_dataset(self)
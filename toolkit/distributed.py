@@ -0,0 +1,195 @@
+import datetime
+import os
+from typing import Dict, List, Union
+
+import torch
+import torch.distributed as dist
+
+# grads are flattened into buckets of about this size for the all reduce
+GRAD_BUCKET_SIZE_MB = 25
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    if is_distributed():
+        return dist.get_rank()
+    # set by torchrun, so it is known before the process group is set up
+    return int(os.environ.get('RANK', 0))
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def get_world_size() -> int:
+    if is_distributed():
+        return dist.get_world_size()
+    return int(os.environ.get('WORLD_SIZE', 1))
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(
+        enabled: bool,
+        backend: Union[str, None] = None,
+        timeout_minutes: float = 60,
+) -> bool:
+    """
+    Joins the process group of the processes started by torchrun or run.py --num_processes. Returns True if
+    training is data parallel. The backend defaults to nccl when cuda is available and gloo otherwise.
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        if enabled:
+            print("Warning: train.distributed is set but only one process was started, training on a single device")
+        return False
+    if not enabled:
+        raise ValueError(
+            f"Started with {world_size} processes but train.distributed is not set. Every process would train "
+            f"and save on its own, set train.distributed to train data parallel"
+        )
+    if is_distributed():
+        return True
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(get_local_rank())
+    # sampling and saving only happen on the main process, the others wait in the next collective
+    dist.init_process_group(backend=backend, timeout=datetime.timedelta(minutes=timeout_minutes))
+    if is_main_process():
+        print(f"Data parallel training on {get_world_size()} processes with {backend}")
+    return True
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src: int = 0):
+    # the value of the src rank, on every rank
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_object(obj) -> list:
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+def shard(items: list) -> list:
+    # this rank's share of a list that is the same on every rank
+    if not is_distributed():
+        return items
+    return items[get_rank()::get_world_size()]
+
+
+def _get_communication_device() -> torch.device:
+    if dist.get_backend() == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
+def _get_param_list(params) -> List[torch.nn.Parameter]:
+    # optimizer style params, a list of tensors or of {'params': ...} groups
+    param_list = []
+    for param in params:
+        if isinstance(param, dict):
+            param_list.extend(param['params'])
+        else:
+            param_list.append(param)
+    return param_list
+
+
+def _get_buckets(tensors: List[torch.Tensor]) -> List[List[torch.Tensor]]:
+    # same device and dtype per bucket so each one flattens into a single tensor
+    bucket_size = GRAD_BUCKET_SIZE_MB * 1024 * 1024
+    buckets: Dict[tuple, List[List[torch.Tensor]]] = {}
+    bucket_bytes: Dict[tuple, int] = {}
+    for tensor in tensors:
+        key = (tensor.device, tensor.dtype)
+        num_bytes = tensor.numel() * tensor.element_size()
+        if key not in buckets or bucket_bytes[key] + num_bytes > bucket_size:
+            buckets.setdefault(key, []).append([])
+            bucket_bytes[key] = 0
+        buckets[key][-1].append(tensor)
+        bucket_bytes[key] += num_bytes
+    return [bucket for key_buckets in buckets.values() for bucket in key_buckets]
+
+
+@torch.no_grad()
+def broadcast_parameters(params, src: int = 0):
+    # start every rank from the same weights, new lora / adapter weights are randomly initialized per rank
+    if not is_distributed():
+        return
+    tensors = [param.data for param in _get_param_list(params)]
+    device = _get_communication_device()
+    for bucket in _get_buckets(tensors):
+        flat = torch.cat([t.reshape(-1) for t in bucket]).to(device)
+        dist.broadcast(flat, src=src)
+        offset = 0
+        for tensor in bucket:
+            numel = tensor.numel()
+            tensor.copy_(flat[offset:offset + numel].view_as(tensor))
+            offset += numel
+
+
+@torch.no_grad()
+def all_reduce_gradients(params):
+    """
+    Averages the gradients of params over all ranks, in flattened buckets. Every rank has to call it with the
+    same params in the same order. Params that have a gradient on some ranks but not on this one get a zero
+    one, so all ranks send the same buckets. Params no rank has a gradient for keep grad None, like they would
+    in a single process run, so the optimizer skips them.
+    """
+    if not is_distributed():
+        return
+    world_size = get_world_size()
+    param_list = [param for param in _get_param_list(params) if param.requires_grad]
+    device = _get_communication_device()
+    has_grad = torch.tensor([param.grad is not None for param in param_list], dtype=torch.int32, device=device)
+    dist.all_reduce(has_grad, op=dist.ReduceOp.SUM)
+    grads = []
+    for param, num_ranks in zip(param_list, has_grad.tolist()):
+        if num_ranks == 0:
+            param.grad = None
+            continue
+        if param.grad is None:
+            param.grad = torch.zeros_like(param)
+        grads.append(param.grad)
+    for bucket in _get_buckets(grads):
+        flat = torch.cat([g.reshape(-1) for g in bucket]).to(device)
+        dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+        flat.div_(world_size)
+        offset = 0
+        for grad in bucket:
+            numel = grad.numel()
+            grad.copy_(flat[offset:offset + numel].view_as(grad))
+            offset += numel
+
+
+def all_reduce_mean_dict(values: Dict[str, float]) -> Dict[str, float]:
+    # mean of logged scalars over all ranks
+    if not is_distributed() or len(values) == 0:
+        return values
+    keys = list(values.keys())
+    tensor = torch.tensor([float(values[key]) for key in keys], dtype=torch.float64, device=_get_communication_device())
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    tensor.div_(get_world_size())
+    return type(values)(zip(keys, tensor.tolist()))
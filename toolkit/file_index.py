@@ -0,0 +1,135 @@
+import sys
+from typing import TYPE_CHECKING, Dict, List, Union
+
+import numpy as np
+
+from toolkit.data_transfer_object.data_loader import FileItemDTO
+
+if TYPE_CHECKING:
+    from toolkit.data_loader import AiToolkitDataset
+
+# per file geometry columns, in the order they are passed to FileItemDTO
+_int_columns = [
+    'width', 'height', 'scale_to_width', 'scale_to_height', 'crop_x', 'crop_y', 'crop_width', 'crop_height'
+]
+_bool_columns = ['flip_x', 'flip_y']
+# paths of the files that go with an image, found by probing the disk when the file list is built
+_path_attrs = ['control_path', 'clip_image_path', 'mask_path', 'unconditional_path']
+_poi_attrs = ['poi_x', 'poi_y', 'poi_width', 'poi_height']
+# built from the dataset config, the same for every file item
+_shared_item_kwargs = ['aug_transform', 'clip_image_aug_transform']
+
+# state set uniformly on every file item by the caching mixins. It is copied onto items built from the index
+_shared_item_attrs = [
+    'is_latent_cached', 'is_caching_to_disk', 'is_caching_to_memory', 'latent_load_device', 'latent_space_version',
+    'latent_store', 'is_caching_clip_vision_to_disk', 'is_vision_clip_cached', 'clip_vision_is_quad',
+    'clip_vision_load_device', 'clip_image_encoder_path', 'clip_vision_unconditional_paths', 'image_cache',
+    'text_embedding_dropout_path',
+]
+
+
+class FileIndex:
+    """
+    Columnar view of a dataset file list. Holds numpy arrays for the geometry of every file and an interned
+    path table instead of one FileItemDTO per file, so it is cheap to hold and to pickle into dataloader workers.
+    File items are built from it on demand for each sample, without touching the filesystem: everything the
+    file item would probe or read on init is resolved once and passed in.
+    """
+
+    def __init__(self, num_items: int):
+        self.paths: List[str] = [''] * num_items
+        self.columns: Dict[str, np.ndarray] = {}
+        for name in _int_columns:
+            self.columns[name] = np.zeros(num_items, dtype=np.int32)
+        for name in _bool_columns:
+            self.columns[name] = np.zeros(num_items, dtype=np.bool_)
+        self.bucket_id = np.full(num_items, -1, dtype=np.int32)
+        self.raw_captions: List[Union[str, None]] = [None] * num_items
+        self.raw_captions_short: List[Union[str, None]] = [None] * num_items
+        # only files whose caption set their own extra values
+        self.extra_values: Dict[int, List[float]] = {}
+        # cached text embedding variants, when the dataset caches them
+        self.text_embedding_paths: Union[List[List[str]], None] = None
+        self.text_embedding_captions: Union[List[List[str]], None] = None
+        # only the paths the dataset config uses, None where the file has none
+        self.file_paths: Dict[str, List[Union[str, None]]] = {}
+        self.poi_boxes: Union[np.ndarray, None] = None
+        self.shared_attrs: dict = {}
+        self.shared_kwargs: dict = {}
+
+    def __len__(self):
+        return len(self.paths)
+
+    @classmethod
+    def from_dataset(cls, dataset: 'AiToolkitDataset') -> 'FileIndex':
+        file_list: List[FileItemDTO] = dataset.file_list
+        index = cls(len(file_list))
+        for idx, file_item in enumerate(file_list):
+            index.paths[idx] = sys.intern(file_item.path)
+            for name in _int_columns + _bool_columns:
+                index.columns[name][idx] = getattr(file_item, name)
+            index.raw_captions[idx] = file_item.raw_caption
+            index.raw_captions_short[idx] = file_item.raw_caption_short
+            if file_item.extra_values is not dataset.dataset_config.extra_values:
+                index.extra_values[idx] = file_item.extra_values
+            if file_item.text_embedding_paths is not None:
+                if index.text_embedding_paths is None:
+                    index.text_embedding_paths = [None] * len(file_list)
+                    index.text_embedding_captions = [None] * len(file_list)
+                index.text_embedding_paths[idx] = file_item.text_embedding_paths
+                index.text_embedding_captions[idx] = file_item.text_embedding_captions
+        dataset_config = dataset.dataset_config
+        used_path_attrs = {
+            'control_path': dataset_config.control_path is not None,
+            'clip_image_path': dataset_config.clip_image_path is not None,
+            'mask_path': dataset_config.mask_path is not None and not dataset_config.alpha_mask,
+            'unconditional_path': dataset_config.unconditional_path is not None,
+        }
+        for name in _path_attrs:
+            if used_path_attrs[name]:
+                index.file_paths[name] = [
+                    None if getattr(file_item, name) is None else sys.intern(getattr(file_item, name))
+                    for file_item in file_list
+                ]
+        if dataset_config.poi is not None:
+            index.poi_boxes = np.array(
+                [[getattr(file_item, name) for name in _poi_attrs] for file_item in file_list], dtype=np.int32
+            ).reshape(-1, len(_poi_attrs))
+        for bucket_id, bucket in enumerate(dataset.buckets.values()):
+            # a file can be in a bucket several times for repeats, the id is the same
+            index.bucket_id[np.asarray(bucket.file_list_idx, dtype=np.int64)] = bucket_id
+        if len(file_list) > 0:
+            index.shared_attrs = {
+                name: getattr(file_list[0], name) for name in _shared_item_attrs if hasattr(file_list[0], name)
+            }
+            index.shared_kwargs = {name: getattr(file_list[0], name) for name in _shared_item_kwargs}
+        return index
+
+    def build_file_item(self, idx: int, dataset: 'AiToolkitDataset') -> FileItemDTO:
+        kwargs = {name: self.columns[name][idx].item() for name in _int_columns + _bool_columns}
+        width = kwargs.pop('width')
+        height = kwargs.pop('height')
+        for name, paths in self.file_paths.items():
+            kwargs[name] = paths[idx]
+        if self.poi_boxes is not None:
+            kwargs['poi_box'] = tuple(self.poi_boxes[idx].tolist())
+        kwargs.update(self.shared_kwargs)
+        file_item = FileItemDTO(
+            sd=dataset.sd,
+            path=self.paths[idx],
+            dataset_config=dataset.dataset_config,
+            dataloader_transforms=dataset.transform,
+            image_size=(width, height),
+            **kwargs
+        )
+        for name, value in self.shared_attrs.items():
+            setattr(file_item, name, value)
+        file_item.image_cache_idx = idx
+        file_item.raw_caption = self.raw_captions[idx]
+        file_item.raw_caption_short = self.raw_captions_short[idx]
+        if idx in self.extra_values:
+            file_item.extra_values = self.extra_values[idx]
+        if self.text_embedding_paths is not None:
+            file_item.text_embedding_paths = self.text_embedding_paths[idx]
+            file_item.text_embedding_captions = self.text_embedding_captions[idx]
+        return file_item
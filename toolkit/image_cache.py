@@ -0,0 +1,178 @@
+import atexit
+import multiprocessing
+import os
+import uuid
+from multiprocessing.shared_memory import SharedMemory
+from typing import Union
+
+import numpy as np
+
+# columns of the shared slot table
+_GENERATION = 0
+_NBYTES = 1
+_HEIGHT = 2
+_WIDTH = 3
+_CHANNELS = 4
+_LAST_USED = 5
+_SEGMENT = 6
+_NUM_COLUMNS = 7
+
+# shared counters
+_TOTAL_BYTES = 0
+_TICK = 1
+_HITS = 2
+_MISSES = 3
+_NUM_STATS = 4
+
+# prefix -> cache made in this process or inherited from the parent
+_caches = {}
+
+
+def can_share() -> bool:
+    # workers find the cache, its lock and the resource tracker through what they inherit on fork
+    return multiprocessing.get_start_method() == 'fork'
+
+
+def _get_cache(prefix: str) -> 'SharedImageCache':
+    if prefix not in _caches:
+        raise RuntimeError(
+            f"SharedImageCache can only be shared with forked dataloader workers, "
+            f"the start method is '{multiprocessing.get_start_method()}'"
+        )
+    return _caches[prefix]
+
+
+class SharedImageCache:
+    """
+    Decoded, resized uint8 images shared between the main process and all dataloader workers. Each image lives
+    in its own shared memory segment. A small shared table tracks which file index is cached, at what size,
+    and when it was last used so the least recently used images are evicted to stay under max_bytes.
+    Workers must be forked from the process that made the cache, which is the dataloader default on linux.
+
+    Every segment stays registered with the resource tracker of the process that made the cache. Forked workers
+    share that tracker, so segments they create or attach are tracked by it too, and it unlinks whatever is left
+    once the owner and all workers are gone, even when they were killed.
+    """
+
+    def __init__(self, num_items: int, max_bytes: int):
+        if not can_share():
+            raise RuntimeError(
+                f"SharedImageCache needs the fork start method, it is '{multiprocessing.get_start_method()}'"
+            )
+        self.num_items = num_items
+        self.max_bytes = max_bytes
+        self.prefix = f"aitk_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        # inherited by forked workers
+        self.lock = multiprocessing.Lock()
+        self._owner_pid = os.getpid()
+        table_bytes = max(1, num_items) * _NUM_COLUMNS * 8 + _NUM_STATS * 8
+        # this also starts the resource tracker before any worker is forked, so they all share it
+        self._table_shm = SharedMemory(create=True, size=table_bytes, name=f"{self.prefix}_table")
+        self._map_table()
+        self.table[:] = 0
+        self.stats[:] = 0
+        _caches[self.prefix] = self
+        atexit.register(self.close)
+
+    def _map_table(self):
+        num_rows = max(1, self.num_items)
+        self.table = np.ndarray((num_rows, _NUM_COLUMNS), dtype=np.int64, buffer=self._table_shm.buf)
+        self.stats = np.ndarray(
+            (_NUM_STATS,), dtype=np.int64, buffer=self._table_shm.buf, offset=num_rows * _NUM_COLUMNS * 8
+        )
+
+    def __reduce__(self):
+        # file items holding the cache are pickled on their way out of dataloader workers. The lock cannot be
+        # pickled, so they are resolved back to the instance the process inherited when it was forked
+        return _get_cache, (self.prefix,)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _segment_name(self, idx: int, generation: int) -> str:
+        return f"{self.prefix}_{idx}_{generation}"
+
+    def _evict(self, idx: int):
+        # must hold the lock
+        row = self.table[idx]
+        if row[_NBYTES] == 0:
+            return
+        try:
+            shm = SharedMemory(name=self._segment_name(idx, int(row[_SEGMENT])))
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        self.stats[_TOTAL_BYTES] -= row[_NBYTES]
+        row[_NBYTES] = 0
+
+    def get(self, idx: int, width: int, height: int) -> Union[np.ndarray, None]:
+        with self.lock:
+            row = self.table[idx]
+            if row[_NBYTES] == 0 or row[_WIDTH] != width or row[_HEIGHT] != height:
+                self.stats[_MISSES] += 1
+                return None
+            self.stats[_TICK] += 1
+            row[_LAST_USED] = self.stats[_TICK]
+            self.stats[_HITS] += 1
+            shape = (int(row[_HEIGHT]), int(row[_WIDTH]), int(row[_CHANNELS]))
+            try:
+                # attach under the lock so it cannot be evicted first. The mapping outlives an unlink
+                shm = SharedMemory(name=self._segment_name(idx, int(row[_SEGMENT])))
+            except FileNotFoundError:
+                row[_NBYTES] = 0
+                return None
+        try:
+            return np.ndarray(shape, dtype=np.uint8, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+
+    def put(self, idx: int, img: np.ndarray):
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if img.ndim == 2:
+            img = img[:, :, None]
+        if img.nbytes > self.max_bytes or img.nbytes == 0:
+            return
+        with self.lock:
+            # reserve a segment name for this write
+            self.table[idx, _GENERATION] += 1
+            generation = int(self.table[idx, _GENERATION])
+        try:
+            shm = SharedMemory(create=True, size=img.nbytes, name=self._segment_name(idx, generation))
+        except FileExistsError:
+            return
+        np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)[:] = img
+        shm.close()
+        with self.lock:
+            if self.table[idx, _GENERATION] != generation:
+                # another worker cached this file after us, keep theirs
+                shm.unlink()
+                return
+            self._evict(idx)
+            while self.stats[_TOTAL_BYTES] + img.nbytes > self.max_bytes:
+                cached = np.nonzero(self.table[:, _NBYTES] > 0)[0]
+                if len(cached) == 0:
+                    break
+                self._evict(int(cached[np.argmin(self.table[cached, _LAST_USED])]))
+            self.stats[_TICK] += 1
+            self.table[idx, _SEGMENT] = generation
+            self.table[idx, _NBYTES] = img.nbytes
+            self.table[idx, _HEIGHT] = img.shape[0]
+            self.table[idx, _WIDTH] = img.shape[1]
+            self.table[idx, _CHANNELS] = img.shape[2]
+            self.table[idx, _LAST_USED] = self.stats[_TICK]
+            self.stats[_TOTAL_BYTES] += img.nbytes
+
+    def close(self):
+        # only the process that made the cache removes it
+        if os.getpid() != self._owner_pid or self._table_shm is None:
+            return
+        with self.lock:
+            for idx in range(self.num_items):
+                self._evict(idx)
+        del self.table
+        del self.stats
+        self._table_shm.close()
+        self._table_shm.unlink()
+        self._table_shm = None
+        _caches.pop(self.prefix, None)
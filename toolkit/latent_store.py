@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Union
+
+import numpy as np
+import torch
+from safetensors.torch import load_file
+
+# torch dtypes we can round trip through the packed store by name
+_dtype_by_name: Dict[str, torch.dtype] = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+}
+
+# offsets are aligned so we can view the raw bytes as any of the dtypes above
+_alignment = 64
+
+
+class PackedLatentStore:
+    """
+    Append only latent cache. Latents are packed into a few large shard files and looked up through
+    an index keyed by the same path/hash the per file safetensors cache uses. Reads are zero copy slices
+    of a memory mapped shard.
+
+    Layout:
+        <root>/index.jsonl       one json line per latent {key, shard, offset, nbytes, shape, dtype}
+        <root>/latents_00000.bin  raw latent bytes
+    """
+
+    def __init__(self, root: str, dataset_root: str, max_shard_size: int = 4 * 1024 ** 3):
+        self.root = root
+        self.dataset_root = dataset_root
+        self.max_shard_size = max_shard_size
+        self.index_path = os.path.join(self.root, 'index.jsonl')
+        self.index: Dict[str, dict] = OrderedDict()
+        self._maps: Dict[int, np.memmap] = {}
+        self._lock = threading.Lock()
+        self._write_shard: Union[int, None] = None
+        self._load_index()
+
+    def __getstate__(self):
+        # memory maps and locks do not survive pickling into dataloader workers, reopen them lazily
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        # file items are deep copied per sample, they should all share one store
+        return self
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # partially written line from an interrupted run. Everything before it is valid
+                    break
+                self.index[entry['key']] = entry
+
+    def reload(self):
+        # pick up latents another process added
+        self._load_index()
+        self._write_shard = None
+
+    def _shard_path(self, shard: int) -> str:
+        return os.path.join(self.root, f'latents_{shard:05d}.bin')
+
+    def _get_map(self, shard: int) -> np.memmap:
+        if shard not in self._maps:
+            # copy on write so torch gets a writable buffer without ever touching the file
+            self._maps[shard] = np.memmap(self._shard_path(shard), dtype=np.uint8, mode='c')
+        return self._maps[shard]
+
+    def key_for_path(self, latent_path: str) -> str:
+        # key off the per file cache path so the hash and folder layout are identical to the unpacked cache
+        key = os.path.relpath(os.path.splitext(latent_path)[0], self.dataset_root)
+        return key.replace(os.sep, '/')
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, key: str) -> torch.Tensor:
+        entry = self.index[key]
+        mm = self._get_map(entry['shard'])
+        if entry['offset'] + entry['nbytes'] > len(mm):
+            # shard grew since we mapped it
+            del self._maps[entry['shard']]
+            mm = self._get_map(entry['shard'])
+        raw = mm[entry['offset']:entry['offset'] + entry['nbytes']]
+        tensor = torch.from_numpy(raw).view(_dtype_by_name[entry['dtype']])
+        return tensor.view(entry['shape'])
+
+    def add(self, key: str, latent: torch.Tensor):
+        latent = latent.detach().cpu().contiguous()
+        dtype_name = str(latent.dtype).replace('torch.', '')
+        if dtype_name not in _dtype_by_name:
+            raise ValueError(f"Unsupported latent dtype for packed cache: {latent.dtype}")
+        data = latent.view(torch.uint8).numpy().tobytes() if latent.numel() > 0 else b''
+        with self._lock:
+            os.makedirs(self.root, exist_ok=True)
+            shard = self._get_write_shard(len(data))
+            shard_path = self._shard_path(shard)
+            with open(shard_path, 'ab') as f:
+                offset = f.tell()
+                pad = (-offset) % _alignment
+                if pad:
+                    f.write(b'\0' * pad)
+                    offset += pad
+                f.write(data)
+            entry = OrderedDict([
+                ('key', key),
+                ('shard', shard),
+                ('offset', offset),
+                ('nbytes', len(data)),
+                ('shape', list(latent.shape)),
+                ('dtype', dtype_name),
+            ])
+            # data is written before the index line so the index never points at missing bytes
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            self.index[key] = entry
+
+    def _get_write_shard(self, nbytes: int) -> int:
+        if self._write_shard is None:
+            self._write_shard = max([e['shard'] for e in self.index.values()], default=0)
+        shard_path = self._shard_path(self._write_shard)
+        if os.path.exists(shard_path) and os.path.getsize(shard_path) + nbytes > self.max_shard_size:
+            self._write_shard += 1
+        return self._write_shard
+
+    def migrate_file(self, key: str, latent_path: str) -> torch.Tensor:
+        # pull a latent from the legacy one file per image cache into the store
+        state_dict = load_file(latent_path, device='cpu')
+        latent = state_dict['latent']
+        self.add(key, latent)
+        return latent
+
+    def keys(self) -> List[str]:
+        return list(self.index.keys())
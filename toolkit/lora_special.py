@@ -485,6 +485,9 @@ class LoRASpecialNetwork(ToolkitNetworkMixin, LoRANetwork):
                 unet.conv_in = self.unet_conv_in
                 unet.conv_out = self.unet_conv_out
 
+        if self.network_config is not None and self.network_config.fuse_shared_inputs and not is_lorm:
+            self.setup_shared_input_groups(text_encoders + ([unet] if train_unet else []))
+
     def prepare_optimizer_params(self, text_encoder_lr, unet_lr, default_lr):
         # call Lora prepare_optimizer_params
         all_params = super().prepare_optimizer_params(text_encoder_lr, unet_lr, default_lr)
@@ -11,7 +11,16 @@ import torch.nn.functional as F
 import torch.linalg as linalg
 
 from tqdm import tqdm
-from collections import OrderedDict
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import re
+
+from safetensors import safe_open
+
+from toolkit.paths import KEYMAPS_ROOT
+from toolkit.safetensors_writer import SafetensorsWriter
 
 
 def make_sparse(t: torch.Tensor, sparsity=0.95):
@@ -22,21 +31,25 @@ def make_sparse(t: torch.Tensor, sparsity=0.95):
     return sparse_t
 
 
-def extract_conv(
-        weight: Union[torch.Tensor, nn.Parameter],
-        mode='fixed',
-        mode_param=0,
-        device='cpu',
-        is_cp=False,
-) -> Tuple[nn.Parameter, nn.Parameter]:
-    weight = weight.to(device)
-    out_ch, in_ch, kernel_size, _ = weight.shape
+# rank is known in fixed mode, so a randomized svd of only the top singular vectors is enough
+SVD_LOWRANK_OVERSAMPLE = 8
+SVD_LOWRANK_NITER = 4
 
-    U, S, Vh = linalg.svd(weight.reshape(out_ch, -1))
+LAYER_CLASSES = {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}
 
-    if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
+
+def svd(weight: torch.Tensor, lora_rank: Union[int, None] = None):
+    # U, S, Vh, truncated to about lora_rank when it is known
+    if lora_rank is not None:
+        q = lora_rank + SVD_LOWRANK_OVERSAMPLE
+        if q < min(weight.shape):
+            U, S, V = torch.svd_lowrank(weight, q=q, niter=SVD_LOWRANK_NITER)
+            return U, S, V.T
+    return linalg.svd(weight)
+
+
+def get_lora_rank(S: torch.Tensor, mode, mode_param):
+    if mode == 'threshold':
         assert mode_param >= 0
         lora_rank = torch.sum(S > mode_param)
     elif mode == 'ratio':
@@ -50,10 +63,31 @@ def extract_conv(
         lora_rank = torch.sum(s_cum < min_cum_sum)
     else:
         raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2 and not is_cp:
-        return weight, 'full'
+    return lora_rank
+
+
+def extract_conv(
+        weight: Union[torch.Tensor, nn.Parameter],
+        mode='fixed',
+        mode_param=0,
+        device='cpu',
+        is_cp=False,
+) -> Tuple[nn.Parameter, nn.Parameter]:
+    weight = weight.to(device)
+    out_ch, in_ch, kernel_size, _ = weight.shape
+
+    if mode == 'fixed':
+        lora_rank = min(out_ch, in_ch, max(1, mode_param))
+        if lora_rank >= out_ch / 2 and not is_cp:
+            return weight, 'full'
+        U, S, Vh = svd(weight.reshape(out_ch, -1), lora_rank)
+    else:
+        U, S, Vh = svd(weight.reshape(out_ch, -1))
+        lora_rank = get_lora_rank(S, mode, mode_param)
+        lora_rank = max(1, lora_rank)
+        lora_rank = min(out_ch, in_ch, lora_rank)
+        if lora_rank >= out_ch / 2 and not is_cp:
+            return weight, 'full'
 
     U = U[:, :lora_rank]
     S = S[:lora_rank]
@@ -76,28 +110,18 @@ def extract_linear(
     weight = weight.to(device)
     out_ch, in_ch = weight.shape
 
-    U, S, Vh = linalg.svd(weight)
-
     if mode == 'fixed':
-        lora_rank = mode_param
-    elif mode == 'threshold':
-        assert mode_param >= 0
-        lora_rank = torch.sum(S > mode_param)
-    elif mode == 'ratio':
-        assert 1 >= mode_param >= 0
-        min_s = torch.max(S) * mode_param
-        lora_rank = torch.sum(S > min_s)
-    elif mode == 'quantile' or mode == 'percentile':
-        assert 1 >= mode_param >= 0
-        s_cum = torch.cumsum(S, dim=0)
-        min_cum_sum = mode_param * torch.sum(S)
-        lora_rank = torch.sum(s_cum < min_cum_sum)
+        lora_rank = min(out_ch, in_ch, max(1, mode_param))
+        if lora_rank >= out_ch / 2:
+            return weight, 'full'
+        U, S, Vh = svd(weight, lora_rank)
     else:
-        raise NotImplementedError('Extract mode should be "fixed", "threshold", "ratio" or "quantile"')
-    lora_rank = max(1, lora_rank)
-    lora_rank = min(out_ch, in_ch, lora_rank)
-    if lora_rank >= out_ch / 2:
-        return weight, 'full'
+        U, S, Vh = svd(weight)
+        lora_rank = get_lora_rank(S, mode, mode_param)
+        lora_rank = max(1, lora_rank)
+        lora_rank = min(out_ch, in_ch, lora_rank)
+        if lora_rank >= out_ch / 2:
+            return weight, 'full'
 
     U = U[:, :lora_rank]
     S = S[:lora_rank]
@@ -111,9 +135,11 @@ def extract_linear(
     return (extract_weight_A, extract_weight_B, diff), 'low rank'
 
 
-def extract_diff(
-        base_model,
-        db_model,
+@torch.no_grad()
+def extract_layer(
+        lora_name: str,
+        base_weight: torch.Tensor,
+        db_weight: torch.Tensor,
         mode='fixed',
         linear_mode_param=0,
         conv_mode_param=0,
@@ -122,11 +148,78 @@ def extract_diff(
         sparsity=0.98,
         small_conv=True,
         linear_only=False,
+) -> Dict[str, torch.Tensor]:
+    # lora weights for the difference of one linear or conv weight, empty if it did not change
+    loras = OrderedDict()
+    if db_weight.dim() not in [2, 4]:
+        return loras
+    if torch.allclose(db_weight, base_weight):
+        return loras
+
+    if db_weight.dim() == 2:
+        weight, decompose_mode = extract_linear(
+            (db_weight - base_weight),
+            mode,
+            linear_mode_param,
+            device=extract_device,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+    else:
+        is_linear = (db_weight.shape[2] == 1
+                     and db_weight.shape[3] == 1)
+        if not is_linear and linear_only:
+            return loras
+        weight, decompose_mode = extract_conv(
+            (db_weight - base_weight),
+            mode,
+            linear_mode_param if is_linear else conv_mode_param,
+            device=extract_device,
+        )
+        if decompose_mode == 'low rank':
+            extract_a, extract_b, diff = weight
+        if small_conv and not is_linear and decompose_mode == 'low rank':
+            dim = extract_a.size(0)
+            (extract_c, extract_a, _), _ = extract_conv(
+                extract_a.transpose(0, 1),
+                'fixed', dim,
+                extract_device, True
+            )
+            extract_a = extract_a.transpose(0, 1)
+            extract_c = extract_c.transpose(0, 1)
+            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
+            diff = db_weight - torch.einsum(
+                'i j k l, j r, p i -> p r k l',
+                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
+            ).detach().cpu().contiguous()
+            del extract_c
+
+    if decompose_mode == 'low rank':
+        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
+        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
+        if use_bias:
+            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
+            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
+
+            indices = sparse_diff.indices().to(torch.int16)
+            values = sparse_diff.values().half()
+            loras[f'{lora_name}.bias_indices'] = indices
+            loras[f'{lora_name}.bias_values'] = values
+            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
+        del extract_a, extract_b, diff
+    elif decompose_mode == 'full':
+        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
+    else:
+        raise NotImplementedError
+    return loras
+
+
+def get_extract_targets(
         extract_unet=True,
         extract_text_encoder=True,
+        linear_only=False,
 ):
-    meta = OrderedDict()
-
     UNET_TARGET_REPLACE_MODULE = [
         "Transformer2DModel",
         "Attention",
@@ -155,10 +248,38 @@ def extract_diff(
 
     if not extract_text_encoder:
         TEXT_ENCODER_TARGET_REPLACE_MODULE = []
+    return UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE
+
+
+def extract_diff(
+        base_model,
+        db_model,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+):
+    meta = OrderedDict()
+
+    UNET_TARGET_REPLACE_MODULE, UNET_TARGET_REPLACE_NAME, TEXT_ENCODER_TARGET_REPLACE_MODULE = get_extract_targets(
+        extract_unet, extract_text_encoder, linear_only
+    )
 
     LORA_PREFIX_UNET = 'lora_unet'
     LORA_PREFIX_TEXT_ENCODER = 'lora_te'
 
+    def extract(lora_name, base_weight, db_weight):
+        return extract_layer(
+            lora_name, base_weight, db_weight, mode, linear_mode_param, conv_mode_param, extract_device,
+            use_bias, sparsity, small_conv, linear_only
+        )
+
     def make_state_dict(
             prefix,
             root_module: torch.nn.Module,
@@ -174,7 +295,7 @@ def extract_diff(
             if module.__class__.__name__ in target_replace_modules:
                 temp[name] = {}
                 for child_name, child_module in module.named_modules():
-                    if child_module.__class__.__name__ not in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
+                    if child_module.__class__.__name__ not in LAYER_CLASSES:
                         continue
                     temp[name][child_name] = child_module.weight
             elif name in target_replace_names:
@@ -186,139 +307,15 @@ def extract_diff(
                 for child_name, child_module in module.named_modules():
                     lora_name = prefix + '.' + name + '.' + child_name
                     lora_name = lora_name.replace('.', '_')
-                    layer = child_module.__class__.__name__
-                    if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                        root_weight = child_module.weight
-                        if torch.allclose(root_weight, weights[child_name]):
-                            continue
-
-                    if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                        weight, decompose_mode = extract_linear(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                    elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                        is_linear = (child_module.weight.shape[2] == 1
-                                     and child_module.weight.shape[3] == 1)
-                        if not is_linear and linear_only:
-                            continue
-                        weight, decompose_mode = extract_conv(
-                            (child_module.weight - weights[child_name]),
-                            mode,
-                            linear_mode_param if is_linear else conv_mode_param,
-                            device=extract_device,
-                        )
-                        if decompose_mode == 'low rank':
-                            extract_a, extract_b, diff = weight
-                        if small_conv and not is_linear and decompose_mode == 'low rank':
-                            dim = extract_a.size(0)
-                            (extract_c, extract_a, _), _ = extract_conv(
-                                extract_a.transpose(0, 1),
-                                'fixed', dim,
-                                extract_device, True
-                            )
-                            extract_a = extract_a.transpose(0, 1)
-                            extract_c = extract_c.transpose(0, 1)
-                            loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                            diff = child_module.weight - torch.einsum(
-                                'i j k l, j r, p i -> p r k l',
-                                extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                            ).detach().cpu().contiguous()
-                            del extract_c
-                    else:
+                    if child_module.__class__.__name__ not in LAYER_CLASSES:
                         continue
-                    if decompose_mode == 'low rank':
-                        loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                        loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                        if use_bias:
-                            diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                            sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                            indices = sparse_diff.indices().to(torch.int16)
-                            values = sparse_diff.values().half()
-                            loras[f'{lora_name}.bias_indices'] = indices
-                            loras[f'{lora_name}.bias_values'] = values
-                            loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                        del extract_a, extract_b, diff
-                    elif decompose_mode == 'full':
-                        loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                    else:
-                        raise NotImplementedError
+                    loras.update(extract(lora_name, weights[child_name], child_module.weight))
             elif name in temp_name:
-                weights = temp_name[name]
                 lora_name = prefix + '.' + name
                 lora_name = lora_name.replace('.', '_')
-                layer = module.__class__.__name__
-
-                if layer in {'Linear', 'LoRACompatibleLinear', 'Conv2d', 'LoRACompatibleConv'}:
-                    root_weight = module.weight
-                    if torch.allclose(root_weight, weights):
-                        continue
-
-                if layer == 'Linear' or layer == 'LoRACompatibleLinear':
-                    weight, decompose_mode = extract_linear(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                elif layer == 'Conv2d' or layer == 'LoRACompatibleConv':
-                    is_linear = (
-                            root_weight.shape[2] == 1
-                            and root_weight.shape[3] == 1
-                    )
-                    if not is_linear and linear_only:
-                        continue
-                    weight, decompose_mode = extract_conv(
-                        (root_weight - weights),
-                        mode,
-                        linear_mode_param if is_linear else conv_mode_param,
-                        device=extract_device,
-                    )
-                    if decompose_mode == 'low rank':
-                        extract_a, extract_b, diff = weight
-                    if small_conv and not is_linear and decompose_mode == 'low rank':
-                        dim = extract_a.size(0)
-                        (extract_c, extract_a, _), _ = extract_conv(
-                            extract_a.transpose(0, 1),
-                            'fixed', dim,
-                            extract_device, True
-                        )
-                        extract_a = extract_a.transpose(0, 1)
-                        extract_c = extract_c.transpose(0, 1)
-                        loras[f'{lora_name}.lora_mid.weight'] = extract_c.detach().cpu().contiguous().half()
-                        diff = root_weight - torch.einsum(
-                            'i j k l, j r, p i -> p r k l',
-                            extract_c, extract_a.flatten(1, -1), extract_b.flatten(1, -1)
-                        ).detach().cpu().contiguous()
-                        del extract_c
-                else:
+                if module.__class__.__name__ not in LAYER_CLASSES:
                     continue
-                if decompose_mode == 'low rank':
-                    loras[f'{lora_name}.lora_down.weight'] = extract_a.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.lora_up.weight'] = extract_b.detach().cpu().contiguous().half()
-                    loras[f'{lora_name}.alpha'] = torch.Tensor([extract_a.shape[0]]).half()
-                    if use_bias:
-                        diff = diff.detach().cpu().reshape(extract_b.size(0), -1)
-                        sparse_diff = make_sparse(diff, sparsity).to_sparse().coalesce()
-
-                        indices = sparse_diff.indices().to(torch.int16)
-                        values = sparse_diff.values().half()
-                        loras[f'{lora_name}.bias_indices'] = indices
-                        loras[f'{lora_name}.bias_values'] = values
-                        loras[f'{lora_name}.bias_size'] = torch.tensor(diff.shape).to(torch.int16)
-                    del extract_a, extract_b, diff
-                elif decompose_mode == 'full':
-                    loras[f'{lora_name}.diff'] = weight.detach().cpu().contiguous().half()
-                else:
-                    raise NotImplementedError
+                loras.update(extract(lora_name, temp_name[name], module.weight))
         return loras
 
     text_encoder_loras = make_state_dict(
@@ -338,6 +335,150 @@ def extract_diff(
     return (text_encoder_loras | unet_loras), meta
 
 
+# where the target module classes are in diffusers key paths
+DIFFUSERS_MODULE_PATTERNS = {
+    'Transformer2DModel': r'attentions\.\d+',
+    'Attention': r'attentions\.\d+\.transformer_blocks\.\d+\.attn\d+',
+    'ResnetBlock2D': r'resnets\.\d+',
+    'Downsample2D': r'downsamplers\.\d+',
+    'Upsample2D': r'upsamplers\.\d+',
+    'CLIPAttention': r'self_attn',
+    'CLIPMLP': r'mlp',
+}
+
+
+def get_ldm_extract_keys(
+        is_v2=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+        linear_only=False,
+) -> List[Tuple[str, str, int, int]]:
+    """
+    Weights of an ldm checkpoint that extract_diff would extract, found from the ldm to diffusers keymap
+    instead of by building the models. Returns (lora_name, ldm_key, slice_index, num_slices), where v2 text
+    encoder q, k and v are row slices of one in_proj_weight.
+    """
+    mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2.json' if is_v2 else 'stable_diffusion_sd1.json')
+    with open(mapping_path, 'r') as f:
+        mapping = json.load(f, object_pairs_hook=OrderedDict)
+
+    # diffusers key -> (ldm key, slice index, num slices)
+    diffusers_keys = OrderedDict()
+    for ldm_key, diffusers_key in mapping['ldm_diffusers_keymap'].items():
+        diffusers_keys[diffusers_key] = (ldm_key, 0, 1)
+    for ldm_key, operator in mapping['ldm_diffusers_operator_map'].items():
+        if 'cat' in operator:
+            for i, diffusers_key in enumerate(operator['cat']):
+                diffusers_keys[diffusers_key] = (ldm_key, i, len(operator['cat']))
+
+    unet_modules, unet_names, text_encoder_modules = get_extract_targets(
+        extract_unet, extract_text_encoder, linear_only
+    )
+    targets = [
+        ('unet_', 'lora_unet', [DIFFUSERS_MODULE_PATTERNS[m] for m in unet_modules], unet_names),
+        ('te_', 'lora_te', [DIFFUSERS_MODULE_PATTERNS[m] for m in text_encoder_modules], []),
+    ]
+
+    extract_keys = []
+    for diffusers_key, (ldm_key, slice_index, num_slices) in diffusers_keys.items():
+        if not diffusers_key.endswith('.weight'):
+            continue
+        for key_prefix, lora_prefix, patterns, names in targets:
+            if not diffusers_key.startswith(key_prefix):
+                continue
+            name = diffusers_key[len(key_prefix):-len('.weight')]
+            # layers inside a target module, or a target name itself
+            in_module = any(re.search(rf'(^|\.){pattern}\.', name) for pattern in patterns)
+            if in_module or name in names:
+                lora_name = f"{lora_prefix}.{name}".replace('.', '_')
+                extract_keys.append((lora_name, ldm_key, slice_index, num_slices))
+    return extract_keys
+
+
+def _read_weight(f, key: str, slice_index: int, num_slices: int) -> torch.Tensor:
+    if num_slices == 1:
+        return f.get_tensor(key).float()
+    # only the rows of this slice are read
+    tensor_slice = f.get_slice(key)
+    rows = tensor_slice.get_shape()[0] // num_slices
+    return tensor_slice[slice_index * rows:(slice_index + 1) * rows].float()
+
+
+@torch.no_grad()
+def extract_diff_from_files(
+        base_path: str,
+        db_path: str,
+        output_path: str,
+        is_v2=False,
+        mode='fixed',
+        linear_mode_param=0,
+        conv_mode_param=0,
+        extract_device='cpu',
+        use_bias=False,
+        sparsity=0.98,
+        small_conv=True,
+        linear_only=False,
+        extract_unet=True,
+        extract_text_encoder=True,
+        num_workers=4,
+        save_dtype=torch.float16,
+        metadata: Optional[Dict[str, str]] = None,
+) -> int:
+    """
+    extract_diff for two safetensors ldm checkpoints, without loading either model. The weights are read
+    lazily one pair at a time, extracted on num_workers threads and written to output_path as they finish,
+    so only a few layers are in memory at once. Returns the number of layers extracted.
+    """
+    extract_keys = get_ldm_extract_keys(is_v2, extract_unet, extract_text_encoder, linear_only)
+    num_extracted = 0
+    missing_keys = []
+
+    def extract(lora_name, base_weight, db_weight):
+        return extract_layer(
+            lora_name, base_weight, db_weight, mode, linear_mode_param, conv_mode_param, extract_device,
+            use_bias, sparsity, small_conv, linear_only
+        )
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with safe_open(base_path, framework='pt', device='cpu') as base_file, \
+            safe_open(db_path, framework='pt', device='cpu') as db_file, \
+            ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor, \
+            SafetensorsWriter(output_path, metadata) as writer:
+        base_keys = set(base_file.keys())
+        db_keys = set(db_file.keys())
+        # a few layers are read ahead while the workers are busy
+        in_flight = deque()
+
+        def write_oldest():
+            nonlocal num_extracted
+            loras = in_flight.popleft().result()
+            if len(loras) > 0:
+                num_extracted += 1
+            for key, value in loras.items():
+                writer.write(key, value.to(save_dtype))
+
+        for lora_name, ldm_key, slice_index, num_slices in tqdm(extract_keys, desc='Extracting'):
+            if ldm_key not in base_keys or ldm_key not in db_keys:
+                missing_keys.append(ldm_key)
+                continue
+            # norms and, for linear_only, 3x3 convs are skipped without reading them
+            shape = db_file.get_slice(ldm_key).get_shape()
+            if len(shape) not in [2, 4] or (linear_only and len(shape) == 4 and shape[2:] != [1, 1]):
+                continue
+            base_weight = _read_weight(base_file, ldm_key, slice_index, num_slices)
+            db_weight = _read_weight(db_file, ldm_key, slice_index, num_slices)
+            in_flight.append(executor.submit(extract, lora_name, base_weight, db_weight))
+            del base_weight, db_weight
+            if len(in_flight) > num_workers:
+                write_oldest()
+        while len(in_flight) > 0:
+            write_oldest()
+
+    if len(missing_keys) > 0:
+        print(f"Warning: {len(missing_keys)} weights were not in both checkpoints and were skipped")
+    return num_extracted
+
+
 def get_module(
         lyco_state_dict: Dict,
         lora_name
@@ -0,0 +1,166 @@
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import time
+from typing import Dict, List, Union
+
+import torch
+
+from toolkit.paths import CONVERTED_MODELS_CACHE_ROOT
+
+# an entry is only used once this is written, after all of its files
+COMPLETE_MARKER = 'cache_entry.json'
+FILE_HASHES_NAME = 'file_hashes.json'
+HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def get_dir_size(path: str) -> int:
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+def get_pipeline_component_kwargs(pipeline_class, kwargs: dict) -> List[str]:
+    # names of the pipeline components passed in kwargs, they are not part of the converted checkpoint
+    params = inspect.signature(pipeline_class.__init__).parameters
+    return sorted(k for k, v in kwargs.items() if k in params and k != 'self' and not isinstance(v, bool))
+
+
+class ConvertedModelCache:
+    """
+    Diffusers format copies of single file checkpoints, so a checkpoint is only converted once and loaded with
+    from_pretrained after that. Entries are keyed by the sha256 of the checkpoint, the pipeline class, the
+    dtype and the components that were passed in instead of converted. The hash of a file is remembered by
+    path, size and mtime, so an unchanged file is only hashed once. When the cache grows past max_size_gb
+    the least recently used entries are removed.
+    """
+
+    def __init__(self, cache_root: Union[str, None] = None, max_size_gb: float = 32):
+        self.cache_root = cache_root if cache_root is not None else CONVERTED_MODELS_CACHE_ROOT
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.file_hashes_path = os.path.join(self.cache_root, FILE_HASHES_NAME)
+
+    def _load_file_hashes(self) -> Dict[str, dict]:
+        try:
+            with open(self.file_hashes_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_file_hashes(self, file_hashes: Dict[str, dict]):
+        os.makedirs(self.cache_root, exist_ok=True)
+        tmp_path = f"{self.file_hashes_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(file_hashes, f, indent=2)
+        os.replace(tmp_path, self.file_hashes_path)
+
+    def get_file_hash(self, path: str) -> str:
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        file_hashes = self._load_file_hashes()
+        known = file_hashes.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        print(f"Hashing {path}")
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        file_hash = sha256.hexdigest()
+        file_hashes[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_hash}
+        self._save_file_hashes(file_hashes)
+        return file_hash
+
+    def get_key(
+            self,
+            model_path: str,
+            pipeline_class,
+            torch_dtype: torch.dtype,
+            passed_components: Union[List[str], None] = None,
+    ) -> str:
+        import diffusers
+        key_data = {
+            'sha256': self.get_file_hash(model_path),
+            'pipeline': f"{pipeline_class.__module__}.{pipeline_class.__qualname__}",
+            'dtype': str(torch_dtype),
+            'passed_components': sorted(passed_components or []),
+            # the conversion can change between diffusers versions
+            'diffusers': diffusers.__version__,
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+
+    def get_entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_root, key)
+
+    def get(self, key: str) -> Union[str, None]:
+        # path of a complete entry to load with from_pretrained, marked as used
+        entry_path = self.get_entry_path(key)
+        marker_path = os.path.join(entry_path, COMPLETE_MARKER)
+        if not os.path.exists(marker_path):
+            return None
+        try:
+            os.utime(marker_path)
+        except OSError:
+            pass
+        return entry_path
+
+    def put(self, key: str, pipe, source: str, skip_components: Union[List[str], None] = None) -> Union[str, None]:
+        # saves the components of a converted pipeline, except the ones that were passed in
+        entry_path = self.get_entry_path(key)
+        if os.path.exists(os.path.join(entry_path, COMPLETE_MARKER)):
+            return entry_path
+        skip_components = skip_components or []
+        tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(tmp_path, exist_ok=True)
+            for name, component in pipe.components.items():
+                if name in skip_components or component is None:
+                    continue
+                component.save_pretrained(os.path.join(tmp_path, name))
+            # model_index.json
+            pipe.save_config(tmp_path)
+            with open(os.path.join(tmp_path, COMPLETE_MARKER), 'w') as f:
+                json.dump({'source': os.path.realpath(source), 'created': time.time()}, f, indent=2)
+            entry_size = get_dir_size(tmp_path)
+            try:
+                os.rename(tmp_path, entry_path)
+                print(f"Cached the converted model in {entry_path} ({entry_size / 1024 ** 3:.2f}GB)")
+            except OSError:
+                # another process cached it first
+                shutil.rmtree(tmp_path, ignore_errors=True)
+        except Exception as e:
+            print(f"Warning: could not cache the converted model: {e}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return None
+        self.evict(keep=key)
+        return entry_path
+
+    def evict(self, keep: Union[str, None] = None):
+        # remove least recently used entries until the cache fits in max_size
+        if not os.path.isdir(self.cache_root):
+            return
+        entries = []
+        for name in os.listdir(self.cache_root):
+            marker_path = os.path.join(self.cache_root, name, COMPLETE_MARKER)
+            if not os.path.exists(marker_path):
+                continue
+            entry_path = os.path.join(self.cache_root, name)
+            entries.append((os.path.getmtime(marker_path), name, get_dir_size(entry_path)))
+        total_size = sum(size for _, _, size in entries)
+        for last_used, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if name == keep:
+                continue
+            print(f"Removing converted model {name} from the cache")
+            # the marker goes first so a partly removed entry is never used
+            os.remove(os.path.join(self.cache_root, name, COMPLETE_MARKER))
+            shutil.rmtree(os.path.join(self.cache_root, name), ignore_errors=True)
+            total_size -= size
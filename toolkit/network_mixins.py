@@ -21,6 +21,7 @@ if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork, LoRAModule
     from toolkit.stable_diffusion_model import StableDiffusion
     from toolkit.models.DoRA import DoRAModule
+    from toolkit.async_saver import AsyncSaver
 
 Network = Union['LycorisSpecialNetwork', 'LoRASpecialNetwork']
 Module = Union['LoConSpecialModule', 'LoRAModule', 'DoRAModule']
@@ -44,6 +45,11 @@ ExtractMode = Union[
     'percentage'
 ]
 
+# batched merge deltas are computed in chunks of about this size
+MERGE_CHUNK_SIZE_MB = 256
+# original weights kept in pinned memory while the network is merged in, the rest go to normal memory
+MERGE_MAX_PINNED_MB = 2048
+
 
 def broadcast_and_multiply(tensor, multiplier):
     # Determine the number of dimensions required
@@ -151,6 +157,157 @@ class ExtractableModuleMixin:
             self.scalar.data = torch.tensor(1.0).to(self.scalar.device, self.scalar.dtype)
 
 
+class SharedInputGroup:
+    """
+    LoRA modules on sibling linear layers with the same input size, like to_q, to_k and to_v. Which of them
+    are fed the same activation is learned from the first forward. After that the down projections of the
+    modules sharing an input run as one matmul on a single dtype cast of it, and each module takes its slice.
+    The modules keep their own lora_down weights, so saving and loading are unchanged.
+    """
+
+    def __init__(self, modules: List[Module]):
+        self.modules = modules
+        self.index = {id(module): i for i, module in enumerate(modules)}
+        # module index -> indices of the modules fed the same input, itself included
+        self.partners: Dict[int, tuple] = {}
+        # input and modules seen with it while learning
+        self._learn_input: Union[weakref.ref, None] = None
+        self._learn_members: List[int] = []
+        # slices of the last fused matmul that were not taken yet
+        self._cache_input: Union[weakref.ref, None] = None
+        self._cache_key: Union[tuple, None] = None
+        self._cache: Dict[int, torch.Tensor] = {}
+
+    def _learn(self, idx: int, x: torch.Tensor):
+        if self._learn_input is not None and self._learn_input() is x:
+            if idx not in self._learn_members:
+                self._learn_members.append(idx)
+            return
+        # a new input, so everything seen with the last one is known
+        for member in self._learn_members:
+            if member not in self.partners:
+                self.partners[member] = tuple(self._learn_members)
+        self._learn_input = weakref.ref(x)
+        self._learn_members = [idx]
+
+    def get_down(self, module: Module, x: torch.Tensor) -> torch.Tensor:
+        idx = self.index[id(module)]
+        partners = self.partners.get(idx)
+        if partners is None:
+            self._learn(idx, x)
+        if partners is None or len(partners) == 1:
+            return module.lora_down(x.to(module.lora_down.weight.dtype))
+
+        key = (x._version, torch.is_grad_enabled())
+        if self._cache_input is not None and self._cache_input() is x and self._cache_key == key and idx in self._cache:
+            return self._cache.pop(idx)
+
+        weights = [self.modules[member].lora_down.weight for member in partners]
+        if any(w.dtype != weights[0].dtype or w.device != weights[0].device for w in weights):
+            return module.lora_down(x.to(module.lora_down.weight.dtype))
+        weight = torch.cat(weights, dim=0)
+        lx = torch.nn.functional.linear(x.to(weight.dtype), weight)
+        outputs = lx.split([w.shape[0] for w in weights], dim=-1)
+        self._cache = {member: output for member, output in zip(partners, outputs) if member != idx}
+        self._cache_input = weakref.ref(x)
+        self._cache_key = key
+        return outputs[partners.index(idx)]
+
+
+class NetworkMerger:
+    """
+    Merges the network into the weights of the model and back out again. The deltas of modules with the same
+    shapes are computed in one batched matmul and added to the weights in place. The original weights are
+    kept on the cpu while merged in, so merging out copies them back exactly instead of subtracting the delta
+    again. Up to max_pinned_mb of them are in pinned memory, the rest in normal memory, and all of them are
+    freed on merge out.
+    """
+
+    def __init__(self, modules: List[Module], pin_memory: bool = True, max_pinned_mb: float = MERGE_MAX_PINNED_MB):
+        self.modules = modules
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.max_pinned_bytes = int(max_pinned_mb * 1024 * 1024)
+        # module index -> cpu copy of the original weight
+        self._originals: Dict[int, torch.Tensor] = {}
+        self._pinned_bytes = 0
+        # indices of the modules merged in
+        self._merged: List[int] = []
+        self.is_merged_in = False
+
+    def _backup(self, idx: int, weight: torch.Tensor):
+        nbytes = weight.numel() * weight.element_size()
+        pin_memory = self.pin_memory and weight.is_cuda and self._pinned_bytes + nbytes <= self.max_pinned_bytes
+        try:
+            buffer = torch.empty(weight.shape, dtype=weight.dtype, device='cpu', pin_memory=pin_memory)
+        except RuntimeError:
+            # out of page locked memory, use normal memory from here on
+            print("Warning: could not allocate pinned memory for merging, falling back to normal memory")
+            self.pin_memory = False
+            pin_memory = False
+            buffer = torch.empty(weight.shape, dtype=weight.dtype, device='cpu')
+        if pin_memory:
+            self._pinned_bytes += nbytes
+        self._originals[idx] = buffer
+        buffer.copy_(weight, non_blocking=pin_memory)
+
+    def _apply(self, idx: int, delta: torch.Tensor):
+        weight = self.modules[idx].org_module[0].weight
+        self._backup(idx, weight.data)
+        # the add is done in float32 and rounded once to the weight dtype
+        weight.data.add_(delta.to(weight.device))
+        self._merged.append(idx)
+
+    @torch.no_grad()
+    def merge_in(self, merge_weight=1.0):
+        if self.is_merged_in:
+            return
+        # linear and 1x1 conv modules with the same shapes -> (module index, up, down, scale)
+        groups: Dict[tuple, List[tuple]] = OrderedDict()
+        for idx, module in enumerate(self.modules):
+            merge_weights = module.get_merge_weights()
+            if merge_weights is None:
+                continue
+            up_weight, down_weight, scale = merge_weights
+            if len(down_weight.size()) == 4 and down_weight.size()[2:4] != (1, 1):
+                self._apply(idx, module.get_merge_delta(merge_weight))
+                continue
+            up_weight = up_weight.reshape(up_weight.shape[:2])
+            down_weight = down_weight.reshape(down_weight.shape[:2])
+            key = (up_weight.device, up_weight.shape, down_weight.shape)
+            groups.setdefault(key, []).append((idx, up_weight, down_weight, scale))
+
+        for (device, up_shape, down_shape), members in groups.items():
+            # cap the size of the batched deltas
+            delta_bytes = up_shape[0] * down_shape[1] * 4
+            chunk_size = max(1, MERGE_CHUNK_SIZE_MB * 1024 * 1024 // delta_bytes)
+            for i in range(0, len(members), chunk_size):
+                chunk = members[i:i + chunk_size]
+                ups = torch.stack([up_weight for _, up_weight, _, _ in chunk])
+                downs = torch.stack([down_weight for _, _, down_weight, _ in chunk])
+                scales = torch.tensor(
+                    [float(scale) * merge_weight for _, _, _, scale in chunk], dtype=torch.float32, device=device
+                )
+                deltas = torch.bmm(ups, downs).mul_(scales.view(-1, 1, 1))
+                for (idx, _, _, _), delta in zip(chunk, deltas):
+                    self._apply(idx, delta.view(self.modules[idx].org_module[0].weight.shape))
+                del deltas
+        self.is_merged_in = True
+
+    @torch.no_grad()
+    def merge_out(self):
+        if not self.is_merged_in:
+            return
+        for idx in self._merged:
+            weight = self.modules[idx].org_module[0].weight
+            original = self._originals[idx]
+            weight.data.copy_(original, non_blocking=original.is_pinned())
+        self._merged = []
+        # pending copies keep their pinned blocks alive until they are done
+        self._originals = {}
+        self._pinned_bytes = 0
+        self.is_merged_in = False
+
+
 class ToolkitModuleMixin:
     def __init__(
             self: Module,
@@ -161,14 +318,19 @@ class ToolkitModuleMixin:
         self.network_ref: weakref.ref = weakref.ref(network)
         self.is_checkpointing = False
         self._multiplier: Union[float, list, torch.Tensor] = None
+        # set when the down projection is fused with other modules fed the same input
+        self.shared_input_group: Union[SharedInputGroup, None] = None
 
-    def _call_forward(self: Module, x):
+    def _call_forward(self: Module, x, lx=None):
+        # lx is the output of lora_down when it was already computed
         # module dropout
         if self.module_dropout is not None and self.training:
             if torch.rand(1) < self.module_dropout:
                 return 0.0  # added to original forward
 
-        if hasattr(self, 'lora_mid') and self.lora_mid is not None:
+        if lx is not None:
+            pass
+        elif hasattr(self, 'lora_mid') and self.lora_mid is not None:
             lx = self.lora_mid(self.lora_down(x))
         else:
             try:
@@ -262,9 +424,13 @@ class ToolkitModuleMixin:
 
         if isinstance(x, QTensor):
             x = x.dequantize()
-        # always cast to float32
-        lora_input = x.to(self.lora_down.weight.dtype)
-        lora_output = self._call_forward(lora_input)
+        if self.shared_input_group is not None:
+            # the group casts the input once for all modules fed it
+            lora_output = self._call_forward(None, lx=self.shared_input_group.get_down(self, x))
+        else:
+            # always cast to float32
+            lora_input = x.to(self.lora_down.weight.dtype)
+            lora_output = self._call_forward(lora_input)
         multiplier = self.network_ref().torch_multiplier
 
         lora_output_batch_size = lora_output.size(0)
@@ -318,55 +484,46 @@ class ToolkitModuleMixin:
         self.merge_in(merge_weight=-merge_out_weight)
 
     @torch.no_grad()
-    def merge_in(self: Module, merge_weight=1.0):
+    def get_merge_weights(self: Module):
+        # (up, down, scale) of a module that can be merged in, None if it cannot
         if not self.can_merge_in:
-            return
-        # get up/down weight
-        up_weight = self.lora_up.weight.clone().float()
-        down_weight = self.lora_down.weight.clone().float()
-
-        # extract weight from org_module
-        org_sd = self.org_module[0].state_dict()
+            return None
+        weight = self.org_module[0].weight
         # todo find a way to merge in weights when doing quantized model
-        if 'weight._data' in org_sd:
-            # quantized weight
-            return
-
-        weight_key = "weight"
-        if 'weight._data' in org_sd:
-            # quantized weight
-            weight_key = "weight._data"
-
-        orig_dtype = org_sd[weight_key].dtype
-        weight = org_sd[weight_key].float()
-
-        multiplier = merge_weight
+        if isinstance(weight, QTensor) or hasattr(weight, '_data'):
+            return None
         scale = self.scale
         # handle trainable scaler method locon does
         if hasattr(self, 'scalar'):
             scale = scale * self.scalar
+        return self.lora_up.weight.float(), self.lora_down.weight.float(), scale
 
-        # merge weight
-        if len(weight.size()) == 2:
+    @torch.no_grad()
+    def get_merge_delta(self: Module, merge_weight=1.0) -> Union[torch.Tensor, None]:
+        # float32 delta to add to the org_module weight
+        merge_weights = self.get_merge_weights()
+        if merge_weights is None:
+            return None
+        up_weight, down_weight, scale = merge_weights
+        if len(down_weight.size()) == 2:
             # linear
-            weight = weight + multiplier * (up_weight @ down_weight) * scale
+            delta = up_weight @ down_weight
         elif down_weight.size()[2:4] == (1, 1):
             # conv2d 1x1
-            weight = (
-                    weight
-                    + multiplier
-                    * (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
-                    * scale
-            )
+            delta = (up_weight.squeeze(3).squeeze(2) @ down_weight.squeeze(3).squeeze(2)).unsqueeze(2).unsqueeze(3)
         else:
             # conv2d 3x3
-            conved = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
-            # print(conved.size(), weight.size(), module.stride, module.padding)
-            weight = weight + multiplier * conved * scale
+            delta = torch.nn.functional.conv2d(down_weight.permute(1, 0, 2, 3), up_weight).permute(1, 0, 2, 3)
+        return delta * (merge_weight * scale)
 
-        # set weight to org_module
-        org_sd[weight_key] = weight.to(orig_dtype)
-        self.org_module[0].load_state_dict(org_sd)
+    @torch.no_grad()
+    def merge_in(self: Module, merge_weight=1.0):
+        delta = self.get_merge_delta(merge_weight)
+        if delta is None:
+            return
+        weight = self.org_module[0].weight
+        # the add is done in float32 and rounded once to the weight dtype
+        weight.data.add_(delta.to(weight.device))
 
     def setup_lorm(self: Module, state_dict: Optional[Dict[str, Any]] = None):
         # LoRM (Low Rank Middle) is a method reduce the number of parameters in a module while keeping the inputs and
@@ -478,7 +635,8 @@ class ToolkitNetworkMixin:
             self: Network,
             file, dtype=torch.float16,
             metadata=None,
-            extra_state_dict: Optional[OrderedDict] = None
+            extra_state_dict: Optional[OrderedDict] = None,
+            saver: Optional['AsyncSaver'] = None
     ):
         keymap = self.get_keymap()
 
@@ -530,10 +688,16 @@ class ToolkitNetworkMixin:
             metadata = OrderedDict()
         metadata = add_model_hash_to_meta(state_dict, metadata)
         if os.path.splitext(file)[1] == ".safetensors":
-            from safetensors.torch import save_file
-            save_file(save_dict, file, metadata)
+            if saver is not None:
+                saver.save_file(save_dict, file, metadata)
+            else:
+                from safetensors.torch import save_file
+                save_file(save_dict, file, metadata)
         else:
-            torch.save(save_dict, file)
+            if saver is not None:
+                saver.torch_save(save_dict, file)
+            else:
+                torch.save(save_dict, file)
 
     def load_weights(self: Network, file, force_weight_mapping=False):
         # allows us to save and load to and from ldm weights
@@ -654,6 +818,34 @@ class ToolkitNetworkMixin:
             loras += self.text_encoder_loras
         return loras
 
+    def setup_shared_input_groups(self: Network, root_modules: List[torch.nn.Module]):
+        # linear loras on siblings with the same input size may share an input, the groups find out which do
+        parents = {}
+        for root_module in root_modules:
+            for parent in root_module.modules():
+                for child in parent.children():
+                    parents[id(child)] = id(parent)
+        candidates: Dict[tuple, List[Module]] = OrderedDict()
+        for module in self.get_all_modules():
+            if (
+                    not isinstance(module.lora_down, torch.nn.Linear)
+                    or getattr(module, 'lora_mid', None) is not None
+                    or module.__class__.__name__ == "DoRAModule"
+            ):
+                continue
+            org_module = module.org_module[0]
+            key = (parents.get(id(org_module)), module.lora_down.in_features)
+            candidates.setdefault(key, []).append(module)
+        num_grouped = 0
+        for modules in candidates.values():
+            if len(modules) < 2:
+                continue
+            group = SharedInputGroup(modules)
+            for module in modules:
+                module.shared_input_group = group
+            num_grouped += len(modules)
+        print(f"Fusing the down projections of {num_grouped} LoRA modules that may share an input")
+
     def _update_checkpointing(self: Network):
         for module in self.get_all_modules():
             if self.is_checkpointing:
@@ -671,19 +863,23 @@ class ToolkitNetworkMixin:
         self.is_checkpointing = False
         self._update_checkpointing()
 
+    def get_merger(self: Network) -> 'NetworkMerger':
+        if getattr(self, 'merger', None) is None:
+            self.merger = NetworkMerger(self.get_all_modules())
+        return self.merger
+
     def merge_in(self, merge_weight=1.0):
         if self.network_type.lower() == 'dora':
             return
         self.is_merged_in = True
-        for module in self.get_all_modules():
-            module.merge_in(merge_weight)
+        self.get_merger().merge_in(merge_weight)
 
     def merge_out(self: Network, merge_weight=1.0):
+        # the original weights are copied back, so merge_weight is not needed
         if not self.is_merged_in:
             return
         self.is_merged_in = False
-        for module in self.get_all_modules():
-            module.merge_out(merge_weight)
+        self.get_merger().merge_out()
 
     def extract_weight(
             self: Network,
@@ -14,6 +14,12 @@ if 'MODELS_PATH' in os.environ:
 else:
     MODELS_PATH = os.path.join(TOOLKIT_ROOT, "models")
 
+# single file checkpoints converted to diffusers format are kept here
+if 'CONVERTED_MODELS_CACHE' in os.environ:
+    CONVERTED_MODELS_CACHE_ROOT = os.environ['CONVERTED_MODELS_CACHE']
+else:
+    CONVERTED_MODELS_CACHE_ROOT = os.path.join(os.path.expanduser("~"), ".cache", "ai-toolkit", "converted_models")
+
 
 def get_path(path):
     # we allow absolute paths, but if it is not absolute, we assume it is relative to the toolkit root
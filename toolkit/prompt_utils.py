@@ -135,7 +135,10 @@ def concat_prompt_embeds(prompt_embeds: list[PromptEmbeds]):
     pooled_embeds = None
     if prompt_embeds[0].pooled_embeds is not None:
         pooled_embeds = torch.cat([p.pooled_embeds for p in prompt_embeds], dim=0)
-    return PromptEmbeds([text_embeds, pooled_embeds])
+    attention_mask = None
+    if prompt_embeds[0].attention_mask is not None:
+        attention_mask = torch.cat([p.attention_mask for p in prompt_embeds], dim=0)
+    return PromptEmbeds([text_embeds, pooled_embeds], attention_mask=attention_mask)
 
 
 def concat_prompt_pairs(prompt_pairs: list[EncodedPromptPair]):
@@ -184,9 +187,14 @@ def split_prompt_embeds(concatenated: PromptEmbeds, num_parts=None) -> List[Prom
     else:
         pooled_embeds_splits = [None] * num_parts
 
+    if concatenated.attention_mask is not None:
+        attention_mask_splits = torch.chunk(concatenated.attention_mask, num_parts, dim=0)
+    else:
+        attention_mask_splits = [None] * num_parts
+
     prompt_embeds_list = [
-        PromptEmbeds([text, pooled])
-        for text, pooled in zip(text_embeds_splits, pooled_embeds_splits)
+        PromptEmbeds([text, pooled], attention_mask=attention_mask)
+        for text, pooled, attention_mask in zip(text_embeds_splits, pooled_embeds_splits, attention_mask_splits)
     ]
 
     return prompt_embeds_list
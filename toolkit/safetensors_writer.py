@@ -0,0 +1,98 @@
+import json
+import os
+import shutil
+import struct
+from collections import OrderedDict
+from typing import Dict, Union
+
+import torch
+
+SAFETENSORS_DTYPES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+
+
+class SafetensorsWriter:
+    """
+    Writes a safetensors file one tensor at a time, so the whole state dict never has to be in memory. The
+    tensor data goes to a side file as it comes in. On close the header is written and the data is copied in
+    after it, then the file is swapped into place, so a failed write never leaves a partial file.
+
+    with SafetensorsWriter(path, metadata) as writer:
+        for key, tensor in tensors:
+            writer.write(key, tensor)
+    """
+
+    def __init__(self, filename: str, metadata: Union[Dict[str, str], None] = None):
+        self.filename = filename
+        self.metadata = metadata
+        self.header: Dict[str, dict] = OrderedDict()
+        self._offset = 0
+        self._data_path = f"{filename}.{os.getpid()}.data"
+        self._data = open(self._data_path, 'wb')
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.header
+
+    def __len__(self) -> int:
+        return len(self.header)
+
+    def write(self, key: str, tensor: torch.Tensor):
+        if key in self.header:
+            raise ValueError(f"{key} was already written to {self.filename}")
+        if tensor.dtype not in SAFETENSORS_DTYPES:
+            raise ValueError(f"Cannot save {key} with dtype {tensor.dtype} to safetensors")
+        tensor = tensor.detach().to('cpu').contiguous()
+        data = tensor.reshape(-1).view(torch.uint8).numpy()
+        self._data.write(data.data)
+        self.header[key] = {
+            'dtype': SAFETENSORS_DTYPES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [self._offset, self._offset + data.nbytes],
+        }
+        self._offset += data.nbytes
+
+    def close(self):
+        self._data.close()
+        header = OrderedDict()
+        if self.metadata is not None:
+            header['__metadata__'] = {k: str(v) for k, v in self.metadata.items()}
+        header.update(self.header)
+        header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+        # the data has to start 8 byte aligned
+        header_bytes += b' ' * (-len(header_bytes) % 8)
+        tmp_path = f"{self.filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(struct.pack('<Q', len(header_bytes)))
+                f.write(header_bytes)
+                with open(self._data_path, 'rb') as data:
+                    shutil.copyfileobj(data, f, 16 * 1024 * 1024)
+            os.replace(tmp_path, self.filename)
+        finally:
+            for path in [tmp_path, self._data_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def abort(self):
+        self._data.close()
+        if os.path.exists(self._data_path):
+            os.remove(self._data_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -4,6 +4,8 @@ from typing import Union
 from diffusers import FlowMatchEulerDiscreteScheduler
 import torch
 
+from toolkit.timestep_sampler import get_timestep_indices
+
 
 class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
     def __init__(self, *args, **kwargs):
@@ -33,7 +35,11 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
 
     def get_weights_for_timesteps(self, timesteps: torch.Tensor) -> torch.Tensor:
         # Get the indices of the timesteps
-        step_indices = [(self.timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(self.timesteps, timesteps)
+
+        # keep the weights on the device of the timesteps so the lookup does not sync
+        if self.linear_timesteps_weights.device != step_indices.device:
+            self.linear_timesteps_weights = self.linear_timesteps_weights.to(step_indices.device)
 
         # Get the weights for the timesteps
         weights = self.linear_timesteps_weights[step_indices].flatten()
@@ -43,8 +49,7 @@ class CustomFlowMatchEulerDiscreteScheduler(FlowMatchEulerDiscreteScheduler):
     def get_sigmas(self, timesteps: torch.Tensor, n_dim, dtype, device) -> torch.Tensor:
         sigmas = self.sigmas.to(device=device, dtype=dtype)
         schedule_timesteps = self.timesteps.to(device)
-        timesteps = timesteps.to(device)
-        step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
+        step_indices = get_timestep_indices(schedule_timesteps, timesteps)
 
         sigma = sigmas[step_indices].flatten()
         while len(sigma.shape) < n_dim:
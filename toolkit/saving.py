@@ -1,16 +1,20 @@
 import json
 import os
 from collections import OrderedDict
-from typing import TYPE_CHECKING, Literal, Optional, Union
+from functools import lru_cache
+from typing import TYPE_CHECKING, Iterator, Literal, Optional, Tuple, Union
 
 import torch
+from safetensors import safe_open
 from safetensors.torch import load_file, save_file
 
 from toolkit.train_tools import get_torch_dtype
 from toolkit.paths import KEYMAPS_ROOT
+from toolkit.safetensors_writer import SafetensorsWriter
 
 if TYPE_CHECKING:
     from toolkit.stable_diffusion_model import StableDiffusion
+    from toolkit.async_saver import AsyncSaver
 
 
 def get_slices_from_string(s: str) -> tuple:
@@ -19,34 +23,57 @@ def get_slices_from_string(s: str) -> tuple:
     return tuple(slices)
 
 
-def convert_state_dict_to_ldm_with_mapping(
+LDM_MAPPING_FILES = {
+    '1': ('stable_diffusion_sd1.json', 'stable_diffusion_sd1_ldm_base.safetensors'),
+    '2': ('stable_diffusion_sd2.json', 'stable_diffusion_sd2_ldm_base.safetensors'),
+    'sdxl': ('stable_diffusion_sdxl.json', 'stable_diffusion_sdxl_ldm_base.safetensors'),
+    'ssd': ('stable_diffusion_ssd.json', 'stable_diffusion_ssd_ldm_base.safetensors'),
+    'vega': ('stable_diffusion_vega.json', 'stable_diffusion_vega_ldm_base.safetensors'),
+    'sdxl_refiner': ('stable_diffusion_refiner.json', 'stable_diffusion_refiner_ldm_base.safetensors'),
+}
+
+
+@lru_cache(maxsize=None)
+def load_ldm_mapping(mapping_path: str) -> 'OrderedDict':
+    # parsed once per file, do not modify the result
+    with open(mapping_path, 'r') as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def get_ldm_mapping_paths(
+        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega', 'sdxl_refiner'] = '2'
+) -> Tuple[str, str]:
+    if sd_version not in LDM_MAPPING_FILES:
+        raise ValueError(f"Invalid sd_version {sd_version}")
+    mapping_file, base_file = LDM_MAPPING_FILES[sd_version]
+    return os.path.join(KEYMAPS_ROOT, mapping_file), os.path.join(KEYMAPS_ROOT, base_file)
+
+
+def iter_ldm_state_dict_from_diffusers(
         diffusers_state_dict: 'OrderedDict',
         mapping_path: str,
         base_path: Union[str, None] = None,
-        device: str = 'cpu',
+        device: Union[str, None] = 'cpu',
         dtype: torch.dtype = torch.float32
-) -> 'OrderedDict':
-    converted_state_dict = OrderedDict()
-
-    # load mapping
-    with open(mapping_path, 'r') as f:
-        mapping = json.load(f, object_pairs_hook=OrderedDict)
+) -> Iterator[Tuple[str, torch.Tensor]]:
+    """
+    Yields the ldm (key, tensor) pairs converted from a diffusers state dict one at a time, so they can be
+    written out without the whole converted state dict in memory. The base tensors, keys like timing ids that
+    diffusers does not have, are read lazily and only for keys the conversion does not make. With device None
+    tensors stay on the device they are on.
+    """
+    mapping = load_ldm_mapping(mapping_path)
 
     # keep track of keys not matched
-    ldm_matched_keys = []
-    diffusers_matched_keys = []
+    ldm_matched_keys = set()
+    diffusers_matched_keys = set()
 
     ldm_diffusers_keymap = mapping['ldm_diffusers_keymap']
     ldm_diffusers_shape_map = mapping['ldm_diffusers_shape_map']
     ldm_diffusers_operator_map = mapping['ldm_diffusers_operator_map']
 
-    # load base if it exists
-    # the base just has come keys like timing ids and stuff diffusers doesn't have or they don't match
-    if base_path is not None:
-        converted_state_dict = load_file(base_path, device)
-        # convert to the right dtype
-        for key in converted_state_dict:
-            converted_state_dict[key] = converted_state_dict[key].to(device, dtype=dtype)
+    def convert(tensor: torch.Tensor) -> torch.Tensor:
+        return tensor.detach().to(device if device is not None else tensor.device, dtype=dtype)
 
     # process operators first
     for ldm_key in ldm_diffusers_operator_map:
@@ -55,35 +82,40 @@ def convert_state_dict_to_ldm_with_mapping(
             cat_list = []
             for diffusers_key in ldm_diffusers_operator_map[ldm_key]['cat']:
                 cat_list.append(diffusers_state_dict[diffusers_key].detach())
-            converted_state_dict[ldm_key] = torch.cat(cat_list, dim=0).to(device, dtype=dtype)
-            diffusers_matched_keys.extend(ldm_diffusers_operator_map[ldm_key]['cat'])
-            ldm_matched_keys.append(ldm_key)
+            yield ldm_key, convert(torch.cat(cat_list, dim=0))
+            del cat_list
+            diffusers_matched_keys.update(ldm_diffusers_operator_map[ldm_key]['cat'])
+            ldm_matched_keys.add(ldm_key)
         if 'slice' in ldm_diffusers_operator_map[ldm_key]:
             tensor_to_slice = diffusers_state_dict[ldm_diffusers_operator_map[ldm_key]['slice'][0]]
             slice_text = diffusers_state_dict[ldm_diffusers_operator_map[ldm_key]['slice'][1]]
-            converted_state_dict[ldm_key] = tensor_to_slice[get_slices_from_string(slice_text)].detach().to(device,
-                                                                                                            dtype=dtype)
-            diffusers_matched_keys.extend(ldm_diffusers_operator_map[ldm_key]['slice'])
-            ldm_matched_keys.append(ldm_key)
+            yield ldm_key, convert(tensor_to_slice[get_slices_from_string(slice_text)])
+            diffusers_matched_keys.update(ldm_diffusers_operator_map[ldm_key]['slice'])
+            ldm_matched_keys.add(ldm_key)
 
     # process the rest of the keys
     for ldm_key in ldm_diffusers_keymap:
         # if the key is in the ldm key, we need to process it
         if ldm_diffusers_keymap[ldm_key] in diffusers_state_dict:
-            tensor = diffusers_state_dict[ldm_diffusers_keymap[ldm_key]].detach().to(device, dtype=dtype)
+            tensor = diffusers_state_dict[ldm_diffusers_keymap[ldm_key]]
             # see if we need to reshape
             if ldm_key in ldm_diffusers_shape_map:
                 tensor = tensor.view(ldm_diffusers_shape_map[ldm_key][0])
-            converted_state_dict[ldm_key] = tensor
-            diffusers_matched_keys.append(ldm_diffusers_keymap[ldm_key])
-            ldm_matched_keys.append(ldm_key)
+            yield ldm_key, convert(tensor)
+            diffusers_matched_keys.add(ldm_diffusers_keymap[ldm_key])
+            ldm_matched_keys.add(ldm_key)
 
-    # see if any are missing from know mapping
-    mapped_diffusers_keys = list(ldm_diffusers_keymap.values())
-    mapped_ldm_keys = list(ldm_diffusers_keymap.keys())
+    # load base if it exists
+    # the base just has come keys like timing ids and stuff diffusers doesn't have or they don't match
+    if base_path is not None:
+        with safe_open(base_path, framework='pt', device='cpu') as f:
+            for key in f.keys():
+                if key not in ldm_matched_keys:
+                    yield key, convert(f.get_tensor(key))
 
-    missing_diffusers_keys = [x for x in mapped_diffusers_keys if x not in diffusers_matched_keys]
-    missing_ldm_keys = [x for x in mapped_ldm_keys if x not in ldm_matched_keys]
+    # see if any are missing from know mapping
+    missing_diffusers_keys = [x for x in ldm_diffusers_keymap.values() if x not in diffusers_matched_keys]
+    missing_ldm_keys = [x for x in ldm_diffusers_keymap.keys() if x not in ldm_matched_keys]
 
     if len(missing_diffusers_keys) > 0:
         print(f"WARNING!!!! Missing {len(missing_diffusers_keys)} diffusers keys")
@@ -92,7 +124,17 @@ def convert_state_dict_to_ldm_with_mapping(
         print(f"WARNING!!!! Missing {len(missing_ldm_keys)} ldm keys")
         print(missing_ldm_keys)
 
-    return converted_state_dict
+
+def convert_state_dict_to_ldm_with_mapping(
+        diffusers_state_dict: 'OrderedDict',
+        mapping_path: str,
+        base_path: Union[str, None] = None,
+        device: str = 'cpu',
+        dtype: torch.dtype = torch.float32
+) -> 'OrderedDict':
+    return OrderedDict(
+        iter_ldm_state_dict_from_diffusers(diffusers_state_dict, mapping_path, base_path, device=device, dtype=dtype)
+    )
 
 
 def get_ldm_state_dict_from_diffusers(
@@ -101,32 +143,8 @@ def get_ldm_state_dict_from_diffusers(
         device='cpu',
         dtype=get_torch_dtype('fp32'),
 ):
-    if sd_version == '1':
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd1.json')
-    elif sd_version == '2':
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sd2.json')
-    elif sd_version == 'sdxl':
-        # load our base
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sdxl_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_sdxl.json')
-    elif sd_version == 'ssd':
-        # load our base
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_ssd_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_ssd.json')
-    elif sd_version == 'vega':
-        # load our base
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_vega_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_vega.json')
-    elif sd_version == 'sdxl_refiner':
-        # load our base
-        base_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_refiner_ldm_base.safetensors')
-        mapping_path = os.path.join(KEYMAPS_ROOT, 'stable_diffusion_refiner.json')
-    else:
-        raise ValueError(f"Invalid sd_version {sd_version}")
-
-        # convert the state dict
+    mapping_path, base_path = get_ldm_mapping_paths(sd_version)
+    # convert the state dict
     return convert_state_dict_to_ldm_with_mapping(
         state_dict,
         mapping_path,
@@ -136,24 +154,47 @@ def get_ldm_state_dict_from_diffusers(
     )
 
 
+def save_ldm_state_dict_from_diffusers(
+        state_dict: 'OrderedDict',
+        output_file: str,
+        meta: 'OrderedDict',
+        save_dtype=get_torch_dtype('fp16'),
+        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega', 'sdxl_refiner'] = '2',
+        saver: Optional['AsyncSaver'] = None
+):
+    # converts and writes one tensor at a time, the async saver keeps its own cpu copy of each
+    mapping_path, base_path = get_ldm_mapping_paths(sd_version)
+
+    # make sure parent folder exists
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    if saver is not None:
+        # cast on the device, the saver copies it out through its pinned buffers
+        tensors = iter_ldm_state_dict_from_diffusers(state_dict, mapping_path, base_path, device=None, dtype=save_dtype)
+        saver.save_tensors(tensors, output_file, metadata=meta)
+    else:
+        tensors = iter_ldm_state_dict_from_diffusers(state_dict, mapping_path, base_path, device='cpu', dtype=save_dtype)
+        with SafetensorsWriter(output_file, meta) as writer:
+            for key, tensor in tensors:
+                writer.write(key, tensor)
+
+
 def save_ldm_model_from_diffusers(
         sd: 'StableDiffusion',
         output_file: str,
         meta: 'OrderedDict',
         save_dtype=get_torch_dtype('fp16'),
-        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega'] = '2'
+        sd_version: Literal['1', '2', 'sdxl', 'ssd', 'vega'] = '2',
+        saver: Optional['AsyncSaver'] = None
 ):
-    converted_state_dict = get_ldm_state_dict_from_diffusers(
+    save_ldm_state_dict_from_diffusers(
         sd.state_dict(),
-        sd_version,
-        device='cpu',
-        dtype=save_dtype
+        output_file,
+        meta,
+        save_dtype=save_dtype,
+        sd_version=sd_version,
+        saver=saver,
     )
 
-    # make sure parent folder exists
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    save_file(converted_state_dict, output_file, metadata=meta)
-
 
 def save_lora_from_diffusers(
         lora_state_dict: 'OrderedDict',
@@ -184,6 +225,7 @@ def save_t2i_from_diffusers(
         output_file: str,
         meta: 'OrderedDict',
         dtype=get_torch_dtype('fp16'),
+        saver: Optional['AsyncSaver'] = None
 ):
     # todo: test compatibility with non diffusers
     converted_state_dict = OrderedDict()
@@ -192,7 +234,10 @@ def save_t2i_from_diffusers(
 
     # make sure parent folder exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    save_file(converted_state_dict, output_file, metadata=meta)
+    if saver is not None:
+        saver.save_file(converted_state_dict, output_file, metadata=meta)
+    else:
+        save_file(converted_state_dict, output_file, metadata=meta)
 
 
 def load_t2i_model(
@@ -215,7 +260,8 @@ def save_ip_adapter_from_diffusers(
         output_file: str,
         meta: 'OrderedDict',
         dtype=get_torch_dtype('fp16'),
-        direct_save: bool = False
+        direct_save: bool = False,
+        saver: Optional['AsyncSaver'] = None
 ):
     # todo: test compatibility with non diffusers
 
@@ -229,7 +275,10 @@ def save_ip_adapter_from_diffusers(
 
     # make sure parent folder exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    save_file(converted_state_dict, output_file, metadata=meta)
+    if saver is not None:
+        saver.save_file(converted_state_dict, output_file, metadata=meta)
+    else:
+        save_file(converted_state_dict, output_file, metadata=meta)
 
 
 def load_ip_adapter_model(
@@ -0,0 +1,111 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+from PIL import Image
+from PIL.ImageOps import exif_transpose
+
+from toolkit import image_utils
+
+# bump to invalidate every stored size
+SIZE_DATABASE_VERSION = 2
+
+# below this many unknown files it is faster to probe them in this process
+_min_files_for_pool = 256
+
+
+def probe_image_size(path: str) -> Union[Tuple[int, int], None]:
+    # module level so it can be sent to a process pool. Returns None for unreadable images
+    try:
+        return image_utils.get_image_size(path)
+    except image_utils.UnknownImageFormat:
+        pass
+    except Exception:
+        return None
+    try:
+        img = exif_transpose(Image.open(path))
+        return img.size
+    except Exception:
+        return None
+
+
+class ImageSizeDatabase:
+    """
+    Width and height of every image in a dataset, stored in .aitk_size.json in the dataset folder.
+    Entries are keyed by path relative to the dataset folder and hold the file mtime and size so
+    edited files are probed again. Only new or changed files are probed, in parallel.
+    """
+
+    def __init__(self, path: str, dataset_root: str, num_workers: int = None):
+        self.path = path
+        self.dataset_root = dataset_root
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        # rel path -> [width, height, mtime_ns, file size]
+        self.entries: Dict[str, List[int]] = {}
+        self.is_dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Warning: could not read size database {self.path}, rebuilding it: {e}")
+            return
+        # the old format is keyed only by basename and cannot be validated, so it is rebuilt
+        if isinstance(data, dict) and data.get('__version__') == SIZE_DATABASE_VERSION:
+            self.entries = data.get('files', {})
+        else:
+            self.is_dirty = True
+
+    def save(self):
+        if not self.is_dirty:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'__version__': SIZE_DATABASE_VERSION, 'files': self.entries}, f)
+        # atomic so a crash or a second job never sees a half written file
+        os.replace(tmp_path, self.path)
+        self.is_dirty = False
+
+    def _key(self, path: str) -> str:
+        return os.path.relpath(path, self.dataset_root).replace(os.sep, '/')
+
+    def get_sizes(self, paths: List[str]) -> Dict[str, Tuple[int, int]]:
+        sizes: Dict[str, Tuple[int, int]] = {}
+        to_probe: List[Tuple[str, str, int, int]] = []
+        for path in dict.fromkeys(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key = self._key(path)
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] == stat.st_mtime_ns and entry[3] == stat.st_size:
+                sizes[path] = (entry[0], entry[1])
+            else:
+                to_probe.append((path, key, stat.st_mtime_ns, stat.st_size))
+
+        if len(to_probe) == 0:
+            return sizes
+
+        probe_paths = [x[0] for x in to_probe]
+        if self.num_workers > 1 and len(to_probe) >= _min_files_for_pool:
+            print(f"  -  Probing {len(to_probe)} image sizes with {self.num_workers} workers")
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                chunksize = max(1, min(1024, len(probe_paths) // (self.num_workers * 4)))
+                results = list(executor.map(probe_image_size, probe_paths, chunksize=chunksize))
+        else:
+            results = [probe_image_size(path) for path in probe_paths]
+
+        for (path, key, mtime_ns, file_size), size in zip(to_probe, results):
+            if size is None:
+                continue
+            w, h = size
+            sizes[path] = (w, h)
+            self.entries[key] = [w, h, mtime_ns, file_size]
+            self.is_dirty = True
+        return sizes
@@ -4,7 +4,7 @@ import json
 import random
 import shutil
 import typing
-from typing import Union, List, Literal, Iterator
+from typing import Union, List, Literal, Iterator, Tuple
 import sys
 import os
 from collections import OrderedDict
@@ -29,12 +29,14 @@ from library.model_util import convert_unet_state_dict_to_sd, convert_text_encod
     convert_vae_state_dict, load_vae
 from toolkit import train_tools
 from toolkit.config_modules import ModelConfig, GenerateImageConfig
+from toolkit.distributed import is_main_process
 from toolkit.metadata import get_meta_for_safetensors
+from toolkit.model_cache import ConvertedModelCache, get_pipeline_component_kwargs
 from toolkit.paths import REPOS_ROOT, KEYMAPS_ROOT
-from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds
+from toolkit.prompt_utils import inject_trigger_into_prompt, PromptEmbeds, concat_prompt_embeds, split_prompt_embeds
 from toolkit.reference_adapter import ReferenceAdapter
 from toolkit.sampler import get_sampler
-from toolkit.saving import save_ldm_model_from_diffusers, get_ldm_state_dict_from_diffusers
+from toolkit.saving import save_ldm_model_from_diffusers, save_ldm_state_dict_from_diffusers
 from toolkit.sd_device_states_presets import empty_preset
 from toolkit.train_tools import get_torch_dtype, apply_noise_offset
 from einops import rearrange, repeat
@@ -63,6 +65,7 @@ from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from toolkit.lora_special import LoRASpecialNetwork
+    from toolkit.async_saver import AsyncSaver
 
 # tell it to shut up
 diffusers.logging.set_verbosity(diffusers.logging.ERROR)
@@ -87,7 +90,7 @@ DO_NOT_TRAIN_WEIGHTS = [
     "refiner_unet_time_embedding.linear_2.weight",
 ]
 
-DeviceStatePreset = Literal['cache_latents', 'generate']
+DeviceStatePreset = Literal['cache_latents', 'cache_clip', 'cache_text_embeddings', 'generate']
 
 
 class BlankNetwork:
@@ -163,6 +166,9 @@ class StableDiffusion:
         # to hold network if there is one
         self.network = None
         self.adapter: Union['ControlNetModel', 'T2IAdapter', 'IPAdapter', 'ReferenceAdapter', None] = None
+        # memo key -> single prompt embeds, for prompts that repeat every step like negative prompts
+        self.prompt_embeds_memo: OrderedDict = OrderedDict()
+        self.prompt_embeds_memo_size = 32
         self.is_xl = model_config.is_xl
         self.is_v2 = model_config.is_v2
         self.is_ssd = model_config.is_ssd
@@ -187,6 +193,26 @@ class StableDiffusion:
         # merge in and preview active with -1 weight
         self.invert_assistant_lora = False
 
+    def load_single_file_pipeline(self, pipeline_class, model_path: str, **kwargs):
+        # from_single_file, through the converted model cache so a checkpoint is only converted once
+        if not self.model_config.use_converted_cache:
+            return pipeline_class.from_single_file(model_path, **kwargs)
+        cache = ConvertedModelCache(
+            self.model_config.converted_cache_dir,
+            max_size_gb=self.model_config.converted_cache_max_gb
+        )
+        passed_components = get_pipeline_component_kwargs(pipeline_class, kwargs)
+        key = cache.get_key(model_path, pipeline_class, kwargs.get('torch_dtype', self.torch_dtype), passed_components)
+        cache_path = cache.get(key)
+        if cache_path is not None:
+            print(f"Loading converted model from {cache_path}")
+            return pipeline_class.from_pretrained(cache_path, **kwargs)
+        pipe = pipeline_class.from_single_file(model_path, **kwargs)
+        if is_main_process():
+            print(f"Caching converted model to {cache.get_entry_path(key)}")
+            cache.put(key, pipe, model_path, skip_components=passed_components)
+        return pipe
+
     def load_model(self):
         if self.is_loaded:
             return
@@ -228,7 +254,8 @@ class StableDiffusion:
                     **load_args
                 )
             else:
-                pipe = pipln.from_single_file(
+                pipe = self.load_single_file_pipeline(
+                    pipln,
                     model_path,
                     device=self.device_torch,
                     torch_dtype=self.torch_dtype,
@@ -697,7 +724,8 @@ class StableDiffusion:
                     **load_args
                 )
             else:
-                pipe = pipln.from_single_file(
+                pipe = self.load_single_file_pipeline(
+                    pipln,
                     model_path,
                     dtype=dtype,
                     device=self.device_torch,
@@ -1913,6 +1941,79 @@ class StableDiffusion:
             return latents, first_prediction
         return latents
 
+    def is_text_encoder_trained(self) -> bool:
+        # true when the text encoder output for a prompt can change between steps
+        text_encoders = self.text_encoder if isinstance(self.text_encoder, list) else [self.text_encoder]
+        for text_encoder in text_encoders:
+            if any(param.requires_grad for param in text_encoder.parameters()):
+                return True
+        if self.network is not None and len(getattr(self.network, 'text_encoder_loras', [])) > 0:
+            return True
+        # these inject into the tokenizer or text encoder per step
+        if self.adapter is not None and isinstance(self.adapter, (ClipVisionAdapter, CustomAdapter)):
+            return True
+        return False
+
+    def encode_prompt_with_negative(
+            self,
+            prompt: Union[List[str], None],
+            negative_prompt: List[str],
+            prompt2: Union[List[str], None] = None,
+            long_prompts=False,
+            dropout_prob=0.0,
+    ) -> Tuple[Union[PromptEmbeds, None], PromptEmbeds]:
+        # Encodes the prompts (None to only get negatives) and the negative prompts. Negative prompts repeat
+        # across steps, so while the text encoders are frozen they are memoized by text and encoder settings.
+        # The ones not memoized yet are encoded in the same text encoder batch as the prompts
+        use_memo = not long_prompts and dropout_prob == 0 and not self.is_text_encoder_trained()
+        if not use_memo:
+            # long prompts pad to the batch, dropout is random, and trained encoders change
+            self.prompt_embeds_memo.clear()
+            conditional_embeds = None
+            if prompt is not None:
+                conditional_embeds = self.encode_prompt(
+                    prompt, prompt2, long_prompts=long_prompts, dropout_prob=dropout_prob
+                )
+            negative_embeds = self.encode_prompt(negative_prompt, long_prompts=long_prompts, dropout_prob=dropout_prob)
+            return conditional_embeds, negative_embeds
+
+        def get_memo_key(text: str) -> tuple:
+            return text, self.model_config.use_text_encoder_1, self.model_config.use_text_encoder_2
+
+        found = {}
+        for text in negative_prompt:
+            key = get_memo_key(text)
+            if key in self.prompt_embeds_memo:
+                self.prompt_embeds_memo.move_to_end(key)
+                found[text] = self.prompt_embeds_memo[key]
+        missing = [text for text in dict.fromkeys(negative_prompt) if text not in found]
+
+        conditional_embeds = None
+        if prompt is not None and len(missing) > 0:
+            # the negatives have no second prompt, that is the same as using the prompt for both
+            combined_prompt2 = None if prompt2 is None else list(prompt2) + missing
+            embeds = self.encode_prompt(list(prompt) + missing, combined_prompt2)
+            embeds_list = split_prompt_embeds(embeds, len(prompt) + len(missing))
+            conditional_embeds = concat_prompt_embeds(embeds_list[:len(prompt)])
+            missing_embeds = embeds_list[len(prompt):]
+        else:
+            if prompt is not None:
+                conditional_embeds = self.encode_prompt(prompt, prompt2)
+            missing_embeds = []
+            if len(missing) > 0:
+                missing_embeds = split_prompt_embeds(self.encode_prompt(missing), len(missing))
+
+        for text, embeds in zip(missing, missing_embeds):
+            embeds = embeds.detach()
+            found[text] = embeds
+            self.prompt_embeds_memo[get_memo_key(text)] = embeds
+            while len(self.prompt_embeds_memo) > self.prompt_embeds_memo_size:
+                self.prompt_embeds_memo.popitem(last=False)
+
+        # concat makes new tensors, callers can move them without touching the memo
+        negative_embeds = concat_prompt_embeds([found[text] for text in negative_prompt])
+        return conditional_embeds, negative_embeds
+
     def encode_prompt(
             self,
             prompt,
@@ -2285,23 +2386,27 @@ class StableDiffusion:
             new_key = k if k.startswith(f"{SD_PREFIX_UNET}_") else f"{SD_PREFIX_UNET}_{k}"
             diffusers_state_dict[new_key] = v
 
-        converted_state_dict = get_ldm_state_dict_from_diffusers(
+        save_ldm_state_dict_from_diffusers(
             diffusers_state_dict,
-            'sdxl_refiner',
-            device='cpu',
-            dtype=save_dtype
+            output_file,
+            meta,
+            save_dtype=save_dtype,
+            sd_version='sdxl_refiner'
         )
 
-        # make sure parent folder exists
-        os.makedirs(os.path.dirname(output_file), exist_ok=True)
-        save_file(converted_state_dict, output_file, metadata=meta)
-
         if self.config_file is not None:
             output_path_no_ext = os.path.splitext(output_file)[0]
             output_config_path = f"{output_path_no_ext}.yaml"
             shutil.copyfile(self.config_file, output_config_path)
 
-    def save(self, output_file: str, meta: OrderedDict, save_dtype=get_torch_dtype('fp16'), logit_scale=None):
+    def save(
+            self,
+            output_file: str,
+            meta: OrderedDict,
+            save_dtype=get_torch_dtype('fp16'),
+            logit_scale=None,
+            saver: Union['AsyncSaver', None] = None
+    ):
         version_string = '1'
         if self.is_v2:
             version_string = '2'
@@ -2347,6 +2452,7 @@ class StableDiffusion:
                 meta=meta,
                 save_dtype=save_dtype,
                 sd_version=version_string,
+                saver=saver,
             )
             if self.config_file is not None:
                 output_path_no_ext = os.path.splitext(output_file)[0]
@@ -2583,6 +2689,8 @@ class StableDiffusion:
             active_modules = ['vae']
         if device_state_preset in ['cache_clip']:
             active_modules = ['clip']
+        if device_state_preset in ['cache_text_embeddings']:
+            active_modules = ['text_encoder']
         if device_state_preset in ['generate']:
             active_modules = ['vae', 'unet', 'text_encoder', 'adapter', 'refiner_unet']
 
@@ -0,0 +1,54 @@
+import warnings
+
+import torch
+
+# torch warns with this message for every synchronizing cuda call while the sync debug mode is 'warn'
+_SYNC_WARNING = 'called a synchronizing CUDA operation'
+
+
+class HostSyncCounter:
+    """
+    Counts the device to host syncs made inside a block, using the cuda sync debug mode. Syncs stall the cpu
+    until the gpu catches up, so a training step should make as few as possible. Only cuda syncs can be
+    counted, on other devices the count stays at 0.
+
+    with counter:
+        loss_dict = self.hook_train_loop(batch)
+    print(counter.count)
+    """
+
+    def __init__(self):
+        self.is_available = torch.cuda.is_available()
+        # syncs in the last block
+        self.count = 0
+        self.total = 0
+        self._catcher = None
+        self._records = None
+        self._prev_mode = 0
+
+    def __enter__(self):
+        self.count = 0
+        if not self.is_available:
+            return self
+        self._catcher = warnings.catch_warnings(record=True)
+        self._records = self._catcher.__enter__()
+        # report every sync, not only the first one from each line
+        warnings.simplefilter('always')
+        self._prev_mode = torch.cuda.get_sync_debug_mode()
+        torch.cuda.set_sync_debug_mode('warn')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.is_available:
+            return
+        torch.cuda.set_sync_debug_mode(self._prev_mode)
+        self._catcher.__exit__(exc_type, exc_val, exc_tb)
+        for record in self._records:
+            if _SYNC_WARNING in str(record.message):
+                self.count += 1
+            else:
+                # pass on everything else
+                warnings.warn_explicit(record.message, record.category, record.filename, record.lineno)
+        self.total += self.count
+        self._catcher = None
+        self._records = None
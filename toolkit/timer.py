@@ -1,65 +1,301 @@
+import json
+import os
+import threading
 import time
 from collections import OrderedDict, deque
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+# joins nested span names, get_batch > load_image > decode
+PATH_SEPARATOR = ' > '
+
+# (path, start in us, duration in us, pid), the start is on the monotonic clock shared by all processes
+TimerEvent = Tuple[str, int, int, int]
+
+
+def _now_us() -> int:
+    return time.perf_counter_ns() // 1000
+
+
+class _Span:
+    # context manager returned by Timer.__call__, so spans can nest
+    def __init__(self, timer: 'Timer', timer_name: str):
+        self.timer = timer
+        self.timer_name = timer_name
+
+    def __enter__(self):
+        self.timer.start(self.timer_name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # No exceptions, stop the timer normally
+            self.timer.stop(self.timer_name)
+        else:
+            # There was an exception, cancel the timer
+            self.timer.cancel(self.timer_name)
 
 
 class Timer:
-    def __init__(self, name='Timer', max_buffer=10):
+    """
+    Hierarchical step profiler. Spans started while another span is active are recorded under it, so a
+    `with timer('decode')` inside `with timer('load_image')` is kept as load_image > decode. For every span it
+    keeps the last max_buffer durations for p50 / p95 / max, the total since the last reset, and a trace of
+    recent events for chrome://tracing. Spans whose name is in data_wait_names count as time spent waiting
+    for data, the rest of the top level spans count as compute.
+
+    Each thread keeps its own stack of active spans, so spans started on worker threads do not nest under or
+    stop the spans of other threads. Spans recorded in other processes, like dataloader workers, are merged in
+    with add_events. With use_cuda_events, spans also record cuda events so the gpu time of each span is known.
+    Those are only read back when the stats are made, so timing does not sync the device.
+    """
+
+    def __init__(
+            self,
+            name='Timer',
+            max_buffer=100,
+            max_trace_events=20000,
+            use_cuda_events=False,
+    ):
         self.name = name
         self.max_buffer = max_buffer
-        self.timers = OrderedDict()
-        self.active_timers = {}
-        self.current_timer = None  # Used for the context manager functionality
+        # path -> recent durations in seconds
+        self.timers: Dict[str, deque] = OrderedDict()
+        # path -> total seconds and count since the last reset
+        self.totals: Dict[str, float] = OrderedDict()
+        self.counts: Dict[str, int] = OrderedDict()
+        # path -> recent gpu durations in seconds
+        self.gpu_timers: Dict[str, deque] = OrderedDict()
+        self.trace: deque = deque(maxlen=max_trace_events)
+        # per thread active spans and stack
+        self._local = threading.local()
+        # guards the recorded stats, spans can be recorded from several threads
+        self._lock = threading.Lock()
+        # timer name -> path it was last recorded at
+        self.last_paths: Dict[str, str] = {}
+        self.data_wait_names = set()
+        self.use_cuda_events = use_cuda_events
+        self._pending_gpu: deque = deque(maxlen=max_trace_events)
+        if self.use_cuda_events:
+            import torch
+            if not torch.cuda.is_available():
+                self.use_cuda_events = False
+
+    @property
+    def active_timers(self) -> Dict[str, tuple]:
+        # timer name -> (path, start us, cuda start event), for this thread
+        if not hasattr(self._local, 'active_timers'):
+            self._local.active_timers = {}
+        return self._local.active_timers
+
+    @property
+    def stack(self) -> List[str]:
+        # names of the active spans of this thread, innermost last
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
 
     def start(self, timer_name):
-        if timer_name not in self.timers:
-            self.timers[timer_name] = deque(maxlen=self.max_buffer)
-        self.active_timers[timer_name] = time.time()
+        path = PATH_SEPARATOR.join(self.stack + [timer_name])
+        cuda_start = None
+        if self.use_cuda_events:
+            import torch
+            cuda_start = torch.cuda.Event(enable_timing=True)
+            cuda_start.record()
+        self.stack.append(timer_name)
+        self.active_timers[timer_name] = (path, _now_us(), cuda_start)
+
+    def _pop_stack(self, timer_name):
+        # spans normally stop innermost first, but start / stop can be used out of order
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i] == timer_name:
+                del self.stack[i]
+                return
 
     def cancel(self, timer_name):
         """Cancel an active timer."""
         if timer_name in self.active_timers:
             del self.active_timers[timer_name]
+            self._pop_stack(timer_name)
 
     def stop(self, timer_name):
         if timer_name not in self.active_timers:
             raise ValueError(f"Timer '{timer_name}' was not started!")
 
-        elapsed_time = time.time() - self.active_timers[timer_name]
-        self.timers[timer_name].append(elapsed_time)
+        path, start_us, cuda_start = self.active_timers.pop(timer_name)
+        self._pop_stack(timer_name)
+        duration_us = _now_us() - start_us
+        self.record(path, start_us, duration_us, os.getpid())
+        with self._lock:
+            self.last_paths[timer_name] = path
+
+        if cuda_start is not None:
+            import torch
+            cuda_end = torch.cuda.Event(enable_timing=True)
+            cuda_end.record()
+            self._pending_gpu.append((path, cuda_start, cuda_end))
+
+    def record(self, path: str, start_us: int, duration_us: int, pid: int):
+        seconds = duration_us / 1e6
+        with self._lock:
+            if path not in self.timers:
+                self.timers[path] = deque(maxlen=self.max_buffer)
+                self.totals[path] = 0.0
+                self.counts[path] = 0
+            self.timers[path].append(seconds)
+            self.totals[path] += seconds
+            self.counts[path] += 1
+            self.trace.append((path, start_us, duration_us, pid))
+
+    def add_events(self, events: List[TimerEvent], parent: Union[str, None] = None):
+        # merge spans recorded by another timer, under the path the parent timer name was last recorded at
+        parent_path = self.last_paths.get(parent, parent) if parent is not None else None
+        for path, start_us, duration_us, pid in events:
+            if parent_path is not None:
+                path = f"{parent_path}{PATH_SEPARATOR}{path}"
+            self.record(path, start_us, duration_us, pid)
+
+    def pop_events(self) -> List[TimerEvent]:
+        # hand the recorded spans to another process and forget them here
+        with self._lock:
+            events = list(self.trace)
+            self._clear()
+        return events
 
-        # Clean up active timers
-        del self.active_timers[timer_name]
+    def _resolve_gpu_times(self):
+        while len(self._pending_gpu) > 0:
+            path, cuda_start, cuda_end = self._pending_gpu.popleft()
+            cuda_end.synchronize()
+            if path not in self.gpu_timers:
+                self.gpu_timers[path] = deque(maxlen=self.max_buffer)
+            self.gpu_timers[path].append(cuda_start.elapsed_time(cuda_end) / 1000)
 
-        # Check if this timer's buffer exceeds max_buffer and remove the oldest if it does
-        if len(self.timers[timer_name]) > self.max_buffer:
-            self.timers[timer_name].popleft()
+    def _is_data_wait(self, path: str) -> bool:
+        return path.split(PATH_SEPARATOR)[-1] in self.data_wait_names
+
+    def get_fractions(self) -> Dict[str, float]:
+        # share of the top level time spent waiting for data and computing
+        with self._lock:
+            totals = list(self.totals.items())
+        total = sum(value for path, value in totals if PATH_SEPARATOR not in path)
+        data_wait = 0.0
+        for path, value in totals:
+            if not self._is_data_wait(path):
+                continue
+            # nested data spans are already counted in their parent
+            parents = path.split(PATH_SEPARATOR)[:-1]
+            if any(name in self.data_wait_names for name in parents):
+                continue
+            data_wait += value
+        if total <= 0:
+            return {'data_wait': 0.0, 'compute': 0.0}
+        data_wait = min(data_wait / total, 1.0)
+        return {'data_wait': data_wait, 'compute': 1.0 - data_wait}
+
+    def get_stats(self) -> Dict[str, dict]:
+        if self.use_cuda_events:
+            self._resolve_gpu_times()
+        stats = OrderedDict()
+        with self._lock:
+            timers = [(path, list(timings), self.counts[path], self.totals[path]) for path, timings in self.timers.items()]
+        for path, timings, count, total in timers:
+            if len(timings) == 0:
+                continue
+            values = np.array(timings)
+            stats[path] = OrderedDict([
+                ('count', count),
+                ('total', total),
+                ('mean', float(values.mean())),
+                ('p50', float(np.percentile(values, 50))),
+                ('p95', float(np.percentile(values, 95))),
+                ('max', float(values.max())),
+            ])
+            if path in self.gpu_timers and len(self.gpu_timers[path]) > 0:
+                gpu_values = np.array(self.gpu_timers[path])
+                stats[path]['gpu_mean'] = float(gpu_values.mean())
+                stats[path]['gpu_p95'] = float(np.percentile(gpu_values, 95))
+        return stats
+
+    def _tree_key(self, path: str) -> list:
+        # parents before their children, longest total first on each level
+        names = path.split(PATH_SEPARATOR)
+        return [
+            (-self.totals.get(PATH_SEPARATOR.join(names[:i + 1]), 0.0), names[i]) for i in range(len(names))
+        ]
 
     def print(self):
         print(f"\nTimer '{self.name}':")
-        # sort by longest at top
-        for timer_name, timings in sorted(self.timers.items(), key=lambda x: sum(x[1]), reverse=True):
-            avg_time = sum(timings) / len(timings)
-            print(f" - {avg_time:.4f}s avg - {timer_name}, num = {len(timings)}")
+        stats = self.get_stats()
+        for path in sorted(stats.keys(), key=self._tree_key):
+            stat = stats[path]
+            depth = path.count(PATH_SEPARATOR)
+            timer_name = path.split(PATH_SEPARATOR)[-1]
+            line = f"{'  ' * depth} - {stat['mean']:.4f}s avg, p50 {stat['p50']:.4f}s, p95 {stat['p95']:.4f}s, " \
+                   f"max {stat['max']:.4f}s"
+            if 'gpu_mean' in stat:
+                line += f", gpu {stat['gpu_mean']:.4f}s avg"
+            print(f"{line} - {timer_name}, num = {stat['count']}")
+        if len(self.data_wait_names) > 0:
+            fractions = self.get_fractions()
+            print(f" data wait {fractions['data_wait'] * 100:.1f}%, compute {fractions['compute'] * 100:.1f}%")
 
         print('')
 
+    def log_to_tensorboard(self, writer, step: int):
+        for path, stat in self.get_stats().items():
+            tag = path.replace(PATH_SEPARATOR, '/')
+            for key in ['mean', 'p50', 'p95', 'max', 'gpu_mean']:
+                if key in stat:
+                    writer.add_scalar(f"timer/{tag}/{key}", stat[key], step)
+        if len(self.data_wait_names) > 0:
+            for key, value in self.get_fractions().items():
+                writer.add_scalar(f"timer/fraction/{key}", value, step)
+
+    def save_json(self, path: str, step: Union[int, None] = None):
+        data = OrderedDict([
+            ('name', self.name),
+            ('step', step),
+            ('spans', self.get_stats()),
+            ('fractions', self.get_fractions()),
+        ])
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    def save_chrome_trace(self, path: str):
+        # open with chrome://tracing or https://ui.perfetto.dev
+        events = []
+        for event_path, start_us, duration_us, pid in self.trace:
+            events.append({
+                'name': event_path.split(PATH_SEPARATOR)[-1],
+                'cat': event_path,
+                'ph': 'X',
+                'ts': start_us,
+                'dur': duration_us,
+                'pid': pid,
+                'tid': pid,
+            })
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
     def reset(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
         self.timers.clear()
-        self.active_timers.clear()
+        self.totals.clear()
+        self.counts.clear()
+        self.gpu_timers.clear()
+        self.trace.clear()
+        # spans that are still running keep going
+        self._pending_gpu.clear()
 
     def __call__(self, timer_name):
         """Enable the use of the Timer class as a context manager."""
-        self.current_timer = timer_name
-        self.start(timer_name)
-        return self
+        return _Span(self, timer_name)
 
-    def __enter__(self):
-        pass
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        if exc_type is None:
-            # No exceptions, stop the timer normally
-            self.stop(self.current_timer)
-        else:
-            # There was an exception, cancel the timer
-            self.cancel(self.current_timer)
+# spans recorded while loading data, in the dataloader workers or the main process when there are none.
+# They are sent along with each batch and merged into the training timer
+data_timer = Timer('data')
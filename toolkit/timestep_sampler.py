@@ -0,0 +1,157 @@
+from typing import TYPE_CHECKING, Dict, Union
+
+import torch
+
+from toolkit.basic import value_map
+
+if TYPE_CHECKING:
+    from toolkit.config_modules import TrainConfig
+
+
+def get_timestep_indices(
+        schedule_timesteps: torch.Tensor,
+        timesteps: torch.Tensor,
+        check_on_host: bool = False
+) -> torch.Tensor:
+    # index of each timestep in the schedule, first match. Stays on the device, unlike nonzero().item()
+    timesteps = timesteps.to(schedule_timesteps.device).reshape(-1, 1)
+    matches = schedule_timesteps.reshape(1, -1) == timesteps
+    found = matches.any(dim=1)
+    if check_on_host or found.device.type == 'cpu':
+        if not found.all():
+            missing = timesteps.flatten()[~found].tolist()
+            raise ValueError(f"Timesteps {missing} are not in the noise scheduler timesteps")
+    else:
+        # argmax would map a missing timestep to index 0. Fail on the device instead of reading back to the host
+        torch._assert_async(found.all(), "Timesteps are not in the noise scheduler timesteps")
+    return matches.to(torch.uint8).argmax(dim=1)
+
+
+class TimestepSampler:
+    """
+    Samples training timesteps and looks up their sigmas entirely on the training device. The schedule
+    timesteps and sigmas are kept as device lookup tables, so a step never has to read values back to the
+    host. The scheduler is only set up again when something else changed its timesteps, or every step for
+    the random flowmatch schedule.
+    """
+
+    def __init__(self, train_config: 'TrainConfig', device: Union[str, torch.device]):
+        self.train_config = train_config
+        self.device = torch.device(device)
+        self.noise_scheduler = None
+        self.timesteps: Union[torch.Tensor, None] = None
+        self._scheduler_sigmas = None
+        # dtype -> sigmas on the device
+        self._sigmas: Dict[torch.dtype, torch.Tensor] = {}
+        # the first lookup checks for missing timesteps on the host for a readable error, later ones on the device
+        self._checked_on_host = False
+
+    def _is_static_schedule(self) -> bool:
+        return self.train_config.noise_scheduler != 'flowmatch' or self.train_config.linear_timesteps
+
+    def set_train_timesteps(self, noise_scheduler):
+        if (
+                self._is_static_schedule()
+                and noise_scheduler is self.noise_scheduler
+                and noise_scheduler.timesteps is self.timesteps
+                and getattr(noise_scheduler, 'sigmas', None) is self._scheduler_sigmas
+        ):
+            # the scheduler still holds our schedule
+            return
+        num_train_timesteps = self.train_config.num_train_timesteps
+        if self.train_config.noise_scheduler in ['custom_lcm']:
+            # we store this value on our custom one
+            noise_scheduler.set_timesteps(noise_scheduler.train_timesteps, device=self.device)
+        elif self.train_config.noise_scheduler in ['lcm']:
+            noise_scheduler.set_timesteps(
+                num_train_timesteps, device=self.device, original_inference_steps=num_train_timesteps
+            )
+        elif self.train_config.noise_scheduler == 'flowmatch':
+            noise_scheduler.set_train_timesteps(
+                num_train_timesteps,
+                device=self.device,
+                linear=self.train_config.linear_timesteps
+            )
+        else:
+            noise_scheduler.set_timesteps(num_train_timesteps, device=self.device)
+        if noise_scheduler.timesteps.device != self.device:
+            noise_scheduler.timesteps = noise_scheduler.timesteps.to(self.device)
+        self.noise_scheduler = noise_scheduler
+        self.timesteps = noise_scheduler.timesteps
+        self._scheduler_sigmas = getattr(noise_scheduler, 'sigmas', None)
+        self._sigmas = {}
+
+    def sample_timestep_indices(
+            self,
+            batch_size: int,
+            content_or_style: str,
+            min_noise_steps: int,
+            max_noise_steps: int,
+    ) -> torch.Tensor:
+        num_train_timesteps = self.train_config.num_train_timesteps
+        if content_or_style in ['style', 'content']:
+            # this is from diffusers training code
+            # Cubic sampling for favoring later or earlier timesteps
+            # For more details about why cubic sampling is used for content / structure,
+            # refer to section 3.4 of https://arxiv.org/abs/2302.08453
+
+            # for content / structure, it is best to favor earlier timesteps
+            # for style, it is best to favor later timesteps
+            orig_timesteps = torch.rand((batch_size,), device=self.device)
+
+            if content_or_style == 'content':
+                timestep_indices = orig_timesteps ** 3 * num_train_timesteps
+            else:
+                timestep_indices = (1 - orig_timesteps ** 3) * num_train_timesteps
+
+            timestep_indices = value_map(
+                timestep_indices,
+                0,
+                num_train_timesteps - 1,
+                min_noise_steps,
+                max_noise_steps - 1
+            )
+            timestep_indices = timestep_indices.long().clamp(
+                min_noise_steps + 1,
+                max_noise_steps - 1
+            )
+        elif content_or_style == 'balanced':
+            if min_noise_steps == max_noise_steps:
+                timestep_indices = torch.full((batch_size,), min_noise_steps, device=self.device, dtype=torch.long)
+            else:
+                # todo, some schedulers use indices, otheres use timesteps. Not sure what to do here
+                timestep_indices = torch.randint(
+                    min_noise_steps + 1,
+                    max_noise_steps - 1,
+                    (batch_size,),
+                    device=self.device
+                )
+        else:
+            raise ValueError(f"Unknown content_or_style {content_or_style}")
+        return timestep_indices
+
+    def get_timesteps(self, timestep_indices: torch.Tensor) -> torch.Tensor:
+        return self.timesteps[timestep_indices.to(self.timesteps.device)]
+
+    def sample_timesteps(
+            self,
+            batch_size: int,
+            content_or_style: str,
+            min_noise_steps: int,
+            max_noise_steps: int,
+    ) -> torch.Tensor:
+        timestep_indices = self.sample_timestep_indices(batch_size, content_or_style, min_noise_steps, max_noise_steps)
+        return self.get_timesteps(timestep_indices)
+
+    def get_sigma_table(self, dtype=torch.float32) -> torch.Tensor:
+        if dtype not in self._sigmas:
+            self._sigmas[dtype] = self.noise_scheduler.sigmas.to(device=self.device, dtype=dtype)
+        return self._sigmas[dtype]
+
+    def get_sigmas(self, timesteps: torch.Tensor, n_dim=4, dtype=torch.float32) -> torch.Tensor:
+        step_indices = get_timestep_indices(self.timesteps, timesteps, check_on_host=not self._checked_on_host)
+        self._checked_on_host = True
+        sigma = self.get_sigma_table(dtype)[step_indices].flatten()
+        while len(sigma.shape) < n_dim:
+            sigma = sigma.unsqueeze(-1)
+        return sigma
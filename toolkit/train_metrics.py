@@ -0,0 +1,197 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Union
+
+import torch
+
+
+def get_host_rss() -> int:
+    # current resident memory of this process in bytes
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # peak since start, in kB on linux and bytes on mac, close enough where /proc is missing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return 0
+
+
+def reset_host_peak() -> bool:
+    # linux resets the peak resident memory (VmHWM) when 5 is written to clear_refs
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_host_peak() -> Union[int, None]:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class _Phase:
+    def __init__(self, metrics: 'TrainMetrics', name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.metrics.start_phase(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.end_phase(self.name)
+
+
+class TrainMetrics:
+    """
+    Throughput and efficiency of the training loop, measured over the steps between two calls to log.
+    Rates are per second of training step time. latents_per_sec is only reported when batches carried cached
+    latents. effective_samples_per_sec only counts samples that made it into an optimizer step and is per
+    second of wall time, so it includes gradient accumulation and the time spent sampling and saving.
+
+    Peak host and device memory is the peak of the process so far. With reset_peaks, the peaks are reset between
+    phases to get one for each phase: train, and the sample / save phases entered with
+    `with metrics.phase('sample')`. That resets the cuda peak memory stats and the linux VmHWM for the whole
+    process, so anything else reading them sees the reset too.
+
+    Logged as metrics/... scalars to tensorboard and as one json line per log to jsonl_path.
+    """
+
+    def __init__(self, jsonl_path: Union[str, None] = None, reset_peaks: bool = False):
+        self.jsonl_path = jsonl_path
+        self.is_cuda = torch.cuda.is_available()
+        self.reset_peaks = reset_peaks
+        self._can_reset_host_peak = reset_host_peak() if reset_peaks else False
+        self._step_start = None
+        self._data_end = None
+        self._phase_start = None
+        # samples of the current accumulation, counted once their optimizer step happens
+        self.pending_samples = 0
+        self.reset()
+
+    def reset(self):
+        self.window_start = time.perf_counter()
+        self.num_steps = 0
+        self.num_optimizer_steps = 0
+        self.num_samples = 0
+        self.num_images = 0
+        self.num_latents = 0
+        self.effective_samples = 0
+        self.step_time = 0.0
+        self.data_wait_time = 0.0
+        self.phase_times: Dict[str, float] = OrderedDict()
+        self.host_peaks: Dict[str, int] = OrderedDict()
+        self.device_peaks: Dict[str, int] = OrderedDict()
+        self._reset_peaks()
+
+    def _reset_peaks(self):
+        if not self.reset_peaks:
+            return
+        if self._can_reset_host_peak:
+            reset_host_peak()
+        if self.is_cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def _collect_peaks(self, phase: str):
+        # peaks since the last reset belong to this phase. Without resets there is one peak for the process
+        if not self.reset_peaks:
+            phase = 'process'
+        host_peak = get_host_peak()
+        if host_peak is None:
+            host_peak = get_host_rss()
+        self.host_peaks[phase] = max(self.host_peaks.get(phase, 0), host_peak)
+        if self.is_cuda:
+            device_peak = torch.cuda.max_memory_allocated()
+            self.device_peaks[phase] = max(self.device_peaks.get(phase, 0), device_peak)
+        self._reset_peaks()
+
+    def start_step(self):
+        self._step_start = time.perf_counter()
+
+    def data_ready(self):
+        self._data_end = time.perf_counter()
+
+    def end_step(self, num_samples: int, num_images: int, num_latents: int, is_optimizer_step: bool):
+        now = time.perf_counter()
+        if self._step_start is None:
+            return
+        self.step_time += now - self._step_start
+        if self._data_end is not None:
+            self.data_wait_time += self._data_end - self._step_start
+        self._step_start = None
+        self._data_end = None
+        self.num_steps += 1
+        self.num_samples += num_samples
+        self.num_images += num_images
+        self.num_latents += num_latents
+        self.pending_samples += num_samples
+        if is_optimizer_step:
+            self.num_optimizer_steps += 1
+            self.effective_samples += self.pending_samples
+            self.pending_samples = 0
+
+    def start_phase(self, name: str):
+        self._collect_peaks('train')
+        self._phase_start = time.perf_counter()
+
+    def end_phase(self, name: str):
+        self.phase_times[name] = self.phase_times.get(name, 0.0) + time.perf_counter() - self._phase_start
+        self._phase_start = None
+        self._collect_peaks(name)
+
+    def phase(self, name: str) -> _Phase:
+        return _Phase(self, name)
+
+    def get_metrics(self) -> Dict[str, float]:
+        self._collect_peaks('train')
+        wall_time = time.perf_counter() - self.window_start
+        metrics = OrderedDict()
+        if self.step_time > 0:
+            metrics['samples_per_sec'] = self.num_samples / self.step_time
+            metrics['images_per_sec'] = self.num_images / self.step_time
+            if self.num_latents > 0:
+                metrics['latents_per_sec'] = self.num_latents / self.step_time
+            metrics['steps_per_sec'] = self.num_steps / self.step_time
+            metrics['data_stall_fraction'] = self.data_wait_time / self.step_time
+        if wall_time > 0:
+            metrics['effective_samples_per_sec'] = self.effective_samples / wall_time
+            metrics['optimizer_steps_per_sec'] = self.num_optimizer_steps / wall_time
+            metrics['train_time_fraction'] = self.step_time / wall_time
+            for name, phase_time in self.phase_times.items():
+                metrics[f'{name}_time_fraction'] = phase_time / wall_time
+        metrics['train_time'] = self.step_time
+        for name, phase_time in self.phase_times.items():
+            metrics[f'{name}_time'] = phase_time
+        for name, peak in self.host_peaks.items():
+            metrics[f'host_peak_{name}_gb'] = peak / 1024 ** 3
+        for name, peak in self.device_peaks.items():
+            metrics[f'device_peak_{name}_gb'] = peak / 1024 ** 3
+        return metrics
+
+    def log(self, step: int, writer=None) -> Dict[str, float]:
+        # log the window and start a new one
+        metrics = self.get_metrics()
+        if writer is not None:
+            for key, value in metrics.items():
+                writer.add_scalar(f"metrics/{key}", value, step)
+        if self.jsonl_path is not None:
+            line = OrderedDict([('step', step), ('time', time.time())])
+            line.update(metrics)
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps(line) + '\n')
+        self.reset()
+        return metrics